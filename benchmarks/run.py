@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""Deterministic micro-benchmarks of ReferenceSeeker's Python-side hot paths.
+
+All inputs are synthetic genomes and Mash/nucmer outputs built from a fixed random seed. External tools
+are replaced by stand-in executables (benchmarks/bin) serving these recorded outputs, so only Python code
+is measured. Each benchmark is run over a series of sizes to report scaling curves. Results and timings
+are compared against a stored baseline, timings being scaled by a calibration workload measured in each run:
+
+    $ python3 benchmarks/run.py                   # compare against benchmarks/baseline.json
+    $ python3 benchmarks/run.py --record          # store a new baseline
+    $ python3 benchmarks/run.py --quick           # smallest sizes only
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+BENCHMARKS_PATH = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARKS_PATH.parent))
+
+import referenceseeker.algorithms as algorithms  # noqa: E402
+import referenceseeker.ani as ani  # noqa: E402
+import referenceseeker.constants as rc  # noqa: E402
+import referenceseeker.mash as mash  # noqa: E402
+import referenceseeker.util as util  # noqa: E402
+
+
+SEED = 42
+CONTIG_SIZE = 5000000  # max length of synthetic contigs, i.e. chromosome-sized contigs
+SIZES = {  # benchmark sizes, the first size of each benchmark is used in quick mode
+    'build_dna_fragments': [1000000, 2000000, 5000000, 10000000],  # genome size
+    'parse_mash_results': [1000, 10000, 100000],  # candidate count
+    'parse_mash_cohort': [2, 8, 32, 256],  # cohort size
+    'parse_delta': [1000000, 2000000, 5000000],  # genome size
+    'score_alignments': [1000000, 5000000, 10000000],  # genome size
+    'calculate': [2, 8, 32, 256],  # cohort size
+    'startup': [1, 10]  # sequential command line starts
+}
+TARGETS = {  # max calibrated seconds per unit, i.e. fixed overhead budgets
+    'startup': 0.5
+}
+STARTUP_SCRIPT = 'import referenceseeker.main, referenceseeker.util as util; config = {}; util.set_path(config); util.test_binaries(config)'
+COHORT_CANDIDATES = 1000  # Mash hits per cohort query genome
+COHORT_REFERENCES = 100  # common reference genomes aggregated per cohort
+
+
+def write_genome(path, genome_size, rng):
+    """Write a synthetic genome of random contigs."""
+    np_rng = np.random.RandomState(rng.randint(0, 2 ** 31))
+    nucleotides = np.frombuffer(b'ACGT', dtype='S1')
+    with path.open('w') as fh:
+        idx = 0
+        while genome_size > 0:
+            idx += 1
+            contig_size = min(genome_size, CONTIG_SIZE)
+            fh.write('>contig_%d\n' % idx)
+            sequence = nucleotides[np_rng.randint(0, 4, size=contig_size)].tobytes().decode()
+            for pos in range(0, contig_size, 80):
+                fh.write(sequence[pos:pos + 80])
+                fh.write('\n')
+            genome_size -= contig_size
+
+
+def write_mash_output(path, query_paths, no_candidates, rng, related=False):
+    """Write Mash dist output lines grouped by query genome.
+
+    Distances of related query genomes, e.g. of a cohort, deviate only slightly per reference genome.
+    """
+    reference_distances = [rng.uniform(0.0, 0.09) for _ in range(no_candidates)] if related else None
+    with path.open('w') as fh:
+        for query_path in query_paths:
+            for idx in range(no_candidates):
+                distance = reference_distances[idx] + rng.uniform(0.0, 0.01) if related else rng.uniform(0.0, 0.1)
+                fh.write('GCF_%09d.1\t%s\t%f\t0\t%d/1000\n' % (idx, query_path, distance, int((1 - distance * 10) * 1000)))
+
+
+def write_delta(path, no_fragments, rng):
+    """Write nucmer delta output of DNA fragments aligned to a reference genome.
+
+    Some fragments are aligned twice to exercise the alignment filter, some are not aligned at all.
+    """
+    with path.open('w') as fh:
+        fh.write('/ref/genome.fna /tmp/dna-fragments.fasta\nNUCMER\n')
+        for idx in range(1, no_fragments + 1):
+            if rng.random() < 0.05:
+                continue
+            fh.write('>contig_1 %d 5000000 %d\n' % (idx, rc.FRAGMENT_SIZE))
+            for _ in range(2 if rng.random() < 0.1 else 1):
+                query_start = rng.randint(1, 50)
+                query_end = rc.FRAGMENT_SIZE - rng.randint(0, 50)
+                reference_start = rng.randint(1, 4000000)
+                reference_end = reference_start + query_end - query_start
+                errors = rng.randint(0, 60)
+                fh.write('%d %d %d %d %d %d 0\n' % (reference_start, reference_end, query_start, query_end, errors, errors))
+                for _ in range(rng.randint(0, 3)):
+                    fh.write('%d\n' % (rng.choice([-1, 1]) * rng.randint(1, 300)))
+                fh.write('0\n')
+
+
+def build_config(tmp_path, db_path, genome_paths, fixtures):
+    env = os.environ.copy()
+    env['PATH'] = '%s:%s' % (BENCHMARKS_PATH.joinpath('bin'), env.get('PATH', ''))
+    env.update(fixtures)
+    return {
+        'tmp': tmp_path,
+        'db_path': db_path,
+        'genome_path': genome_paths,
+        'env': env,
+        'threads': 1,
+        'unfiltered': False,
+        'n_mash_results': 100
+    }
+
+
+def bench_build_dna_fragments(tmp_path, genome_size, rng):
+    genome_path = tmp_path.joinpath('genome.fna')
+    write_genome(genome_path, genome_size, rng)
+    dna_fragments_path = tmp_path.joinpath('dna-fragments.fasta')
+
+    def run():
+        dna_fragments = util.build_dna_fragments(genome_path, dna_fragments_path)
+        return [len(dna_fragments), int(dna_fragments.sum())]
+    return run
+
+
+def bench_parse_mash_results(tmp_path, no_candidates, rng):
+    mash_path = tmp_path.joinpath('mash.out')
+    write_mash_output(mash_path, ['query.fna'], no_candidates, rng)
+    db_path = tmp_path.joinpath('db')
+    db_path.mkdir()
+    db_path.joinpath('db.msh').write_text('stand-in')
+    config = build_config(tmp_path, db_path, [Path('query.fna')], {'REFERENCESEEKER_BENCHMARK_MASH': str(mash_path)})
+
+    def run():
+        mash_hits = ((ref_genome_id, distance) for ref_genome_id, _, distance in mash.parse_mash_results(mash.stream_mash(config)))
+        screened_ref_genome_ids, mash_distances, no_screened = mash.select_best_hits(mash_hits, 100)
+        return [no_screened, screened_ref_genome_ids[:3]]
+    return run
+
+
+def bench_parse_mash_cohort(tmp_path, cohort_size, rng):
+    query_paths = ['query-%d.fna' % idx for idx in range(cohort_size)]
+    mash_path = tmp_path.joinpath('mash.out')
+    write_mash_output(mash_path, query_paths, COHORT_CANDIDATES, rng, related=True)
+    db_path = tmp_path.joinpath('db')
+    db_path.mkdir()
+    db_path.joinpath('db.msh').write_text('stand-in')
+    config = build_config(tmp_path, db_path, [Path(k) for k in query_paths], {'REFERENCESEEKER_BENCHMARK_MASH': str(mash_path)})
+
+    def run():
+        mash_results, filtered_ids, mash_distances_list = mash.parse_mash_cohort(config)
+        return [len(filtered_ids), sorted(filtered_ids)[:3]]
+    return run
+
+
+def bench_parse_delta(tmp_path, genome_size, rng):
+    no_fragments = genome_size // rc.FRAGMENT_SIZE
+    delta_path = tmp_path.joinpath('nucmer.delta')
+    write_delta(delta_path, no_fragments, rng)
+    dna_fragments = np.full(no_fragments, rc.FRAGMENT_SIZE, dtype=np.int32)
+    config = build_config(tmp_path, None, [], {'REFERENCESEEKER_BENCHMARK_DELTA': str(delta_path)})
+
+    def run():
+        alignment_lengths, non_identities = ani.execute_nucmer(config, tmp_path, dna_fragments, tmp_path.joinpath('query.fasta'), tmp_path.joinpath('reference.fna'))
+        return [int(alignment_lengths.sum()), int(non_identities.sum())]
+    return run
+
+
+def bench_score_alignments(tmp_path, genome_size, rng):
+    no_fragments = genome_size // rc.FRAGMENT_SIZE
+    np_rng = np.random.RandomState(rng.randint(0, 2 ** 31))
+    dna_fragments = np.full(no_fragments, rc.FRAGMENT_SIZE, dtype=np.int32)
+    alignment_lengths = np_rng.randint(0, rc.FRAGMENT_SIZE + 1, size=no_fragments).astype(np.int64)
+    non_identities = (alignment_lengths * np_rng.uniform(0.0, 0.2, size=no_fragments)).astype(np.int64)
+
+    def run():
+        return [
+            round(ani.calculate_ani(dna_fragments, alignment_lengths, non_identities), 9),
+            round(ani.calculate_conserved_dna(dna_fragments, alignment_lengths, non_identities), 9)
+        ]
+    return run
+
+
+def bench_calculate(tmp_path, cohort_size, rng):
+    ref_genome_ids = ['GCF_%09d.1' % idx for idx in range(COHORT_REFERENCES)]
+    query_genomes = ['query-%d' % idx for idx in range(cohort_size)]
+    cohort_results = []
+    for _ in query_genomes:
+        cohort_results.append({k: [(rng.uniform(0.95, 1.0), rng.uniform(0.69, 1.0)), (rng.uniform(0.95, 1.0), rng.uniform(0.69, 1.0))] for k in ref_genome_ids})
+    args = argparse.Namespace(bidirectional=True, algorithm='mean', scores=None)
+
+    def run():
+        ref_id_values = algorithms.calculate(args, {k: [1, 1, 1] for k in ref_genome_ids}, ref_genome_ids, cohort_results, query_genomes)
+        return [round(sum(value[2] for value in ref_id_values.values()), 9)]
+    return run
+
+
+def bench_startup(tmp_path, no_starts, rng):
+    env = build_config(tmp_path, None, [], {'REFERENCESEEKER_BENCHMARK_MASH': os.devnull, 'REFERENCESEEKER_BENCHMARK_DELTA': os.devnull})['env']
+    env['PYTHONPATH'] = str(BENCHMARKS_PATH.parent)
+    env['XDG_CACHE_HOME'] = str(tmp_path.joinpath('cache'))
+    cmd = [sys.executable, '-c', STARTUP_SCRIPT]  # imports, configuration and binary tests of each command line start
+    sp.run(cmd, env=env, check=True)  # measure starts with passed binary tests
+
+    def run():
+        return [sum(1 for _ in range(no_starts) if sp.run(cmd, env=env).returncode == 0)]  # successful starts
+    return run
+
+
+BENCHMARKS = [
+    ('build_dna_fragments', bench_build_dna_fragments),
+    ('parse_mash_results', bench_parse_mash_results),
+    ('parse_mash_cohort', bench_parse_mash_cohort),
+    ('parse_delta', bench_parse_delta),
+    ('score_alignments', bench_score_alignments),
+    ('calculate', bench_calculate),
+    ('startup', bench_startup)
+]
+
+
+def calibrate(repeat):
+    """Measure a fixed pure Python workload, so timings of machines or runs of different speed can be compared.
+
+    :rtype: The best wall time in seconds.
+    """
+
+    timings = []
+    for _ in range(max(repeat, 5)):
+        start = time.perf_counter()
+        counts = {}
+        for idx in range(200000):
+            key = '%d' % (idx % 1000)
+            counts[key] = counts.get(key, 0) + idx
+        sorted(counts.items(), key=lambda k: k[1])
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_benchmark(setup, size, repeat):
+    """Set up a benchmark in a temporary directory and measure the best of `repeat` runs.
+
+    :rtype: The best wall time in seconds and the result summary of the last run.
+    """
+
+    tmp_path = Path(tempfile.mkdtemp(prefix='referenceseeker-benchmark-'))
+    try:
+        run = setup(tmp_path, size, random.Random('%d-%d' % (SEED, size)))
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = run()
+            timings.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(str(tmp_path), ignore_errors=True)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run deterministic micro-benchmarks of ReferenceSeeker hot paths.')
+    parser.add_argument('--baseline', action='store', default=str(BENCHMARKS_PATH.joinpath('baseline.json')), help='Baseline JSON file (default = benchmarks/baseline.json)')
+    parser.add_argument('--record', action='store_true', help='Store results and timings as new baseline instead of comparing them')
+    parser.add_argument('--quick', action='store_true', help='Run the smallest size of each benchmark only')
+    parser.add_argument('--repeat', action='store', type=int, default=5, help='Number of timed runs per benchmark size (default = 5)')
+    parser.add_argument('--tolerance', action='store', type=float, default=2.0, help='Max slowdown factor compared to the calibrated baseline (default = 2.0)')
+    parser.add_argument('--min-time', action='store', dest='min_time', type=float, default=0.01, help='Timings below this number of seconds are not checked for slowdowns (default = 0.01)')
+    parser.add_argument('--benchmark', '-b', action='append', default=None, choices=[name for name, setup in BENCHMARKS], help='Run selected benchmarks only (default = all)')
+    args = parser.parse_args()
+
+    baseline_path = Path(args.baseline)
+    baseline = {}
+    if not args.record and baseline_path.is_file():
+        with baseline_path.open() as fh:
+            baseline = json.load(fh)
+
+    calibration = calibrate(args.repeat)
+    speed = calibration / baseline['calibration'] if 'calibration' in baseline else 1.0  # > 1 on slower machines or runs
+    measurements = {'calibration': calibration}
+    failures = []
+    print('#calibration: %.4f s (%.2fx baseline)' % (calibration, speed))
+    print('#benchmark\tsize\tseconds\tseconds/unit\tbaseline\tratio\tstatus')
+    for name, setup in BENCHMARKS:
+        if args.benchmark is not None and name not in args.benchmark:
+            continue
+        measurements[name] = {}
+        for size in SIZES[name][:1] if args.quick else SIZES[name]:
+            seconds, result = run_benchmark(setup, size, args.repeat)
+            measurements[name][str(size)] = {'seconds': seconds, 'result': result}
+            reference = baseline.get(name, {}).get(str(size))
+            status = 'ok'
+            if reference is None:
+                baseline_seconds, ratio, status = '-', '-', 'new'
+            else:
+                ratio = seconds / (reference['seconds'] * speed)  # slowdown compared to the calibrated baseline
+                baseline_seconds = '%.4f' % reference['seconds']
+                if reference['result'] != result:
+                    status = 'RESULT CHANGED'
+                    failures.append('%s (%d): result %s differs from baseline %s' % (name, size, result, reference['result']))
+                elif seconds > args.min_time and ratio > args.tolerance:
+                    status = 'SLOWER'
+                    failures.append('%s (%d): %.4f s exceeds calibrated baseline %.4f s by %.2fx' % (name, size, seconds, reference['seconds'] * speed, ratio))
+                ratio = '%.2f' % ratio
+            if name in TARGETS and seconds / size > TARGETS[name] * speed:
+                status = 'OVER TARGET'
+                failures.append('%s (%d): %.4f s per unit exceeds calibrated target %.4f s' % (name, size, seconds / size, TARGETS[name] * speed))
+            print('%s\t%d\t%.4f\t%.3e\t%s\t%s\t%s' % (name, size, seconds, seconds / size, baseline_seconds, ratio, status))
+            sys.stdout.flush()
+
+    if args.record:
+        with baseline_path.open('w') as fh:
+            json.dump(measurements, fh, indent=2, sort_keys=True)
+            fh.write('\n')
+        print('\nStored baseline: %s' % baseline_path)
+    elif len(failures) > 0:
+        print('\nRegressions:', file=sys.stderr)
+        for failure in failures:
+            print('\t%s' % failure, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
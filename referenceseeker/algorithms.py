@@ -1,150 +1,99 @@
 import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+
+def aggregate_product(scores):
+    """Multiply scores of all query genomes."""
+    return np.prod(scores, axis=1)
+
+
+def aggregate_mean(scores):
+    """Compute the arithmetic mean of scores of all query genomes."""
+    return np.mean(scores, axis=1)
+
+
+def aggregate_geometric(scores):
+    """Compute the geometric mean of scores of all query genomes via logarithms to avoid underflows of large cohorts."""
+    with np.errstate(divide='ignore'):  # zero scores result in zero means
+        return np.exp(np.mean(np.log(scores), axis=1))
+
+
+def aggregate_harmonic(scores):
+    """Compute the harmonic mean of scores of all query genomes."""
+    with np.errstate(divide='ignore'):  # zero scores result in zero means
+        return scores.shape[1] / np.sum(1 / scores, axis=1)
+
+
+# Aggregators reduce a (reference, query, metric) score array to a (reference, metric) array.
+# New aggregators are added here and become available as cohort --algorithm choices.
+AGGREGATORS = {
+    'product': aggregate_product,
+    'mean': aggregate_mean,
+    'geometric': aggregate_geometric,
+    'harmonic': aggregate_harmonic
+}
+
+
+def build_scores(args, common_references, cohort_results):
+    """Build a dense array of ANI, conDNA and ANIconDNA scores of each reference genome to each query genome.
+
+    :param args: the parsed command line arguments
+    :param common_references: A list of reference genome ids.
+    :param cohort_results: A list comprising a dict of lists of (ANI, conserved DNA) tuples per reference genome for each query genome.
+
+    :rtype: A np.ndarray of shape (references, queries, metrics) comprising ANI, conDNA and ANIconDNA scores.
+    """
+
+    directions = 2 if args.bidirectional else 1
+    results = np.array(
+        [[query_results[ref_id][:directions] for query_results in cohort_results] for ref_id in common_references],
+        dtype=np.float64
+    ).reshape(len(common_references), len(cohort_results), directions, 2)
+    scores = np.empty((len(common_references), len(cohort_results), 3), dtype=np.float64)
+    scores[:, :, 0:2] = np.mean(results, axis=2)  # average ANI and conDNA of both directions
+    scores[:, :, 2] = scores[:, :, 0] * scores[:, :, 1]
+    return scores
 
 
 def calculate(args, ref_id_values, common_references, cohort_results, query_genomes):
-    """Calculates common ANIs and conDNAs based on choosen algorithm."""
-    # Export the cohort results
-    with open("cohort_results.txt", "w+") as cohort_results_file:
+    """Calculates common ANIs and conDNAs based on choosen algorithm.
+
+    :param args: the parsed command line arguments
+    :param ref_id_values: A dict of score lists per reference genome id to store the final scores in.
+    :param common_references: A list of reference genome ids.
+    :param cohort_results: A list comprising a dict of lists of (ANI, conserved DNA) tuples per reference genome for each query genome.
+    :param query_genomes: A list of query genome names.
+
+    :rtype: A dict of final ANI, conDNA and ANIconDNA score lists per reference genome id.
+    """
+
+    if args.algorithm not in AGGREGATORS:
+        sys.exit("ERROR: unknown algorithm '%s'! Choose one of: %s" % (args.algorithm, ', '.join(sorted(AGGREGATORS))))
+    scores = build_scores(args, common_references, cohort_results)
+    final_scores = AGGREGATORS[args.algorithm](scores)
+    for ref_id, values in zip(common_references, final_scores.tolist()):
+        ref_id_values[ref_id] = values
+
+    if getattr(args, 'scores', None) is not None:
+        write_scores(Path(args.scores), common_references, cohort_results, query_genomes, scores, final_scores)
+    return ref_id_values
+
+
+def write_scores(scores_path, common_references, cohort_results, query_genomes, scores, final_scores):
+    """Export cohort results, raw scores of each reference genome to each query genome and final scores as JSON files."""
+    scores_path.mkdir(parents=True, exist_ok=True)
+    with scores_path.joinpath('cohort_results.txt').open('w') as cohort_results_file:
         cohort_results_file.write("#cohort results of the analysis\n")
         cohort_results_file.write(json.dumps(cohort_results, sort_keys=True, indent=4))
-    
-    # Calculate rawscores of each reference-genome to each query genome
-    raw_scores = {}
-    if args.bidirectional:
-        for ref_id in common_references:
-            dic = {}
-            for name in query_genomes:
-                for results in cohort_results:
-                    ani_score = (results[ref_id][0][0] + results[ref_id][1][0])/2  # Calculating bidirectional ANI
-                    condna_score = (results[ref_id][0][1] + results[ref_id][1][1])/2  # Calculating bidirectional conDNA
-                    anicondna_score = ani_score*condna_score
-                    dic[name] = (ani_score, condna_score, anicondna_score)
-            raw_scores[ref_id] = dic
-
-    else:
-        for ref_id in common_references:
-            dic = {}
-            for name in query_genomes:
-                for results in cohort_results:
-                    ani_score = results[ref_id][0][0] # Calculating bidirectional ANI
-                    condna_score = results[ref_id][0][1]  # Calculating bidirectional conDNA
-                    anicondna_score = ani_score * condna_score
-                    dic[name] = (ani_score, condna_score, anicondna_score)
-            raw_scores[ref_id] = dic
-
-    # Export the rawscores
-    with open("rawscores.txt", "w+") as rawscores_file:
+
+    raw_scores = {ref_id: dict(zip(query_genomes, ref_scores)) for ref_id, ref_scores in zip(common_references, scores.tolist())}
+    with scores_path.joinpath('rawscores.txt').open('w') as rawscores_file:
         rawscores_file.write("#rawscores of ANI, conDNA and ANIconDNA of each reference-genome to each query-genome\n")
         rawscores_file.write(json.dumps(raw_scores, sort_keys=True, indent=4))
 
-    # ANIconDNA calculation: Product
-    if args.algorithm == "product":
-        for ref_id_key, ref_id_dic in raw_scores.items():
-            ani_score_list = []
-            condna_score_list = []
-            anicondna_score_list = []
-            for key2, query in ref_id_dic.items():
-                ani_score_list.append(query[0])
-                condna_score_list.append(query[1])
-                anicondna_score_list.append(query[2])
-            ani = 1
-            condna = 1
-            anicondna = 1
-            for score in ani_score_list:
-                ani *= score
-            for score in condna_score_list:
-                condna *= score
-            for score in anicondna_score_list:
-                anicondna *= score
-
-            ref_id_values[ref_id_key][0] = ani
-            ref_id_values[ref_id_key][1] = condna
-            ref_id_values[ref_id_key][2] = anicondna
-
-    # ANIconDNA calculation: algorithmic mean
-    if args.algorithm == "mean":
-        for ref_id_key, ref_id_dic in raw_scores.items():
-            ani_score_list = []
-            condna_score_list = []
-            anicondna_score_list = []
-            for key2, query in ref_id_dic.items():
-                ani_score_list.append(query[0])
-                condna_score_list.append(query[1])
-                anicondna_score_list.append(query[2])
-            ani = 0
-            condna = 0
-            anicondna = 0
-            for score in ani_score_list:
-                ani += score
-            ani = ani / len(ani_score_list)
-            for score in condna_score_list:
-                condna += score
-            condna = condna / len(condna_score_list)
-            for score in anicondna_score_list:
-                anicondna += score
-            anicondna = anicondna / len(anicondna_score_list)
-
-            ref_id_values[ref_id_key][0] = ani
-            ref_id_values[ref_id_key][1] = condna
-            ref_id_values[ref_id_key][2] = anicondna
-
-    # ANIconDNA calculation: geometric mean
-    if args.algorithm == "geometric":
-        for ref_id_key, ref_id_dic in raw_scores.items():
-            ani_score_list = []
-            condna_score_list = []
-            anicondna_score_list = []
-            for key2, query in ref_id_dic.items():
-                ani_score_list.append(query[0])
-                condna_score_list.append(query[1])
-                anicondna_score_list.append(query[2])
-            ani = 1
-            condna = 1
-            anicondna = 1
-            for score in ani_score_list:
-                ani *= score
-            ani = ani**(1/len(ani_score_list))
-            for score in condna_score_list:
-                condna *= score
-            condna = condna**(1/len(condna_score_list))
-            for score in anicondna_score_list:
-                anicondna *= score
-            anicondna = anicondna**(1/len(anicondna_score_list))
-
-            ref_id_values[ref_id_key][0] = ani
-            ref_id_values[ref_id_key][1] = condna
-            ref_id_values[ref_id_key][2] = anicondna
-
-    # ANIconDNA calculation: harmonic mean
-    if args.algorithm == "harmonic":
-        for ref_id_key, ref_id_dic in raw_scores.items():
-            ani_score_list = []
-            condna_score_list = []
-            anicondna_score_list = []
-            for key2, query in ref_id_dic.items():
-                ani_score_list.append(query[0])
-                condna_score_list.append(query[1])
-                anicondna_score_list.append(query[2])
-            ani = 1
-            condna = 1
-            anicondna = 1
-            for score in ani_score_list:
-                ani += (1/score)
-            ani = len(ani_score_list)/ani
-            for score in condna_score_list:
-                condna += (1/score)
-            condna = len(condna_score_list)/condna
-            for score in anicondna_score_list:
-                anicondna += (1/score)
-            anicondna = len(anicondna_score_list)/anicondna
-
-            ref_id_values[ref_id_key][0] = ani
-            ref_id_values[ref_id_key][1] = condna
-            ref_id_values[ref_id_key][2] = anicondna
-
-    # Export final table
-    with open("final_scores.txt", "w+") as final_scores_file:
+    with scores_path.joinpath('final_scores.txt').open('w') as final_scores_file:
         final_scores_file.write("#final scores of ANI, conDNA and ANIconDNA of each reference-genome\n")
-        final_scores_file.write(json.dumps(raw_scores, sort_keys=True, indent=4))
-
-    return ref_id_values
+        final_scores_file.write(json.dumps(dict(zip(common_references, final_scores.tolist())), sort_keys=True, indent=4))
@@ -1,4 +1,5 @@
 
+import collections
 import shutil
 import sys
 import subprocess as sp
@@ -6,148 +7,323 @@ import tempfile
 
 from pathlib import Path
 
+import numpy as np
+
+import referenceseeker.index as index
+import referenceseeker.trace as trace
 import referenceseeker.util as util
 
 
-def align_query_genome(config, dna_fragments_path, dna_fragments, ref_genome_id):
-    """Perform per-genome calculation of ANI/conserved DNA values.
+def align_query_genome(config, dna_fragments_path, dna_fragments, ref_genome_id, threads=1):
+    """Perform per-genome alignments of query DNA fragments to a reference genome.
 
     :param dna_fragments_path:
     :param config: a global config object encapsulating global runtime vars
-    :param dna_fragments: A dict comprising information on fragments.
+    :param dna_fragments: An array of DNA fragment lengths.
     :param ref_genome_id: reference genome id.
+    :param threads: number of nucmer threads
 
-    :rtype: A dict representing a reference genome and additionally comprising ANI / conserved DNA values.
+    :rtype: reference genome id and arrays of alignment lengths and non-identities per query DNA fragment.
     """
 
     reference_genome_path = config['db_path'].joinpath("%s.fna" % ref_genome_id)
     tmp_dir = Path(tempfile.mkdtemp())
 
-    dna_fragment_matches = execute_nucmer(config, tmp_dir, dna_fragments, dna_fragments_path, reference_genome_path)
+    with index.use_index(config, ref_genome_id) as index_prefix:  # keeps the index until nucmer has exited
+        alignment_lengths, non_identities = execute_nucmer(config, tmp_dir, dna_fragments, dna_fragments_path, reference_genome_path, index_prefix, threads)
 
     shutil.rmtree(str(tmp_dir))
 
-    ani = calculate_ani(dna_fragment_matches)
-    conserved_dna = calculate_conserved_dna(dna_fragments, dna_fragment_matches)
-
-    return ref_genome_id, ani, conserved_dna
+    return ref_genome_id, alignment_lengths, non_identities
 
 
-def align_reference_genome(config, query_genome_path, ref_genome_id):
-    """Perform per-genome calculation of ANI/conserved DNA values.
+def align_reference_genome(config, query_genome_path, ref_genome_id, threads=1):
+    """Perform per-genome alignments of reference DNA fragments to a query genome.
 
     :param config: a global config object encapsulating global runtime vars
     :param query_genome_path: Path to query genome Fasta file.
     :param ref_genome_id: reference genome id.
+    :param threads: number of nucmer threads
 
-    :rtype: A dict representing a reference genome and additionally comprising ANI / conserved DNA values.
+    :rtype: reference genome id, reference DNA fragment lengths and arrays of alignment lengths and non-identities per reference DNA fragment.
     """
 
-    reference_genome_path = config['db_path'].joinpath("%s.fna" % ref_genome_id)
     tmp_dir = Path(tempfile.mkdtemp())
 
-    dna_fragments_path = tmp_dir.joinpath('dna-fragments.fasta')
-    dna_fragments = util.build_dna_fragments(reference_genome_path, dna_fragments_path)
+    # use DNA fragments stored at import time and build them on the fly for older databases
+    stored_dna_fragments = util.read_dna_fragments(config['db_path'], ref_genome_id)
+    if stored_dna_fragments is not None:
+        dna_fragments_path, dna_fragments = stored_dna_fragments
+    else:
+        reference_genome_path = config['db_path'].joinpath("%s.fna" % ref_genome_id)
+        dna_fragments_path = tmp_dir.joinpath('dna-fragments.fasta')
+        dna_fragments = util.build_dna_fragments(reference_genome_path, dna_fragments_path)
 
     # perform global alignments via nucmer
-    dna_fragment_matches = execute_nucmer(config, tmp_dir, dna_fragments, dna_fragments_path, query_genome_path)
+    alignment_lengths, non_identities = execute_nucmer(config, tmp_dir, dna_fragments, dna_fragments_path, query_genome_path, threads=threads)
 
     shutil.rmtree(str(tmp_dir))
 
-    ani = calculate_ani(dna_fragment_matches)
-    conserved_dna = calculate_conserved_dna(dna_fragments, dna_fragment_matches)
+    return ref_genome_id, dna_fragments, alignment_lengths, non_identities
+
 
-    return ref_genome_id, ani, conserved_dna
+def execute_nucmer(config, tmp_dir, dna_fragments, query_path, reference_genome_path, index_prefix=None, threads=1):
+    """Align DNA fragments to a genome via nucmer.
 
+    Alignment results are stored in new per-call arrays, so concurrent alignments of the same
+    DNA fragments do not interfere with each other.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param tmp_dir: Path to a temporary working directory.
+    :param dna_fragments: An array of DNA fragment lengths.
+    :param query_path: Path to DNA fragments Fasta file.
+    :param reference_genome_path: Path to genome Fasta file.
+    :param index_prefix: Path prefix of a prebuilt nucmer index of the genome (optional).
+    :param threads: number of nucmer threads
+
+    :rtype: Two arrays of alignment lengths and numbers of non-identities per DNA fragment.
+    """
 
-def execute_nucmer(config, tmp_dir, dna_fragments, query_path, reference_genome_path):
     cmd = [
         'nucmer',
-        '--threads=1',
+        '--threads=%d' % threads,
+        '--delta=/dev/stdout',
         str(reference_genome_path),
         str(query_path)
     ]
-    proc = sp.run(
+    if index_prefix is not None:
+        cmd.insert(1, '--load=%s' % index_prefix)
+    proc = trace.popen(
+        config,
         cmd,
         cwd=str(tmp_dir),
         env=config['env'],
-        stdout=sp.DEVNULL,
-        stderr=sp.STDOUT,
+        stdout=sp.PIPE,
+        stderr=sp.DEVNULL,
         universal_newlines=True
     )
-    if proc.returncode != 0:
+    # stream nucmer alignments and keep the best consistent alignments per DNA fragment (delta-filter -q)
+    alignments = list(parse_delta(proc.stdout))
+    proc.stdout.close()
+    if trace.wait(config, proc) != 0:
+        if index_prefix is not None:  # index not loadable, e.g. removed or corrupted, align without it
+            return execute_nucmer(config, tmp_dir, dna_fragments, query_path, reference_genome_path, threads=threads)
         sys.exit("ERROR: failed to execute nucmer!\nexit=%d\ncmd=%s" % (proc.returncode, cmd))
+    with trace.stage(config, 'delta-filter', alignments=len(alignments)):
+        alignments = filter_query_alignments(alignments)
+
+    alignment_lengths = np.zeros(len(dna_fragments), dtype=np.int64)
+    non_identities = np.zeros(len(dna_fragments), dtype=np.int64)
+    for query, query_start, query_end, errors, length, reference_start, reference_end in alignments:
+        dna_fragment_idx = int(query) - 1
+        if 0 <= dna_fragment_idx < len(dna_fragments):
+            alignment_lengths[dna_fragment_idx] = abs(query_end - query_start) + 1  # abs( qStop - qStart ) + 1
+            non_identities[dna_fragment_idx] = errors  # number of non-identities
 
-    filtered_delta_path = tmp_dir.joinpath('out-filtered.delta')
-    with filtered_delta_path.open(mode='w') as fh:
-        cmd = [
-            'delta-filter',
-            '-q',
-            'out.delta'
-        ]
-        proc = sp.run(
-            cmd,
-            cwd=str(tmp_dir),
-            env=config['env'],
-            stdout=fh,
-            stderr=sp.STDOUT
-        )
-        if proc.returncode != 0:
-            sys.exit("ERROR: failed to execute delta-filter!\nexit=%d\ncmd=%s" % (proc.returncode, cmd))
-
-    # parse nucmer output
-    dna_fragment = None
-    dna_fragment_matches = []
-    with filtered_delta_path.open() as fh:
-        for line in fh:
-            line = line.rstrip()
-            if line[0] == '>':
-                dna_fragment = dna_fragments.get(int(line.split(' ')[1]), None)
-            elif dna_fragment is not None:
-                cols = line.split(' ')
-                if len(cols) == 7:
-                    dna_fragment['alignment_length'] = abs(int(cols[3]) - int(cols[2])) + 1  # abs( qStop - qStart ) + 1
-                    dna_fragment['no_non_identities'] = int(cols[4])  # number of non-identities
-                    dna_fragment_matches.append(dna_fragment)
-
-    return dna_fragment_matches
-
-
-def calculate_conserved_dna(dna_fragments, dna_fragment_matches):
+    return alignment_lengths, non_identities
+
+
+def parse_delta(lines):
+    """Parse alignments from nucmer delta formatted lines.
+
+    :param lines: An iterable of delta formatted lines, e.g. a file object or a process pipe.
+
+    :rtype: A generator of (query, query start, query end, non-identities, alignment length, reference start, reference end)
+        tuples in delta order.
+    """
+
+    query = None
+    alignment = None
+    for line in lines:
+        cols = line.split()
+        if len(cols) == 0:
+            continue
+        elif cols[0][0] == '>':
+            query = cols[1]
+        elif query is None:  # file header
+            continue
+        elif len(cols) == 7:
+            reference_start, reference_end, query_start, query_end, errors = [int(col) for col in cols[:5]]
+            alignment = [query, query_start, query_end, errors, abs(reference_end - reference_start) + 1, reference_start, reference_end]
+        elif alignment is not None:
+            indel = int(cols[0])
+            if indel < 0:  # insertions into the reference extend the alignment
+                alignment[4] += 1
+            elif indel == 0:
+                yield tuple(alignment)
+                alignment = None
+
+
+def filter_query_alignments(alignments):
+    """Keep the best consistent set of alignments of each query sequence just like 'delta-filter -q' does.
+
+    Alignments of each query are chained via a weighted LIS on query coordinates scored by length * identity^2
+    while allowing for overlaps not exceeding the lengths of chained alignments. Scores are computed like MUMmer
+    does, i.e. single precision identities and truncated double precision scores. Equally scored chains are
+    resolved by the smallest sum of query and reference gaps and then by MUMmer's pseudo random pick.
+
+    :param alignments: An iterable of alignments as returned by parse_delta().
+
+    :rtype: A list of retained alignments in input order.
+    """
+
+    alignments = list(alignments)
+    if len(alignments) == 0:
+        return []
+    lengths = np.array([alignment[4] for alignment in alignments], dtype=np.float32)
+    errors = np.array([alignment[3] for alignment in alignments], dtype=np.float32)
+    identities = ((lengths - errors) / lengths * np.float32(100.0)) / np.float32(100.0)  # single precision
+    query_alignments = {}
+    for idx, (query, query_start, query_end, errors, length, reference_start, reference_end) in enumerate(alignments):
+        squared_identity = float(identities[idx]) * float(identities[idx])
+        low, high = min(query_start, query_end), max(query_start, query_end)
+        score = int((high - low + 1) * squared_identity)
+        lis_item = (low, -score, high, min(reference_start, reference_end), max(reference_start, reference_end), squared_identity, idx)
+        query_alignments.setdefault(query, []).append(lis_item)
+
+    retained = []
+    rand = _c_rand()  # delta-filter seeds rand() once and draws a number per query sequence in query name order
+    for query in sorted(query_alignments):
+        lis = sorted(query_alignments[query], key=lambda lis_item: lis_item[:2])
+        chains, previous, diffs = _chain_alignments(lis)
+        equal = 1
+        while equal < len(chains) and diffs[chains[equal]] == diffs[chains[0]]:
+            equal += 1
+        best = chains[int(equal * next(rand) * 2.0 ** -31)]
+        while best != -1:
+            retained.append(lis[best][6])
+            best = previous[best]
+
+    return [alignments[idx] for idx in sorted(retained)]
+
+
+def _chain_alignments(lis):
+    """Find all best scoring chains of alignments sorted by query start coordinates (delta-filter's flagQLIS()).
+
+    :rtype: A list of the last alignment indices of all best chains, chain predecessors and sums of gaps per alignment.
+    """
+
+    n = len(lis)
+    used = [False] * n
+    scores = [0] * n
+    diffs = [0] * n
+    previous = [-1] * n
+    chains = []
+    while True:
+        for i, (low, score, high, reference_low, reference_high, squared_identity, idx) in enumerate(lis):
+            if used[i]:
+                continue
+            length = high - low + 1
+            scores[i], diffs[i], previous[i] = -score, 0, -1
+            for j in range(i):
+                if used[j] or (previous[j] != -1 and lis[previous[j]][2] >= low):
+                    continue
+                j_low, j_score, j_high, j_reference_low, j_reference_high = lis[j][:5]
+                overlap = max(j_high - low + 1, 0)
+                query_gap = abs(j_high - low) if j_low < low else abs(high - j_low)
+                reference_gap = abs(j_reference_high - reference_low) if j_reference_low < reference_low else abs(reference_high - j_reference_low)
+                diff = diffs[j] + query_gap + reference_gap
+                if overlap > length or overlap > j_high - j_low + 1:
+                    chain_score = -1
+                else:
+                    chain_score = scores[j] + int((length - overlap) * squared_identity)
+                if chain_score > scores[i] or (chain_score == scores[i] and diff < diffs[i]):
+                    scores[i], diffs[i], previous[i] = chain_score, diff, j
+
+        # pick the best unused chain, the one with the smallest sum of gaps among equally scored chains
+        best = n
+        for i in range(n):
+            if not used[i] and (best == n or scores[i] > scores[best] or (scores[i] == scores[best] and diffs[i] < diffs[best])):
+                best = i
+        if best == n or (len(chains) > 0 and scores[best] < scores[chains[0]]):
+            return chains, previous, diffs
+        chains.append(best)
+        while best != -1:
+            used[best] = True
+            best = previous[best]
+
+
+def _c_rand(seed=1):
+    """Generate the pseudo random numbers of glibc's rand() after srand(seed)."""
+    state = [seed]
+    for i in range(1, 31):
+        state.append(16807 * state[-1] % 2147483647)
+    state.extend(state[:3])
+    state = collections.deque(state, maxlen=34)
+    for i in range(310):  # the first 310 numbers are discarded
+        state.append((state[-31] + state[-3]) & 0xffffffff)
+    while True:
+        state.append((state[-31] + state[-3]) & 0xffffffff)
+        yield state[-1] >> 1
+
+
+def score_alignments(dna_fragments, alignment_lengths, non_identities):
+    """Calculate ANI and conserved DNA values for many genomes in a single vectorized pass.
+
+    :param dna_fragments: A 1-D array of DNA fragment lengths shared by all genomes or a 2-D
+        genome x fragment array of zero padded DNA fragment lengths.
+    :param alignment_lengths: A 2-D genome x fragment array of alignment lengths (0 = no match).
+    :param non_identities: A 2-D genome x fragment array of numbers of non-identities.
+
+    :rtype: Two arrays of ANI and conserved DNA values per genome.
+    """
+
+    alignment_lengths = np.atleast_2d(alignment_lengths)
+    non_identities = np.atleast_2d(non_identities)
+    dna_fragments = np.broadcast_to(dna_fragments, alignment_lengths.shape)
+    matched = (alignment_lengths > 0) & (dna_fragments > 0)
+    identities = alignment_lengths - non_identities
+    zeros = np.zeros(alignment_lengths.shape)
+    rel_identities = np.divide(identities, dna_fragments, out=zeros.copy(), where=matched)
+    rel_alignment_lengths = np.divide(alignment_lengths, dna_fragments, out=zeros.copy(), where=matched)
+
+    # ANI: mean identity of fragments with an identity > 0.3 and a coverage >= 0.7
+    ani_matches = matched & (rel_identities > 0.3) & (rel_alignment_lengths >= 0.7)
+    ani_sums = np.sum(np.divide(identities, alignment_lengths, out=zeros.copy(), where=ani_matches), axis=1)
+    ani_counts = np.count_nonzero(ani_matches, axis=1)
+    anis = np.divide(ani_sums, ani_counts, out=np.zeros(len(ani_counts)), where=ani_counts > 0)
+
+    # conserved DNA: aligned fraction of fragments with more than 90 % identically aligned bases
+    conserved_matches = matched & (rel_identities > 0.9)
+    alignment_sums = np.sum(np.where(conserved_matches, alignment_lengths, 0), axis=1)
+    genome_lengths = np.sum(dna_fragments, axis=1)
+    conserved_dnas = np.divide(alignment_sums, genome_lengths, out=np.zeros(len(genome_lengths)), where=genome_lengths > 0)
+
+    return anis, conserved_dnas
+
+
+def stack_fragment_arrays(arrays):
+    """Stack 1-D per genome arrays of different lengths into a zero padded 2-D array."""
+    width = max((len(array) for array in arrays), default=0)
+    stacked = np.zeros((len(arrays), width), dtype=np.int64)
+    for idx, array in enumerate(arrays):
+        stacked[idx, :len(array)] = array
+    return stacked
+
+
+def calculate_conserved_dna(dna_fragments, alignment_lengths, non_identities):
     """Calculate conserved DNA value for a set of DNA fragment matches.
 
-    :param dna_fragments: A dict comprising information on DNA fragments.
-    :param dna_fragment_matches: A dict comprising matches of DNA fragments.
+    :param dna_fragments: An array of DNA fragment lengths.
+    :param alignment_lengths: An array of alignment lengths per DNA fragment (0 = no match).
+    :param non_identities: An array of numbers of non-identities per DNA fragment.
 
     :rtype: conserved DNA value.
     """
 
-    alignment_sum = 0
-    for fm in dna_fragment_matches:
-        rel_alignment_length = float(fm['alignment_length'] - fm['no_non_identities']) / float(fm['length'])
-        if rel_alignment_length > 0.9:
-            alignment_sum += fm['alignment_length']
-    genome_length = 0
-    for fm in dna_fragments.values():
-        genome_length += fm['length']
-
-    return (float(alignment_sum) / float(genome_length)) if genome_length > 0 else 0
+    anis, conserved_dnas = score_alignments(dna_fragments, alignment_lengths, non_identities)
+    return float(conserved_dnas[0])
 
 
-def calculate_ani(dna_fragment_matches):
+def calculate_ani(dna_fragments, alignment_lengths, non_identities):
     """Calculate ANI value for a set of DNA fragment matches.
 
-    :param dna_fragment_matches: A dict comprising matches of DNA fragments.
+    :param dna_fragments: An array of DNA fragment lengths.
+    :param alignment_lengths: An array of alignment lengths per DNA fragment (0 = no match).
+    :param non_identities: An array of numbers of non-identities per DNA fragment.
 
     :rtype: ANI value.
     """
 
-    ani_matches = 0
-    ni_sum = 0.0
-    for fm in dna_fragment_matches:
-        if(((float(fm['alignment_length'] - fm['no_non_identities']) / float(fm['length'])) > 0.3)
-                and ((float(fm['alignment_length']) / float(fm['length'])) >= 0.7)):
-            ni_sum += float(fm['alignment_length'] - fm['no_non_identities']) / float(fm['alignment_length'])
-            ani_matches += 1
-
-    return (ni_sum / float(ani_matches)) if ani_matches > 0 else 0
+    anis, conserved_dnas = score_alignments(dna_fragments, alignment_lengths, non_identities)
+    return float(anis[0])
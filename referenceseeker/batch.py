@@ -0,0 +1,98 @@
+import shutil
+import sys
+from pathlib import Path
+
+import referenceseeker.constants as rc
+import referenceseeker.mash as mash
+import referenceseeker.scheduler as scheduler
+import referenceseeker.single as single
+import referenceseeker.trace as trace
+import referenceseeker.util as util
+
+
+def batch(args, config):
+    """Allows analysis of many independent query genomes within a single run."""
+    genome_paths = read_genome_paths(args.genomes)
+    if len(genome_paths) == 0:
+        sys.exit('ERROR: no genome files found in %s!' % args.genomes)
+    query_names = [genome_path.name.split('.', 1)[0] for genome_path in genome_paths]
+    if len(set(query_names)) != len(query_names):
+        sys.exit('ERROR: genome file names must be unique!')
+    config['genome_path'] = genome_paths
+
+    output_path = Path(args.output).resolve()
+    try:
+        output_path.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        sys.exit('ERROR: could not create output directory %s!' % output_path)
+
+    # mash out best hits of all query genomes at once
+    with trace.stage(config, 'mash'):
+        mash_results = mash.run_mash_batch(args, config)
+
+    # get genomes from RefSeq by accessions
+    ref_genomes = util.read_reference_genomes(config, set(k for screened_ref_genome_ids, mash_distances in mash_results for k in screened_ref_genome_ids))
+
+    if args.verbose:
+        print('\nCompute ANIs...')
+    screened_ref_genome_ids_list = []
+    for screened_ref_genome_ids, mash_distances in mash_results:
+        screened_ref_genome_ids = set(screened_ref_genome_ids)
+        screened_ref_genome_ids_list.append([k for k in ref_genomes.keys() if k in screened_ref_genome_ids])
+    with util.thread_pool(config) as tpe, trace.stage(config, 'align', queries=len(genome_paths)):
+        batch_results = scheduler.align_genomes(args, config, tpe, genome_paths, screened_ref_genome_ids_list, [mash_distances for screened_ref_genome_ids, mash_distances in mash_results])
+        if config.get('expand'):
+            member_ids = single.expand_duplicates(args, config, tpe, genome_paths, batch_results, [mash_distances for screened_ref_genome_ids, mash_distances in mash_results])
+            ref_genomes.update(util.read_reference_genomes(config, member_ids))
+
+    # write one result table per query genome
+    for genome_path, query_name, (screened_ref_genome_ids, mash_distances), results in zip(genome_paths, query_names, mash_results, batch_results):
+        scheduler.log_decisions(args, config, genome_path, results, mash_distances)
+        with output_path.joinpath('%s.tsv' % query_name).open(mode='w') as fh:
+            single.print_results(args, config, results, mash_distances, ref_genomes, fh)
+        if args.verbose:
+            print("\t%s: %d candidate reference genome(s) aligned" % (query_name, len(results)))
+
+    # remove tmp dir
+    shutil.rmtree(str(config['tmp']))
+
+
+def read_genome_paths(path):
+    """Read query genome paths either from a directory or from a manifest file listing one genome path per line.
+
+    :param path: Path to a directory comprising Fasta files or to a manifest file.
+
+    :rtype: A list of resolved genome paths.
+    """
+
+    try:
+        path = util.check_path(path)
+    except FileNotFoundError:
+        sys.exit('ERROR: genome directory/manifest %s is not readable!' % path)
+    except PermissionError:
+        sys.exit('ERROR (permission): genome directory/manifest %s is not accessible' % path)
+    except OSError:
+        sys.exit('ERROR: genome manifest %s is empty!' % path)
+
+    if path.is_dir():
+        genome_paths = sorted(p for p in path.iterdir() if p.suffix.lower() in rc.FASTA_SUFFIXES)
+    else:
+        genome_paths = []
+        with path.open() as fh:
+            for line in fh:
+                line = line.strip()
+                if line != '' and line[0] != '#':
+                    genome_path = Path(line)
+                    genome_paths.append(genome_path if genome_path.is_absolute() else path.parent.joinpath(genome_path))
+
+    checked_genome_paths = []
+    for genome_path in genome_paths:
+        try:
+            checked_genome_paths.append(util.check_path(genome_path))
+        except FileNotFoundError:
+            sys.exit('ERROR: genome file %s is not readable!' % genome_path)
+        except PermissionError:
+            sys.exit('ERROR (permission): genome file %s is not accessible' % genome_path)
+        except OSError:
+            sys.exit('ERROR: genome file %s is empty!' % genome_path)
+    return checked_genome_paths
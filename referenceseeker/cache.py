@@ -0,0 +1,105 @@
+import hashlib
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import referenceseeker.constants as rc
+
+
+FORWARD = 0  # query fragments -> reference genome
+REVERSE = 1  # reference fragments -> query genome
+
+
+def query_key(config, genome_path):
+    """Compute the content hash of a query genome or None if the result cache is disabled."""
+    if config.get('cache_dir') is None:
+        return None
+    sha256 = hashlib.sha256()
+    with open(str(genome_path), 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def reference_key(config, ref_genome_id):
+    """Build a reference genome key comprising its id and a signature of its database genome file."""
+    stat = config['db_path'].joinpath("%s.fna" % ref_genome_id).stat()
+    return "%s:%d:%d" % (ref_genome_id, stat.st_size, stat.st_mtime_ns)
+
+
+def lookup(config, query, ref_genome_ids, direction):
+    """Look up cached ANI/conserved DNA results of a query genome.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param query: query genome content hash as returned by query_key().
+    :param ref_genome_ids: A list of reference genome ids.
+    :param direction: alignment direction (FORWARD or REVERSE).
+
+    :rtype: A dict of (ANI, conserved DNA) tuples per cached reference genome id.
+    """
+
+    if query is None or len(ref_genome_ids) == 0:
+        return {}
+    results = {}
+    now = time.time()
+    with _connect(config) as conn:
+        for ref_genome_id in ref_genome_ids:
+            key = (query, reference_key(config, ref_genome_id), direction, rc.FRAGMENT_SIZE, rc.MIN_FRAGMENT_SIZE)
+            row = conn.execute(
+                'SELECT ani, conserved_dna FROM results WHERE query=? AND reference=? AND direction=? AND fragment_size=? AND min_fragment_size=?',
+                key
+            ).fetchone()
+            if row is not None:
+                results[ref_genome_id] = (row[0], row[1])
+                conn.execute(
+                    'UPDATE results SET last_used=? WHERE query=? AND reference=? AND direction=? AND fragment_size=? AND min_fragment_size=?',
+                    (now,) + key
+                )
+    return results
+
+
+def store(config, query, results, direction):
+    """Store ANI/conserved DNA results of a query genome and evict least recently used results exceeding the cache size.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param query: query genome content hash as returned by query_key().
+    :param results: A dict of (ANI, conserved DNA) tuples per reference genome id.
+    :param direction: alignment direction (FORWARD or REVERSE).
+    """
+
+    if query is None or len(results) == 0:
+        return
+    now = time.time()
+    with _connect(config) as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(query, reference_key(config, k), direction, rc.FRAGMENT_SIZE, rc.MIN_FRAGMENT_SIZE, ani, conserved_dna, now) for k, (ani, conserved_dna) in results.items()]
+        )
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        used_pages = conn.execute('PRAGMA page_count').fetchone()[0] - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        cache_size = page_size * used_pages
+        if cache_size > config['cache_size']:
+            no_results = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            no_evicted = no_results - int(no_results * config['cache_size'] / cache_size)
+            conn.execute(
+                'DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY last_used LIMIT ?)',
+                (no_evicted,)
+            )
+
+
+@contextmanager
+def _connect(config):
+    """Open the cache database and run all statements within a single transaction."""
+    config['cache_dir'].mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(config['cache_dir'].joinpath(rc.CACHE_FILE)), timeout=60)
+    try:
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'query TEXT, reference TEXT, direction INTEGER, fragment_size INTEGER, min_fragment_size INTEGER, '
+                'ani REAL, conserved_dna REAL, last_used REAL, '
+                'PRIMARY KEY (query, reference, direction, fragment_size, min_fragment_size))'
+            )
+            yield conn
+    finally:
+        conn.close()
@@ -0,0 +1,247 @@
+import concurrent.futures as cf
+import os
+import shutil
+import subprocess as sp
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+import referenceseeker.constants as rc
+import referenceseeker.shards as shards
+import referenceseeker.sketch as sketch
+
+
+CLUSTER_BLOCK_SIZE = 64  # number of genomes compared to known representatives at once
+
+
+def build(config, db_path, max_distance):
+    """Cluster database genomes by Mash distance and store a representative sketch and member sketches per cluster.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param db_path: Path to the database directory.
+    :param max_distance: Max Mash distance of cluster members to their representative.
+
+    :rtype: The number of clustered genomes and the number of clusters.
+    """
+
+    if not db_path.joinpath(rc.SHARDS_MANIFEST).is_file():
+        shards.write_manifest(db_path, shards.read_manifest(db_path))
+    shard_paths = shards.get_shards(db_path)
+    shard_sketches = [sketch.read_sketches(shard_path) for shard_path in shard_paths]
+    if len(shard_sketches) == 0:
+        raise Exception("Database comprises no genomes")
+    sketch_params = check_sketch_params(shard_paths, shard_sketches)
+    no_genomes = sum(len(sketches['ids']) for sketches in shard_sketches)
+    clusters = cluster_sketches(shard_sketches, max_distance, config.get('threads', 1))
+    representatives = {'ids': [members[0][0] for members in clusters]}
+
+    # sketch representatives and cluster members in a temporary directory replacing former clusters at once
+    tmp_path = Path(tempfile.mkdtemp(dir=str(db_path), prefix='.tmp-'))
+    try:
+        sketch_genomes(config, db_path, tmp_path, rc.REPRESENTATIVES_FILE, representatives['ids'], sketch_params)
+        with tmp_path.joinpath(rc.CLUSTERS_FILE).open('w') as fh:
+            for cluster_idx, members in enumerate(clusters):
+                cluster_file = 'cluster-%05d.msh' % (cluster_idx + 1)
+                sketch_genomes(config, db_path, tmp_path, cluster_file, [member_id for member_id, distance in members], sketch_params)
+                radius = max(distance for member_id, distance in members)
+                fh.write("%s\t%s\t%f\t%i\n" % (cluster_file, members[0][0], radius, len(members)))
+        shutil.copyfile(str(db_path.joinpath(rc.SHARDS_MANIFEST)), str(tmp_path.joinpath(rc.SHARDS_MANIFEST)))  # marks the clustered database state
+        os.chmod(str(tmp_path), 0o770)
+        clusters_path = db_path.joinpath(rc.CLUSTERS_DIR)
+        if clusters_path.exists():
+            os.rename(str(clusters_path), str(tmp_path.joinpath('.former')))
+        os.rename(str(tmp_path), str(clusters_path))
+        shutil.rmtree(str(clusters_path.joinpath('.former')), ignore_errors=True)
+    finally:
+        shutil.rmtree(str(tmp_path), ignore_errors=True)
+    return no_genomes, len(clusters)
+
+
+def check_sketch_params(shard_paths, shard_sketches):
+    """Check that all database shards have been sketched with the same k-mer size, sketch size and hash seed.
+
+    :rtype: The (k-mer size, sketch size, hash seed) tuple of all shards.
+    """
+    sketch_params = (shard_sketches[0]['kmer'], shard_sketches[0]['size'], shard_sketches[0]['seed'])
+    for shard_path, sketches in zip(shard_paths, shard_sketches):
+        if (sketches['kmer'], sketches['size'], sketches['seed']) != sketch_params:
+            raise Exception(
+                "Sketch parameters of shard %s (k=%i, s=%i, S=%i) differ from those of shard %s (k=%i, s=%i, S=%i)! Re-sketch or compact the database first."
+                % ((shard_path, sketches['kmer'], sketches['size'], sketches['seed'], shard_paths[0]) + sketch_params)
+            )
+    return sketch_params
+
+
+def cluster_sketches(shard_sketches, max_distance, threads=1):
+    """Cluster genome sketches greedily in database order.
+
+    Each genome joins the cluster of its nearest representative within max_distance
+    or becomes the representative of a new cluster otherwise. Genomes are compared in blocks
+    to all representatives known before their block concurrently and to representatives
+    of their own block one after another.
+
+    :param shard_sketches: A list of database shard sketches as returned by sketch.read_sketches().
+    :param max_distance: Max Mash distance of cluster members to their representative.
+    :param threads: number of threads comparing genomes of a block.
+
+    :rtype: A list of clusters comprising (genome id, distance to representative) tuples, representatives first.
+    """
+
+    no_genomes = sum(len(sketches['ids']) for sketches in shard_sketches)
+    width = max(sketches['hashes'].shape[1] for sketches in shard_sketches)
+    representatives = {
+        'kmer': shard_sketches[0]['kmer'],
+        'size': shard_sketches[0]['size'],
+        'counts': np.zeros(no_genomes, dtype=np.int64),
+        'hashes': np.full((no_genomes, width), np.iinfo(np.uint64).max, dtype=np.uint64)
+    }
+    clusters = []
+    with cf.ThreadPoolExecutor(max_workers=max(threads, 1)) as tpe:
+        for sketches in shard_sketches:
+            genome_hashes = [sketches['hashes'][idx, :count] for idx, count in enumerate(sketches['counts'])]
+            for start in range(0, len(genome_hashes), CLUSTER_BLOCK_SIZE):
+                block_hashes = genome_hashes[start:start + CLUSTER_BLOCK_SIZE]
+                no_known = len(clusters)
+                known_representatives = _select_representatives(representatives, 0, no_known)
+                block_hits = tpe.map(lambda hashes: sketch.compute_distances(known_representatives, hashes, max_distance), block_hashes)
+                for genome_id, hashes, hits in zip(sketches['ids'][start:start + CLUSTER_BLOCK_SIZE], block_hashes, block_hits):
+                    if len(clusters) > no_known:  # representatives of the current block
+                        block_representatives = _select_representatives(representatives, no_known, len(clusters))
+                        hits = hits + sketch.compute_distances(block_representatives, hashes, max_distance)
+                    if len(hits) > 0:
+                        cluster_idx, distance = min(hits, key=lambda hit: hit[1])
+                        clusters[cluster_idx].append((genome_id, distance))
+                    else:
+                        representatives['counts'][len(clusters)] = len(hashes)
+                        representatives['hashes'][len(clusters), :len(hashes)] = hashes
+                        clusters.append([(genome_id, 0.0)])
+    return clusters
+
+
+def _select_representatives(representatives, start, end):
+    """Select a range of representatives as database sketches identified by their cluster indices."""
+    return {
+        'kmer': representatives['kmer'],
+        'size': representatives['size'],
+        'ids': range(start, end),
+        'counts': representatives['counts'][start:end],
+        'hashes': representatives['hashes'][start:end]
+    }
+
+
+def sketch_genomes(config, db_path, tmp_path, sketch_file, genome_ids, sketch_params):
+    """Sketch database genomes into a single sketch file named by their genome ids."""
+    genomes_path = Path(tempfile.mkdtemp(dir=str(tmp_path), prefix='.genomes-'))
+    try:
+        # link genome files to have Mash use the right ID in its internal db
+        for genome_id in genome_ids:
+            genomes_path.joinpath(genome_id).symlink_to(db_path.joinpath("%s.fna" % genome_id))
+        genome_list_path = genomes_path.joinpath('.genomes.txt')
+        with genome_list_path.open('w') as fh:
+            fh.write(''.join("%s\n" % genome_id for genome_id in genome_ids))
+        kmer_size, sketch_size, hash_seed = sketch_params
+        cmd = [
+            'mash',
+            'sketch',
+            '-o', str(tmp_path.joinpath(sketch_file)),
+            '-k', str(kmer_size),
+            '-s', str(sketch_size),
+            '-S', str(hash_seed),
+            '-p', str(config.get('threads', 1)),
+            '-l', str(genome_list_path)
+        ]
+        proc = sp.run(
+            cmd,
+            cwd=str(genomes_path),
+            env=config['env'],
+            stdout=sp.PIPE,
+            stderr=sp.PIPE,
+            universal_newlines=True
+        )
+        if proc.returncode != 0:
+            raise Exception("failed to create cluster kmer sketches via Mash! exit=%d, cmd=%s" % (proc.returncode, cmd))
+    finally:
+        shutil.rmtree(str(genomes_path), ignore_errors=True)
+
+
+def load(config):
+    """Load the cluster index of a database once and keep it in the global config object.
+
+    :rtype: A dict comprising the representatives sketch path, a dict of clusters per representative id
+        and the max cluster radius or None if the database is not clustered or has changed since.
+    """
+
+    if 'clusters' not in config:
+        config['clusters'] = None
+        clusters_path = config['db_path'].joinpath(rc.CLUSTERS_DIR)
+        manifest_path = config['db_path'].joinpath(rc.SHARDS_MANIFEST)
+        if clusters_path.joinpath(rc.CLUSTERS_FILE).is_file() and manifest_path.is_file():
+            if clusters_path.joinpath(rc.SHARDS_MANIFEST).read_text() == manifest_path.read_text():
+                clusters = {}
+                with clusters_path.joinpath(rc.CLUSTERS_FILE).open() as fh:
+                    for line in fh:
+                        cluster_file, representative_id, radius, no_members = line.rstrip('\n').split('\t')
+                        clusters[representative_id] = {
+                            'path': clusters_path.joinpath(cluster_file),
+                            'radius': float(radius),
+                            'size': int(no_members)
+                        }
+                config['clusters'] = {
+                    'representatives_path': clusters_path.joinpath(rc.REPRESENTATIVES_FILE),
+                    'clusters': clusters,
+                    'max_radius': max(cluster['radius'] for cluster in clusters.values()),
+                    'sketches': {}
+                }
+    return config['clusters']
+
+
+def select_clusters(clusters, representative_hits, max_distance):
+    """Select clusters which might comprise members within max_distance of a query genome.
+
+    Mash distances approximately satisfy the triangle inequality. Hence, members of clusters whose
+    representative is farther away than max_distance plus the cluster radius are skipped.
+
+    :param clusters: A cluster index as returned by load().
+    :param representative_hits: An iterable of (representative id, distance) tuples of a query genome.
+    :param max_distance: Maximum distance of reported hits.
+
+    :rtype: A list of selected clusters sorted by representative distance.
+    """
+
+    selected_clusters = []
+    for representative_id, distance in representative_hits:
+        cluster = clusters['clusters'][representative_id]
+        if distance <= max_distance + cluster['radius']:
+            selected_clusters.append((distance, representative_id, cluster))
+    return [cluster for distance, representative_id, cluster in sorted(selected_clusters, key=lambda k: k[:2])]
+
+
+def dist(config, clusters, max_distance):
+    """Compute Mash distances of all query genomes in-process comparing them to cluster representatives first
+    and to the members of selected clusters afterwards.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param clusters: A cluster index as returned by load().
+    :param max_distance: Maximum distance of reported hits.
+
+    :rtype: A list comprising a list of (id, distance) tuples per query genome.
+    """
+
+    if 'representatives' not in clusters['sketches']:
+        clusters['sketches']['representatives'] = sketch.read_sketches(clusters['representatives_path'])
+    representatives = clusters['sketches']['representatives']
+    query_sketches = sketch.sketch_genomes(config, config['genome_path'], representatives)
+    results = []
+    with cf.ThreadPoolExecutor(max_workers=max(config['threads'], 1)) as tpe:
+        for idx in range(len(query_sketches['ids'])):
+            query_hashes = query_sketches['hashes'][idx, :query_sketches['counts'][idx]]
+            representative_hits = sketch.compute_distances(representatives, query_hashes, max_distance + clusters['max_radius'])
+            futures = []
+            for cluster in select_clusters(clusters, representative_hits, max_distance):
+                cluster_path = str(cluster['path'])
+                if cluster_path not in clusters['sketches']:
+                    clusters['sketches'][cluster_path] = sketch.read_sketches(cluster['path'])
+                futures.append(tpe.submit(sketch.compute_distances, clusters['sketches'][cluster_path], query_hashes, max_distance))
+            results.append([hit for future in futures for hit in future.result()])
+    return results
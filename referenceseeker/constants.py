@@ -3,9 +3,47 @@
 MAX_MASH_DIST = '0.1'
 UNFILTERED_MASH_DIST = '0.3'
 
+# Genome file constants
+FASTA_SUFFIXES = ['.fasta', '.fas', '.fsa', '.fna', '.fa']
+GENBANK_SUFFIXES = ['.genbank', '.gbff', '.gbk', '.gb']
+EMBL_SUFFIXES = ['.embl', '.ebl', '.el']
+
 # DNA fragmentation constants
 FRAGMENT_SIZE = 1020
 MIN_FRAGMENT_SIZE = 100
+FRAGMENTS_DIR = 'fragments'
+
+# sketch shard constants
+SHARDS_DIR = 'shards'
+SHARDS_MANIFEST = 'shards.tsv'
+SMALL_SHARD_SIZE = 1000  # max number of sketches of a shard new sketches are appended to
+SHARD_SIZE = 10000  # default max number of sketches of a compacted shard
+RETIRED_SHARDS_FILE = 'retired.tsv'  # shards replaced by compaction, removed by a later cleanup
+RETIRED_SHARD_LIFETIME = 24 * 60 * 60  # min number of seconds retired shards are kept for queries reading a former manifest
+
+# cluster index constants
+CLUSTERS_DIR = 'clusters'
+CLUSTERS_FILE = 'clusters.tsv'
+REPRESENTATIVES_FILE = 'representatives.msh'
+CLUSTER_DIST = 0.1  # default max Mash distance of cluster members to their representative
+
+# near-duplicate index constants
+DUPLICATES_FILE = 'duplicates.tsv'
+DUPLICATE_DIST = 0.001  # default max Mash distance of near-duplicate genomes to their representative
+
+# database metadata store constants
+METADATA_FILE = 'db.sqlite'
+
+# result cache constants
+CACHE_FILE = 'results.sqlite'
+
+# 3rd party executable test cache constants
+BINARIES_CACHE_FILE = 'binaries.json'
+BINARIES_CACHE_SIZE = 16  # max number of cached tests, e.g. of different environments
+
+# nucmer index cache constants
+INDEX_DIR = 'index'
+INDEX_PREFIX = 'reference'
 
 CITATION = '''Schwengers et al., (2020)
 ReferenceSeeker: rapid determination of appropriate reference genomes.
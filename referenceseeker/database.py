@@ -1,15 +1,22 @@
 
 import argparse
+import concurrent.futures as cf
+import itertools
+import multiprocessing as mp
+import os
 from pathlib import Path
 import shutil
 import subprocess as sp
 import sys
 import tempfile
 
-from Bio import SeqIO
-
 import referenceseeker
+import referenceseeker.clusters as clusters
+import referenceseeker.dedup as dedup
 import referenceseeker.constants as rc
+import referenceseeker.index as index
+import referenceseeker.metadata as metadata
+import referenceseeker.shards as shards
 import referenceseeker.util as util
 
 
@@ -29,9 +36,12 @@ def init(args):
         db_tsv_path.touch(mode=0o660)
         print("created database genome information file (db.tsv)")
 
-        db_sketch_path = db_path.joinpath('db.msh')
-        db_sketch_path.touch(mode=0o660)
-        print("created database genome kmer sketch file (db.msh)")
+        metadata.add_genomes(db_path, [])
+        print("created database genome metadata store (%s)" % rc.METADATA_FILE)
+
+        if not db_path.joinpath(rc.SHARDS_MANIFEST).exists():
+            shards.write_manifest(db_path, shards.read_manifest(db_path))  # adopt db.msh of existing databases as first shard
+        print("created database genome kmer sketch shard manifest (%s)" % rc.SHARDS_MANIFEST)
     except:
         print("Error: could not init database (%s) in output directory (%s)!" % (args.output, args.db), file=sys.stderr)
         raise
@@ -40,113 +50,290 @@ def init(args):
 
 
 def import_genome(config, args):
+    """Import a single genome into the database."""
+    genomes = [{
+        'path': Path(args.genome).resolve(),
+        'id': args.id,
+        'tax': args.taxonomy,
+        'status': args.status,
+        'name': args.organism
+    }]
+    import_genomes(config, args, genomes)
+    print("\nSuccessfully imported genome (%s/%s) into database (%s)" % (args.organism, args.genome, Path(args.db).resolve()))
+
+
+def import_genomes(config, args, genomes):
+    """Import many genomes into the database at once.
+
+    Genomes are validated and sketched in a process pool. Afterwards, all metadata are appended in a single write
+    and all sketches are merged into a database sketch shard by a single Mash paste. Sketches are added last,
+    so genomes are only found by queries once all of their files and metadata are in place. If any step fails,
+    stored genome files and metadata are removed again.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param args: parsed command line arguments
+    :param genomes: A list of dicts comprising the path, id (or None), taxonomy, status and organism name of each genome.
+    """
+
+    db_path = Path(args.db).resolve()
+    tmp_path = Path(tempfile.mkdtemp())
+    threads = max(min(getattr(args, 'threads', 1), len(genomes)), 1)
+    stored_genome_ids = []  # genomes to remove from the database directory if the import fails
+    db_tsv_size = None
     try:
-        db_path = Path(args.db).resolve()
-        genome_path = Path(args.genome).resolve()
-        tmp_path = Path(tempfile.mkdtemp())
-        genome_suffix = genome_path.suffix.lower()
-        genome_id = args.id
-        if genome_suffix in ['.fasta', '.fas', '.fsa', '.fna', '.fa']:
-            # import fasta
-            with genome_path.open() as fh_in:
-                sequences = SeqIO.parse(fh_in, "fasta")
-                test_sequences(sequences)
-        elif genome_suffix in ['.genbank', '.gbff', '.gbk', '.gb']:
-            # import genbank
-            input_path = genome_path
-            genome_path = tmp_path.joinpath('genome.fasta')
-            with input_path.open() as fh_in, genome_path.open('w') as fh_out:
-                sequences = SeqIO.parse(fh_in, "genbank")
-                test_sequences(sequences)
-                SeqIO.write(sequences, fh_out, "fasta")
-        elif genome_suffix in ['.embl', '.ebl', '.el']:
-            # import embl
-            input_path = genome_path
-            genome_path = tmp_path.joinpath('genome.fasta')
-            with input_path.open() as fh_in, genome_path.open('w') as fh_out:
-                sequences = SeqIO.parse(fh_in, "embl")
-                test_sequences(sequences)
-                SeqIO.write(sequences, fh_out, "fasta")
-        else:
-            raise Exception("Unknown genome file extension (%s)" % genome_suffix)
-
-        # extract genome id if it is empty
-        if genome_id is None:
-            for record in SeqIO.parse(str(genome_path), 'fasta'):
-                genome_id = record.id
-                break
-
-        # copy genome fasta file to database directory
-        shutil.copyfile(str(genome_path), str(db_path.joinpath("%s.fna" % genome_id)))
-
-        # copy/rename genome file to have Mash use the right ID in its internal db
-        old_genome_path = genome_path
-        genome_path = tmp_path.joinpath(genome_id)
-        shutil.copyfile(str(old_genome_path), str(genome_path))
-
-        # sketch genome
-        cmd = [
-            'mash',
-            'sketch',
-            '-o', 'genome',
-            '-k', '32',
-            '-s', '10000',
-            genome_id
-        ]
-        proc = sp.run(
-            cmd,
-            cwd=str(tmp_path),
-            env=config['env'],
-            stdout=sp.PIPE,
-            stderr=sp.PIPE,
-            universal_newlines=True
-        )
-        if proc.returncode != 0:
-            sys.exit("ERROR: failed to create genome kmer sketches via Mash!\nexit=%d\ncmd=%s" % (proc.returncode, cmd))
-
-        existing_db_sketch_path = db_path.joinpath('db.msh')
-        if existing_db_sketch_path.stat().st_size == 0:
-            # empty db -> replace existing with new sketch file
-            shutil.move(str(tmp_path.joinpath('genome.msh')), str(existing_db_sketch_path))
+        with cf.ProcessPoolExecutor(max_workers=threads) as ppe:
+            # validate, convert and sketch genomes
+            futures = []
+            for idx, genome in enumerate(genomes):
+                genome_tmp_path = tmp_path.joinpath(str(idx))
+                genome_tmp_path.mkdir()
+                futures.append(ppe.submit(prepare_genome, config, genome, genome_tmp_path))
+            for genome, future in zip(genomes, futures):
+                try:
+                    genome['id'], genome['tmp_path'] = future.result()
+                except Exception as e:
+                    raise Exception("%s: %s" % (genome['path'], e))
+
+            genome_ids = [genome['id'] for genome in genomes]
+            if len(set(genome_ids)) != len(genome_ids):
+                raise Exception("Duplicated genome ids: %s" % ', '.join(sorted(set(k for k in genome_ids if genome_ids.count(k) > 1))))
+            existing_genome_ids = util.read_reference_genomes({'db_path': db_path}, genome_ids)
+            if len(existing_genome_ids) > 0:
+                raise Exception("Genome ids already in database: %s" % ', '.join(existing_genome_ids))
+
+            # store genomes, DNA fragments and nucmer indices in database directory
+            stored_genome_ids = genome_ids
+            futures = [ppe.submit(store_genome, config, db_path, genome['id'], genome['tmp_path'], args.index) for genome in genomes]
+            for genome, future in zip(genomes, futures):
+                genome['length'] = future.result()
+
+        # add genome metainformation to db.tsv and the metadata store
+        db_tsv_path = db_path.joinpath('db.tsv')
+        db_tsv_size = db_tsv_path.stat().st_size
+        with db_tsv_path.open(mode='a') as fh:
+            fh.write(''.join(
+                "%s\t%i\t%s\t%s\t%i\n" % (genome['id'], genome['tax'], genome['status'], genome['name'], genome['length'])
+                for genome in genomes
+            ))
+        metadata.add_genomes(db_path, [{
+            'id': genome['id'],
+            'tax': str(genome['tax']),
+            'status': genome['status'],
+            'name': genome['name'],
+            'length': genome['length']
+        } for genome in genomes])
+
+        # add genome sketches to database sketch shards which makes genomes visible to queries
+        shards.add_sketches(config, db_path, [genome['tmp_path'].joinpath('genome.msh') for genome in genomes])
+    except Exception as e:
+        print(e)
+        remove_genomes(db_path, stored_genome_ids, db_tsv_size)
+        print("ERROR: could not import genome(s) into database (%s)!" % args.db, file=sys.stderr)
+        sys.exit(-1)
+    finally:
+        shutil.rmtree(str(tmp_path), ignore_errors=True)
+
+
+def prepare_genome(config, genome, tmp_path):
+    """Validate a genome, convert it to Fasta and compute its Mash sketch.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param genome: A dict comprising the path and id (or None) of a genome.
+    :param tmp_path: Path to a temporary directory of this genome.
+
+    :rtype: The genome id and the temporary directory comprising the Fasta file named by the genome id and its sketch.
+    """
+
+    genome_path = genome['path']
+    genome_suffix = genome_path.suffix.lower()
+    if genome_suffix in rc.FASTA_SUFFIXES:
+        genome_format = 'fasta'
+    elif genome_suffix in rc.GENBANK_SUFFIXES:
+        genome_format = 'genbank'
+    elif genome_suffix in rc.EMBL_SUFFIXES:
+        genome_format = 'embl'
+    else:
+        raise Exception("Unknown genome file extension (%s)" % genome_suffix)
+
+    from Bio import SeqIO  # imported on demand to keep start-up of other sub-commands fast
+
+    # parse, validate and convert genome within a single pass
+    fasta_path = tmp_path.joinpath('genome.fasta')
+    with genome_path.open() as fh_in:
+        records = test_sequences(SeqIO.parse(fh_in, genome_format))
+        first_record = next(records, None)
+        if first_record is None:
+            raise Exception("No sequence records found")
+        records = itertools.chain([first_record], records)
+        if genome_format == 'fasta':
+            for record in records:  # validate only, Fasta files are copied unchanged
+                pass
+            shutil.copyfile(str(genome_path), str(fasta_path))
         else:
-            # add genome sketch to db sketch file
-            cmd = [
-                'mash',
-                'paste',
-                'db',
-                str(existing_db_sketch_path),
-                str(tmp_path.joinpath('genome.msh'))
-            ]
-            proc = sp.run(
-                cmd,
-                cwd=str(tmp_path),
-                env=config['env'],
-                stdout=sp.PIPE,
-                stderr=sp.PIPE,
-                universal_newlines=True
-            )
-            if proc.returncode != 0:
-                sys.exit("ERROR: failed to import sketch to database via Mash!\nexit=%d\ncmd=%s" % (proc.returncode, cmd))
-            # replace old database sketch file by new db.msh
-            shutil.move(str(tmp_path.joinpath('db.msh')), str(existing_db_sketch_path))
-
-        # remove tmp dir
-        shutil.rmtree(str(tmp_path))
-
-        # add genome metainformation to db.tsv
-        with db_path.joinpath('db.tsv').open(mode='a') as fh:
-            fh.write(
-                "%s\t%i\t%s\t%s\n" %
-                (genome_id, args.taxonomy, args.status, args.organism)
-            )
+            with fasta_path.open('w') as fh_out:
+                SeqIO.write(records, fh_out, 'fasta')
+
+    # rename genome file to have Mash use the right ID in its internal db
+    genome_id = genome['id'] if genome['id'] is not None else first_record.id
+    fasta_path.rename(tmp_path.joinpath(genome_id))
+
+    # sketch genome
+    cmd = [
+        'mash',
+        'sketch',
+        '-o', 'genome',
+        '-k', '32',
+        '-s', '10000',
+        genome_id
+    ]
+    proc = sp.run(
+        cmd,
+        cwd=str(tmp_path),
+        env=config['env'],
+        stdout=sp.PIPE,
+        stderr=sp.PIPE,
+        universal_newlines=True
+    )
+    if proc.returncode != 0:
+        raise Exception("failed to create genome kmer sketches via Mash! exit=%d, cmd=%s" % (proc.returncode, cmd))
+    return genome_id, tmp_path
+
+
+def store_genome(config, db_path, genome_id, tmp_path, build_index):
+    """Move a prepared genome into the database directory and build its DNA fragments and nucmer index.
+
+    :rtype: The genome length.
+    """
+
+    genome_path = db_path.joinpath("%s.fna" % genome_id)
+    shutil.move(str(tmp_path.joinpath(genome_id)), str(genome_path))
+
+    # build DNA fragments for bidirectional alignments
+    dna_fragments = util.store_dna_fragments(genome_path, db_path, genome_id)
+
+    # prebuild nucmer index
+    if build_index:
+        if not index.build_index(config, genome_path, db_path.joinpath(rc.INDEX_DIR, genome_id)):
+            raise Exception("Could not build nucmer index of genome %s" % genome_id)
+    return int(dna_fragments.sum())
+
+
+def remove_genomes(db_path, genome_ids, db_tsv_size=None):
+    """Remove genome files, DNA fragments, nucmer indices and metadata of genomes not added to the database sketches.
+
+    :param db_path: Path to the database directory.
+    :param genome_ids: A list of genome ids.
+    :param db_tsv_size: Size of db.tsv before genomes have been appended or None if db.tsv has not been changed.
+    """
+
+    if len(genome_ids) == 0:
+        return
+    metadata.remove_genomes(db_path, genome_ids)
+    if db_tsv_size is not None:
+        os.truncate(str(db_path.joinpath('db.tsv')), db_tsv_size)
+    for genome_id in genome_ids:
+        for genome_file_path in [
+            db_path.joinpath("%s.fna" % genome_id),
+            db_path.joinpath(rc.FRAGMENTS_DIR, "%s.fasta" % genome_id),
+            db_path.joinpath(rc.FRAGMENTS_DIR, "%s.npy" % genome_id)
+        ]:
+            try:
+                genome_file_path.unlink()
+            except FileNotFoundError:
+                pass
+        shutil.rmtree(str(db_path.joinpath(rc.INDEX_DIR, genome_id)), ignore_errors=True)
+
+
+def read_manifest(args):
+    """Read genomes to import either from a directory or from a tab separated manifest file.
+
+    Manifest lines comprise a genome path and optionally its id, taxonomy id, assembly status and organism name.
+    Missing values default to the import options.
+
+    :rtype: A list of dicts comprising the path, id (or None), taxonomy, status and organism name of each genome.
+    """
+
+    try:
+        path = util.check_path(args.manifest)
+    except FileNotFoundError:
+        sys.exit('ERROR: genome directory/manifest %s is not readable!' % args.manifest)
+    except PermissionError:
+        sys.exit('ERROR (permission): genome directory/manifest %s is not accessible' % args.manifest)
+    except OSError:
+        sys.exit('ERROR: genome manifest %s is empty!' % args.manifest)
+
+    genome_suffixes = rc.FASTA_SUFFIXES + rc.GENBANK_SUFFIXES + rc.EMBL_SUFFIXES
+    genomes = []
+    if path.is_dir():
+        for genome_path in sorted(p for p in path.iterdir() if p.suffix.lower() in genome_suffixes):
+            genomes.append({'path': genome_path, 'id': None, 'tax': args.taxonomy, 'status': args.status, 'name': args.organism})
+    else:
+        with path.open() as fh:
+            for line in fh:
+                if line.strip() == '' or line[0] == '#':
+                    continue
+                cols = line.rstrip('\n').split('\t')
+                cols += [''] * (5 - len(cols))
+                genome_path = Path(cols[0])
+                try:
+                    genomes.append({
+                        'path': genome_path if genome_path.is_absolute() else path.parent.joinpath(genome_path),
+                        'id': cols[1] if cols[1] != '' else None,
+                        'tax': int(cols[2]) if cols[2] != '' else args.taxonomy,
+                        'status': cols[3] if cols[3] != '' else args.status,
+                        'name': cols[4] if cols[4] != '' else args.organism
+                    })
+                except ValueError:
+                    sys.exit('ERROR: invalid taxonomy id in manifest line: %s' % line.strip())
+
+    for genome in genomes:
+        try:
+            genome['path'] = util.check_path(genome['path'])
+        except FileNotFoundError:
+            sys.exit('ERROR: genome file %s is not readable!' % genome['path'])
+        except PermissionError:
+            sys.exit('ERROR (permission): genome file %s is not accessible' % genome['path'])
+        except OSError:
+            sys.exit('ERROR: genome file %s is empty!' % genome['path'])
+    return genomes
+
+
+def compact(config, args):
+    db_path = Path(args.db).resolve()
+    try:
+        no_shards, no_compacted_shards = shards.compact(config, db_path, args.shard_size)
     except Exception as e:
         print(e)
-        print("ERROR: could not import genome (%s/%s) into database (%s)!" % (args.organism, args.genome, args.db), file=sys.stderr)
+        print("ERROR: could not compact database (%s)!" % args.db, file=sys.stderr)
         sys.exit(-1)
-    print("\nSuccessfully imported genome (%s/%s) into database (%s)" % (args.organism, args.genome, db_path))
+    print("\nSuccessfully compacted %d sketch shards into %d shards in database (%s)" % (no_shards, no_compacted_shards, db_path))
+
+
+def cluster(config, args):
+    db_path = Path(args.db).resolve()
+    config['threads'] = args.threads
+    try:
+        no_genomes, no_clusters = clusters.build(config, db_path, args.distance)
+    except Exception as e:
+        print(e)
+        print("ERROR: could not cluster database (%s)!" % args.db, file=sys.stderr)
+        sys.exit(-1)
+    print("\nSuccessfully clustered %d genomes into %d clusters in database (%s)" % (no_genomes, no_clusters, db_path))
+
+
+def deduplicate(args):
+    db_path = Path(args.db).resolve()
+    try:
+        no_genomes, no_groups = dedup.build(db_path, args.distance)
+    except Exception as e:
+        print(e)
+        print("ERROR: could not deduplicate database (%s)!" % args.db, file=sys.stderr)
+        sys.exit(-1)
+    print("\nSuccessfully grouped %d genomes into %d near-duplicate groups in database (%s)" % (no_genomes, no_groups, db_path))
 
 
 def test_sequences(sequences):
+    """Validate sequence records while passing them through."""
     sequence_ids = set()
     for record in sequences:
         if len(record.seq) == 0:
@@ -155,14 +342,10 @@ def test_sequences(sequences):
             raise Exception("Duplicated record id: %s" % record.id)
         else:
             sequence_ids.add(record.id)
+        yield record
 
 
 def main():
-    #  setup path and test if necessary 3rd party executables are available
-    config = {}
-    util.set_path(config)
-    util.test_binaries(config)
-
     # parse options and arguments
     parser = argparse.ArgumentParser(
         prog='referenceseeker_db',
@@ -183,20 +366,58 @@ def main():
     parser_init.add_argument('--db', '-d', action='store', required=True, help='Name of the new ReferenceSeeker database')
 
     #  add import sub-command options
-    parser_import = subparsers.add_parser('import', help='Add a new genome to database')
+    parser_import = subparsers.add_parser('import', help='Add new genomes to database')
     parser_import.add_argument('--db', '-d', action='store', required=True, help='ReferenceSeeker database path')
-    parser_import.add_argument('--genome', '-g', action='store', required=True, help='Genome path [Fasta, GenBank, EMBL]')
+    group_genomes = parser_import.add_mutually_exclusive_group(required=True)
+    group_genomes.add_argument('--genome', '-g', action='store', default=None, help='Genome path [Fasta, GenBank, EMBL]')
+    group_genomes.add_argument('--manifest', '-m', action='store', default=None, help='Directory with genomes or tab separated manifest file (path, id, taxonomy, status, organism) of genomes to import at once')
     parser_import.add_argument('--id', '-i', action='store', default=None, help='Unique genome identifier (default sequence id of first record)')
     parser_import.add_argument('--taxonomy', '-t', action='store', type=int, default=12908, help='Taxonomy ID (default = 12908 [unclassified sequences])')
     parser_import.add_argument('--status', '-s', action='store', choices=['complete', 'chromosome', 'scaffold', 'contig'], default='contig', help='Assembly level (default = contig)')
     parser_import.add_argument('--organism', '-o', action='store', default='', help='Organism name (default = "")')
+    parser_import.add_argument('--index', action='store_true', help='Prebuild a nucmer index of the genome for the index cache (default = False)')
+    parser_import.add_argument('--threads', action='store', type=int, default=mp.cpu_count(), help='Number of processes used to import many genomes (default = number of available CPU cores)')
+
+    #  add compact sub-command options
+    parser_compact = subparsers.add_parser('compact', help='Merge small genome sketch shards')
+    parser_compact.add_argument('--db', '-d', action='store', required=True, help='ReferenceSeeker database path')
+    parser_compact.add_argument('--shard-size', action='store', dest='shard_size', type=int, default=rc.SHARD_SIZE, help='Max number of genomes per merged shard (default = %d)' % rc.SHARD_SIZE)
+
+    #  add cluster sub-command options
+    parser_cluster = subparsers.add_parser('cluster', help='Cluster genomes for a two-stage search via cluster representatives')
+    parser_cluster.add_argument('--db', '-d', action='store', required=True, help='ReferenceSeeker database path')
+    parser_cluster.add_argument('--distance', action='store', type=float, default=rc.CLUSTER_DIST, help='Max Mash distance of cluster members to their representative (default = %0.2f)' % rc.CLUSTER_DIST)
+    parser_cluster.add_argument('--threads', action='store', type=int, default=mp.cpu_count(), help='Number of threads used to compare genomes and sketch clusters (default = number of available CPU cores)')
+
+    #  add dedup sub-command options
+    parser_dedup = subparsers.add_parser('dedup', help='Group near-duplicate genomes so that only their representatives are aligned')
+    parser_dedup.add_argument('--db', '-d', action='store', required=True, help='ReferenceSeeker database path')
+    parser_dedup.add_argument('--distance', action='store', type=float, default=rc.DUPLICATE_DIST, help='Max Mash distance of near-duplicate genomes to their representative (default = %0.3f)' % rc.DUPLICATE_DIST)
 
     args = parser.parse_args()
 
+    #  setup path and test if necessary 3rd party executables are available
+    config = {}
+    util.set_path(config)
+    util.test_binaries(config)
+
     if args.subcommand == 'init':
         init(args)
     elif args.subcommand == 'import':
-        import_genome(config, args)
+        if args.manifest is not None:
+            genomes = read_manifest(args)
+            if len(genomes) == 0:
+                sys.exit('ERROR: no genome files found in %s!' % args.manifest)
+            import_genomes(config, args, genomes)
+            print("\nSuccessfully imported %d genomes into database (%s)" % (len(genomes), Path(args.db).resolve()))
+        else:
+            import_genome(config, args)
+    elif args.subcommand == 'compact':
+        compact(config, args)
+    elif args.subcommand == 'cluster':
+        cluster(config, args)
+    elif args.subcommand == 'dedup':
+        deduplicate(args)
     else:
         parser.print_help()
         sys.exit("Error: no subcommand provided!")
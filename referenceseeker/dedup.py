@@ -0,0 +1,110 @@
+import os
+import tempfile
+
+import referenceseeker.clusters as clusters
+import referenceseeker.constants as rc
+import referenceseeker.shards as shards
+import referenceseeker.sketch as sketch
+
+
+def build(db_path, max_distance):
+    """Group near-duplicate database genomes behind a representative and store their membership table.
+
+    The table lists each member genome together with its representative and Mash distance.
+    Representatives and genomes imported afterwards are not listed and hence remain on their own.
+
+    :param db_path: Path to the database directory.
+    :param max_distance: Max Mash distance of near-duplicate genomes to their representative.
+
+    :rtype: The number of grouped genomes and the number of groups.
+    """
+
+    shard_paths = shards.get_shards(db_path)
+    shard_sketches = [sketch.read_sketches(shard_path) for shard_path in shard_paths]
+    if len(shard_sketches) == 0:
+        raise Exception("Database comprises no genomes")
+    clusters.check_sketch_params(shard_paths, shard_sketches)
+    groups = clusters.cluster_sketches(shard_sketches, max_distance)
+
+    # replace a former membership table at once, so concurrent queries never read partial tables
+    fd, tmp_duplicates_path = tempfile.mkstemp(dir=str(db_path), prefix='.tmp-')
+    with os.fdopen(fd, 'w') as fh:
+        for members in groups:
+            representative_id = members[0][0]
+            for member_id, distance in members[1:]:
+                fh.write("%s\t%s\t%f\n" % (member_id, representative_id, distance))
+    os.chmod(tmp_duplicates_path, 0o660)
+    os.replace(tmp_duplicates_path, str(db_path.joinpath(rc.DUPLICATES_FILE)))
+    return sum(len(members) for members in groups), len(groups)
+
+
+def load(config):
+    """Load the near-duplicate membership table of a database once and keep it in the global config object.
+
+    :rtype: A dict comprising the representative id per member id and the member ids per representative id
+        or None if the database comprises no membership table.
+    """
+
+    if 'duplicates' not in config:
+        config['duplicates'] = None
+        duplicates_path = config['db_path'].joinpath(rc.DUPLICATES_FILE)
+        if duplicates_path.is_file():
+            representatives = {}
+            members = {}
+            with duplicates_path.open() as fh:
+                for line in fh:
+                    member_id, representative_id, distance = line.rstrip('\n').split('\t')
+                    representatives[member_id] = representative_id
+                    members.setdefault(representative_id, []).append(member_id)
+            config['duplicates'] = {
+                'representatives': representatives,
+                'members': members
+            }
+    return config['duplicates']
+
+
+def collapse(duplicates, mash_hits):
+    """Collapse Mash hits of near-duplicate genomes to hits of their representatives.
+
+    Representatives are ranked by their own distance if hit or the distance of their closest member otherwise.
+    The latter is a ranking key only, see mash.add_representative_distances().
+
+    :param duplicates: A membership table as returned by load().
+    :param mash_hits: An iterable of (id, distance) tuples.
+
+    :rtype: A list of (representative id, distance) tuples in order of first hits and a dict of hit groups per representative id.
+    """
+
+    groups = group_hits(duplicates, mash_hits)
+    return representative_hits(groups), groups
+
+
+def group_hits(duplicates, mash_hits, groups=None):
+    """Group Mash hits of near-duplicate genomes by their representatives.
+
+    :param duplicates: A membership table as returned by load().
+    :param mash_hits: An iterable of (id, distance) tuples.
+    :param groups: A dict of hit groups per representative id of a former call to extend, e.g. of a former block of hits.
+
+    :rtype: A dict of hit groups per representative id in order of first hits.
+    """
+
+    if groups is None:
+        groups = {}
+    for ref_genome_id, distance in mash_hits:
+        representative_id = duplicates['representatives'].get(ref_genome_id, ref_genome_id)
+        group = groups.setdefault(representative_id, {'distance': None, 'members': []})
+        if ref_genome_id == representative_id:
+            group['distance'] = distance
+        else:
+            group['members'].append((ref_genome_id, distance))
+    return groups
+
+
+def representative_hits(groups):
+    """Build (representative id, distance) tuples of hit groups as returned by group_hits() ranking groups by their closest genome."""
+    representative_hits = []
+    for representative_id, group in groups.items():
+        distance = group['distance'] if group['distance'] is not None else min(distance for member_id, distance in group['members'])
+        representative_hits.append((representative_id, distance))
+    return representative_hits
@@ -0,0 +1,49 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+
+def open_log(target):
+    """Open a JSON-lines event log.
+
+    :param target: A file path, 'fd:<N>' to write to an open file descriptor or None to disable the event log.
+
+    :rtype: An event log dict or None if the event log is disabled.
+    """
+
+    if target is None:
+        return None
+    if target.startswith('fd:'):
+        fh = os.fdopen(int(target[3:]), 'a', buffering=1, closefd=False)
+    else:
+        fh = open(target, 'a', buffering=1)
+    return {
+        'fh': fh,
+        'run': uuid.uuid4().hex,  # relates all events of a run
+        'start': time.perf_counter(),
+        'lock': threading.Lock()
+    }
+
+
+def emit(config, event, **fields):
+    """Write a single event line comprising the run id, a timestamp, the event name and its fields."""
+    log = config.get('events')
+    if log is None:
+        return
+    record = {'run': log['run'], 'ts': round(time.time(), 6), 'event': event}
+    record.update(fields)
+    line = json.dumps(record, separators=(',', ':'))
+    with log['lock']:
+        log['fh'].write(line + '\n')
+
+
+def close_log(config, status):
+    """Write a final event comprising the run status and wall time and close the event log."""
+    log = config.get('events')
+    if log is None:
+        return
+    emit(config, 'end', status=status, wall_ms=round((time.perf_counter() - log['start']) * 1000, 3))
+    log['fh'].close()
+    config['events'] = None
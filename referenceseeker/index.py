@@ -0,0 +1,156 @@
+import fcntl
+import os
+import shutil
+import subprocess as sp
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import referenceseeker.constants as rc
+import referenceseeker.trace as trace
+
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+@contextmanager
+def use_index(config, ref_genome_id):
+    """Provide the persistent nucmer suffix array index of a reference genome and keep it from being evicted until the context exits.
+
+    Indices are stored in the database directory, built lazily on first use and evicted in
+    least recently used order as soon as the cache exceeds its size budget. Indices in use hold a
+    shared lock on their lock file, so concurrent threads, servers and runs skip them on eviction.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param ref_genome_id: reference genome id.
+
+    :rtype: An index path prefix to be passed to nucmer or None if the index cache is disabled or not usable.
+    """
+
+    if config.get('index_cache', 0) <= 0:
+        yield None
+        return
+    lock_fh = _open_lock_file(config['db_path'].joinpath(rc.INDEX_DIR), ref_genome_id)
+    if lock_fh is None:  # indices of read-only databases cannot be evicted
+        yield _get_index(config, ref_genome_id)
+        return
+    with lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_SH)
+        yield _get_index(config, ref_genome_id)
+
+
+def _get_index(config, ref_genome_id):
+    index_path = config['db_path'].joinpath(rc.INDEX_DIR, ref_genome_id)
+    with _get_lock(ref_genome_id):
+        if index_path.is_dir():
+            try:
+                os.utime(str(index_path))  # mark as recently used
+                return index_path.joinpath(rc.INDEX_PREFIX)
+            except OSError:  # evicted by a concurrent run or read-only database
+                if index_path.is_dir():
+                    return index_path.joinpath(rc.INDEX_PREFIX)
+        if not os.access(str(config['db_path']), os.W_OK):
+            return None
+        reference_genome_path = config['db_path'].joinpath("%s.fna" % ref_genome_id)
+        if not build_index(config, reference_genome_path, index_path):
+            return None
+
+    evict(config)
+    return index_path.joinpath(rc.INDEX_PREFIX) if index_path.is_dir() else None
+
+
+def build_index(config, reference_genome_path, index_path):
+    """Build a nucmer suffix array index of a reference genome.
+
+    The index is built in a temporary directory which is renamed to its final path afterwards,
+    so concurrent runs never load incomplete indices.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param reference_genome_path: Path to reference genome Fasta file.
+    :param index_path: Path to the index directory.
+
+    :rtype: True if the index is available.
+    """
+
+    try:
+        index_path.parent.mkdir(mode=0o770, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=str(index_path.parent), prefix='.tmp-')
+    except OSError:
+        return False
+
+    cmd = [
+        'nucmer',
+        '--save=%s' % rc.INDEX_PREFIX,
+        str(reference_genome_path)
+    ]
+    proc = trace.popen(
+        config,
+        cmd,
+        cwd=tmp_path,
+        env=config['env'],
+        stdout=sp.DEVNULL,
+        stderr=sp.DEVNULL
+    )
+    if trace.wait(config, proc) == 0:
+        try:
+            os.chmod(tmp_path, 0o770)
+            os.rename(tmp_path, str(index_path))
+        except OSError:  # built concurrently by another run
+            pass
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    return index_path.is_dir()
+
+
+def evict(config):
+    """Remove least recently used indices until the index cache fits into its size budget."""
+    indices = []
+    cache_size = 0
+    for index_path in config['db_path'].joinpath(rc.INDEX_DIR).iterdir():
+        if index_path.name[0] == '.':  # skip indices under construction
+            continue
+        try:
+            size = sum(p.stat().st_size for p in index_path.iterdir())
+            indices.append((index_path.stat().st_mtime, index_path, size))
+        except FileNotFoundError:  # evicted by a concurrent run
+            continue
+        cache_size += size
+
+    for last_used, index_path, size in sorted(indices, key=lambda k: k[0]):
+        if cache_size <= config['index_cache']:
+            break
+        lock_fh = _open_lock_file(index_path.parent, index_path.name)
+        if lock_fh is None:
+            continue
+        with lock_fh, _get_lock(index_path.name):
+            try:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:  # in use by nucmer
+                continue
+            # move away first, so no other run picks up a partially removed index
+            evicted_path = tempfile.mkdtemp(dir=str(index_path.parent), prefix='.evicted-')
+            try:
+                os.rename(str(index_path), os.path.join(evicted_path, index_path.name))
+                cache_size -= size
+            except OSError:  # evicted by a concurrent run
+                pass
+            shutil.rmtree(evicted_path, ignore_errors=True)
+
+
+def _open_lock_file(indices_path, ref_genome_id):
+    """Open the lock file of an index, which is kept next to the index so it outlives evictions.
+
+    :rtype: An open lock file or None if it cannot be created, e.g. in read-only databases.
+    """
+    try:
+        indices_path.mkdir(mode=0o770, exist_ok=True)
+        return indices_path.joinpath('.%s.lock' % ref_genome_id).open('a')
+    except OSError:
+        return None
+
+
+def _get_lock(ref_genome_id):
+    with _locks_lock:
+        if ref_genome_id not in _locks:
+            _locks[ref_genome_id] = threading.Lock()
+        return _locks[ref_genome_id]
@@ -4,10 +4,15 @@ import multiprocessing as mp
 import sys
 
 import referenceseeker
+import referenceseeker.algorithms as algorithms
 import referenceseeker.constants as rc
+import referenceseeker.events as events
 import referenceseeker.util as util
 import referenceseeker.single as single
 import referenceseeker.cohort as cohort
+import referenceseeker.batch as batch
+import referenceseeker.server as server
+import referenceseeker.trace as trace
 
 
 def main():
@@ -26,12 +31,21 @@ def main():
     group_workflow.add_argument('--conserved-dna', '-c', action='store', dest='conserved_dna', type=float, default=0.69, help='Conserved DNA threshold (default = 0.69)')
     group_workflow.add_argument('--unfiltered', '-u', action='store_true', help='Set kmer prefilter to extremely conservative values and skip species level ANI cutoffs (ANI >= 0.95 and conserved DNA >= 0.69')
     group_workflow.add_argument('--bidirectional', '-b', action='store_true', help='Compute bidirectional ANI/conserved DNA values (default = False)')
+    group_workflow.add_argument('--top', action='store', type=int, default=None, help='Only report the N best reference genomes and stop aligning as soon as they are known (single/batch, default = all)')
+    group_workflow.add_argument('--expand', action='store_true', help='Expand the best near-duplicate group representatives to their best members (single/batch, default = False)')
 
     group_runtime = parser.add_argument_group('Runtime & auxiliary options')
     group_runtime.add_argument('--help', '-h', action='help', help='Show this help message and exit')
     group_runtime.add_argument('--version', '-V', action='version', version='%(prog)s ' + referenceseeker.__version__)
     group_runtime.add_argument('--verbose', '-v', action='store_true', help='Print verbose information')
     group_runtime.add_argument('--threads', '-t', action='store', type=int, default=mp.cpu_count(), help='Number of used threads (default = number of available CPU cores)')
+    group_runtime.add_argument('--server', action='store', default=None, help='Submit single/cohort requests to a running ReferenceSeeker server (Unix socket path or host:port)')
+    group_runtime.add_argument('--cache-dir', action='store', dest='cache_dir', default=None, help='Directory of a persistent ANI/conserved DNA result cache shared between runs (default = disabled)')
+    group_runtime.add_argument('--cache-size', action='store', dest='cache_size', type=int, default=100, help='Max size in MB of the result cache (default = 100)')
+    group_runtime.add_argument('--index-cache', action='store', dest='index_cache', type=int, default=0, help='Max size in MB of the persistent reference genome nucmer index cache within the database directory (default = 0 = disabled)')
+    group_runtime.add_argument('--trace', action='store', default=None, help='Write wall time, CPU time and memory usage (RSS) of pipeline stages, alignment jobs and external processes to a Chrome trace-event JSON file (default = disabled)')
+    group_runtime.add_argument('--events', action='store', default=None, help='Append a JSON-lines log of Mash hits, alignment jobs and scoring decisions to a file or to an open file descriptor via fd:<N> (default = disabled)')
+    group_runtime.add_argument('--native-mash', action='store_true', dest='native_mash', help='Compute Mash distances in-process on resident database sketches instead of calling "mash dist" (default = False)')
 
     subparsers = parser.add_subparsers(dest='subcommand', help='sub-command help')
     # add "single" sub-command option
@@ -43,11 +57,29 @@ def main():
     # add "cohort" sub-command option
     parser_cohort = subparsers.add_parser('cohort', help='start reference genome search for genome cohort')
     parser_cohort.add_argument('--cohort_genomes', '-cg', metavar='<genome>', action='store', nargs="*", help='Target draft genomes or directory with all draft genomes in fasta format')
-    parser_cohort.add_argument('--algorithm', '-a', action='store', default="product", help='Choose algorithm to calculate best fitting reference genome.')
+    parser_cohort.add_argument('--algorithm', '-a', action='store', default="product", choices=sorted(algorithms.AGGREGATORS), help='Choose algorithm to calculate best fitting reference genome.')
+    parser_cohort.add_argument('--scores', action='store', default=None, help='Directory to write cohort results, raw scores and final scores to as JSON files (default = disabled)')
     parser_cohort.add_argument('--n_mash_results', '-n', action='store', default=100, help="Define the number of mash results that will be used as reference-candidates")
 
+    # add "batch" sub-command option
+    parser_batch = subparsers.add_parser('batch', help='start reference genome searches for many independent genomes')
+    parser_batch.add_argument('--genomes', '-g', metavar='<genomes>', action='store', required=True, help='Directory with draft genomes in fasta format or manifest file listing one genome path per line')
+    parser_batch.add_argument('--output', '-o', action='store', required=True, help='Output directory for result tables (one <genome>.tsv per genome)')
+
+    # add "serve" sub-command option
+    parser_serve = subparsers.add_parser('serve', help='start a persistent server keeping the database resident between requests')
+    group_address = parser_serve.add_mutually_exclusive_group(required=True)
+    group_address.add_argument('--socket', '-s', action='store', default=None, help='Unix socket path to listen on')
+    group_address.add_argument('--port', '-p', action='store', type=int, default=None, help='TCP port to listen on')
+    parser_serve.add_argument('--host', action='store', default='127.0.0.1', help='TCP host address to listen on (default = 127.0.0.1)')
+
     args = parser.parse_args()
 
+    # forward requests to a running server
+    if args.server is not None and args.subcommand in ['single', 'cohort']:
+        server.submit(args)
+        return
+
     # setup global configuration
     config = util.setup_configuration(args)
     util.test_binaries(config)
@@ -67,26 +99,54 @@ def main():
         print("ReferenceSeeker v%s" % referenceseeker.__version__)
         print('Options, parameters and arguments:')
         print("\tuse bundled binaries: %s" % str(config['bundled-binaries']))
+        print("\tnative Mash: %s" % str(config['native_mash']))
+        print("\tindex cache: %d MB" % (config['index_cache'] // (1024 * 1024)))
+        print("\tresult cache: %s" % str(config['cache_dir']))
         print("\tdb path: %s" % str(config['db_path']))
-        print("\tgenome path: %s" % str(config['genome_path']))
+        print("\tgenome path: %s" % str(config.get('genome_path')))
         print("\ttmp path: %s" % str(config['tmp']))
         print("\tunfiltered: %s" % str(config['unfiltered']))
         print("\tbidirectional: %s" % str(config['bidirectional']))
         print("\tANI: %0.2f" % config['ani'])
         print("\tconserved DNA: %0.2f" % config['conserved_dna'])
         print("\t# CRG: %d" % config['crg'])
+        print("\ttop: %s" % str(config['top']))
+        print("\texpand: %s" % str(config['expand']))
         print("\t# threads: %d" % config['threads'])
+        print("\ttrace: %s" % str(args.trace))
+        print("\tevents: %s" % str(args.events))
+
+    events.emit(
+        config,
+        'start',
+        subcommand=args.subcommand,
+        version=referenceseeker.__version__,
+        db=str(config['db_path']),
+        threads=config['threads'],
+        options={option: getattr(args, option) for option in server.REQUEST_OPTIONS if hasattr(args, option)}
+    )
+    status = 'failed'
+    try:
+        if args.subcommand == 'single':
+            single.single(args, config)
+
+        elif args.subcommand == 'cohort':
 
-    if args.subcommand == 'single':
-        single.single(args, config)
+            cohort.cohort(args, config)
 
-    elif args.subcommand == 'cohort':
+        elif args.subcommand == 'batch':
+            batch.batch(args, config)
 
-        cohort.cohort(args, config)
+        elif args.subcommand == 'serve':
+            server.serve(args, config)
 
-    else:
-        parser.print_help()
-        sys.exit("Error: no subcommand provided!")
+        else:
+            parser.print_help()
+            sys.exit("Error: no subcommand provided!")
+        status = 'ok'
+    finally:
+        events.close_log(config, status)
+        trace.write(config)
 
 
 if __name__ == '__main__':
@@ -1,119 +1,401 @@
 
+import concurrent.futures as cf
+import heapq
+import itertools
 import subprocess as sp
 import sys
 
+import referenceseeker.clusters as clusters
 import referenceseeker.constants as rc
+import referenceseeker.dedup as dedup
+import referenceseeker.events as events
+import referenceseeker.shards as shards
+import referenceseeker.sketch as sketch
+import referenceseeker.trace as trace
 
 
-def exec_mash(config, mash_output_path):
-    with mash_output_path.open(mode='w') as fh:
-        cmd = [
-            'mash',
-            'dist',
-            '-d', rc.UNFILTERED_MASH_DIST if config['unfiltered'] else rc.MAX_MASH_DIST,
-            '-p', str(config['threads']),
-            str(config['db_path'].joinpath('db.msh')),
-        ]
-        for genome_path in config["genome_path"]:
-            cmd.append(str(genome_path))
-
-        proc = sp.run(
-            cmd,
-            cwd=str(config['tmp']),
-            env=config['env'],
-            stdout=fh,
-            stderr=sp.PIPE,
-            universal_newlines=True
-        )
-        if proc.returncode != 0:
-            sys.exit("ERROR: failed to execute Mash!\nexit=%d\ncmd=%s" % (proc.returncode, cmd))
-
-
-def parse_mash_results(config, mash_output_path):
-    accession_ids = []
-    mash_distances = {}
-    with mash_output_path.open() as fh:
-        for line in fh:
-            cols = line.rstrip().split()
-            accession_ids.append(cols[0])
-            mash_distances[cols[0]] = float(cols[2])
-    return accession_ids, mash_distances
-
-
-def parse_mash_cohort(config, mash_output_path):
-    """Parses mash cohort output"""
-    single_fasta = []
-    mash_results = []
-    with mash_output_path.open("r") as fh:
-        all_lines = fh.readlines()
-        for i, line in enumerate(all_lines):
-            line = line.split()
-            if i == len(all_lines)-1:  # catch last iteration
-                single_fasta.append(line)
-                mash_results.append(single_fasta)
-            elif not single_fasta:  # catch first iteration
-                single_fasta.append(line)
-            elif line[1] == single_fasta[0][1]:  # if the line is part of the same fasta
-                single_fasta.append(line)
-            else:  # if next fasta
-                mash_results.append(single_fasta)
-                single_fasta = [line]
-
-    # filter mash results for duplicates, save intersection reference hits, delete singles and reduce size of list
-    top_mash_results = []
-    for mash in mash_results:  # filter for best 100 mash results
-        mash = sorted(mash, key=lambda k: k[2], reverse=True)
-        mash = mash[0:config['n_mash_results']]
-        top_mash_results.append(mash)
-    id_list = [ref_genome[0] for ref_genome in top_mash_results[0]]
+def stream_mash(config, max_hits=None, screened=None):
+    """Run Mash and yield its output lines grouped by query genome.
+
+    Lines of single shard databases are yielded while Mash is still computing distances. Shards of
+    multi shard databases are searched concurrently, see search_shards().
+    Clustered databases are searched in two stages, see select_cluster_sketch().
+
+    :param config: a global config object encapsulating global runtime vars
+    :param max_hits: Max number of best hits per query genome used by the caller or None if all hits are used.
+    :param screened: An optional dict to count the hits per query genome, including hits dropped by max_hits.
+    """
+    max_distance = float(rc.UNFILTERED_MASH_DIST if config['unfiltered'] else rc.MAX_MASH_DIST)
+    clusters_index = clusters.load(config)
+    if clusters_index is not None:
+        query_path, cluster_sketch_path = select_cluster_sketch(config, clusters_index, max_distance)
+        sketch_paths = [cluster_sketch_path] if cluster_sketch_path is not None else []
+        query_paths = [query_path]
+    else:
+        sketch_paths = shards.get_shards(config['db_path'])
+        query_paths = config['genome_path']
+    if len(sketch_paths) == 0:
+        return
+    elif len(sketch_paths) == 1:
+        for line in stream_shard(config, sketch_paths[0], query_paths, config['threads'], max_distance):
+            if screened is not None:
+                query_id = line.split('\t', 2)[1]
+                screened[query_id] = screened.get(query_id, 0) + 1
+            yield line
+        return
+
+    best_lines = search_shards(config, sketch_paths, max_distance, max_hits, screened)
+    for lines in best_lines.values():
+        for line in lines:
+            yield line
+
+
+def search_shards(config, sketch_paths, max_distance, max_hits, screened=None):
+    """Search many database shards with at most config['threads'] concurrent Mash processes.
+
+    Query genomes are sketched once and the hits of every shard are reduced to the best max_hits hits
+    per query genome while Mash is still computing distances, so memory is proportional to the number of
+    query genomes times max_hits unless all hits are needed.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param sketch_paths: A list of database sketch file paths.
+    :param max_distance: Maximum distance of reported hits.
+    :param max_hits: Max number of best hits per query genome or None to keep all hits.
+    :param screened: An optional dict to count the hits per query genome, including hits dropped by max_hits.
+
+    :rtype: A dict of Mash output lines per query genome sorted by distance or in database order if all hits are kept.
+    """
+
+    query_path = sketch.sketch_queries(config, config['genome_path'], sketch.read_sketch_params(sketch_paths[0]))
+    workers = max(min(config['threads'], len(sketch_paths)), 1)
+    threads = max(config['threads'] // workers, 1)
+    best_lines = {str(genome_path): [] for genome_path in config['genome_path']}
+    with cf.ThreadPoolExecutor(max_workers=workers) as tpe:
+        futures = [tpe.submit(reduce_shard, config, sketch_path, query_path, threads, max_distance, max_hits) for sketch_path in sketch_paths]
+        for future in futures:  # merge shard hits in database order
+            for query_id, (lines, no_hits) in future.result().items():
+                best_lines[query_id] = select_best_lines(best_lines.get(query_id, []) + lines, max_hits)[0]
+                if screened is not None:
+                    screened[query_id] = screened.get(query_id, 0) + no_hits
+    return best_lines
+
+
+def reduce_shard(config, shard_path, query_path, threads, max_distance, max_hits):
+    """Search a single database shard and reduce its hits to the best max_hits hits per query genome.
+
+    :rtype: A dict of (Mash output lines, number of hits) tuples per query genome.
+    """
+    best_lines = {}
+    lines = stream_shard(config, shard_path, [query_path], threads, max_distance)
+    for query_id, query_lines in itertools.groupby(lines, key=lambda line: line.split('\t', 2)[1]):
+        # merge with best hits of a previous block of the same query genome, if any
+        previous_lines, previous_hits = best_lines.get(query_id, ([], 0))
+        lines, no_screened = select_best_lines(itertools.chain(previous_lines, query_lines), max_hits)
+        best_lines[query_id] = (lines, previous_hits + no_screened - len(previous_lines))
+    return best_lines
+
+
+def select_best_lines(lines, max_hits):
+    """Select the Mash output lines of the best max_hits hits or all lines if max_hits is None.
+
+    :rtype: A list of selected lines and the number of screened lines.
+    """
+    if max_hits is None:
+        lines = list(lines)
+        return lines, len(lines)
+    best_lines, distances, no_screened = select_best_hits(((line, float(line.split('\t', 3)[2])) for line in lines), max_hits)
+    return best_lines, no_screened
+
+
+def select_cluster_sketch(config, clusters_index, max_distance):
+    """Compare query genomes to cluster representatives via Mash and merge member sketches of nearby clusters.
+
+    Query genomes are sketched once for both stages and the member sketches of all clusters selected for any
+    query genome are pasted into a single temporary sketch file, so each stage runs a single Mash process.
+
+    :rtype: Path to the query sketch file and path to the merged member sketch file or None if no cluster has been selected.
+    """
+    query_path = sketch.sketch_queries(config, config['genome_path'], sketch.read_sketch_params(clusters_index['representatives_path']))
+    representative_hits = {}
+    mash_hits = parse_mash_results(stream_shard(config, clusters_index['representatives_path'], [query_path], config['threads'], max_distance + clusters_index['max_radius']))
+    for representative_id, query_id, distance in mash_hits:
+        representative_hits.setdefault(query_id, []).append((representative_id, distance))
+    cluster_paths = []
+    for hits in representative_hits.values():
+        for cluster in clusters.select_clusters(clusters_index, hits, max_distance):
+            if cluster['path'] not in cluster_paths:
+                cluster_paths.append(cluster['path'])
+
+    if len(cluster_paths) == 0:
+        return query_path, None
+    elif len(cluster_paths) == 1:
+        return query_path, cluster_paths[0]
+    cluster_sketch_path = config['tmp'].joinpath('clusters.msh')
+    try:
+        shards.paste_sketches(config, cluster_sketch_path, cluster_paths)
+    except Exception as e:
+        sys.exit("ERROR: %s" % e)
+    return query_path, cluster_sketch_path
+
+
+def stream_shard(config, shard_path, query_paths, threads, max_distance):
+    """Run Mash on a single database shard and yield its output lines while Mash is still computing distances.
+
+    :param query_paths: A list of query genome Fasta file paths or a single query sketch file path.
+    """
+    cmd = [
+        'mash',
+        'dist',
+        '-d', str(max_distance),
+        '-p', str(threads),
+        str(shard_path),
+    ]
+    for query_path in query_paths:
+        cmd.append(str(query_path))
+
+    proc = trace.popen(
+        config,
+        cmd,
+        cwd=str(config['tmp']),
+        env=config['env'],
+        stdout=sp.PIPE,
+        stderr=sp.DEVNULL,
+        universal_newlines=True
+    )
+    try:
+        for line in proc.stdout:
+            yield line
+        proc.stdout.close()
+        trace.wait(config, proc)
+    finally:
+        if proc.poll() is None:  # consumer stopped early
+            proc.kill()
+            proc.wait()
+    if proc.returncode != 0:
+        sys.exit("ERROR: failed to execute Mash!\nexit=%d\ncmd=%s" % (proc.returncode, cmd))
+
+
+def native_dist(config, max_distance):
+    """Compute Mash distances in-process either via cluster representatives or against all database shards."""
+    clusters_index = clusters.load(config)
+    if clusters_index is not None:
+        return clusters.dist(config, clusters_index, max_distance)
+    return sketch.dist(config, sketch.load_database(config, shards.get_shards(config['db_path'])), max_distance)
+
+
+def parse_mash_results(lines):
+    """Parse Mash output lines into (reference id, query id, distance) hits."""
+    for line in lines:
+        cols = line.rstrip().split()
+        yield cols[0], cols[1], float(cols[2])
+
+
+def select_best_hits(mash_hits, max_hits):
+    """Select the best hits by Mash distance keeping at most max_hits hits in memory.
+
+    :param mash_hits: An iterable of (id, distance) tuples.
+    :param max_hits: Max number of best hits to keep.
+
+    :rtype: A list of ids sorted by distance, a dict of distances and the number of screened hits.
+    """
+
+    heap = []  # max-heap of the best hits, ties are resolved in favour of earlier hits
+    no_screened = 0
+    for idx, (ref_genome_id, distance) in enumerate(mash_hits):
+        no_screened += 1
+        item = (-distance, -idx, ref_genome_id)
+        if len(heap) < max_hits:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    best_hits = sorted(heap, reverse=True)
+    screened_ref_genome_ids = [ref_genome_id for _, _, ref_genome_id in best_hits]
+    mash_distances = {ref_genome_id: -distance for distance, _, ref_genome_id in best_hits}
+    return screened_ref_genome_ids, mash_distances, no_screened
+
+
+def parse_mash_cohort(config):
+    """Stream Mash cohort output and select reference genomes among the best hits of every query genome, see select_cohort_hits().
+
+    :param config: a global config object encapsulating global runtime vars
+    """
+
+    # Mash reports hits grouped by query genome
+    screened = {}
+    mash_hits = parse_mash_results(stream_mash(config, config['n_mash_results'], screened))
+    mash_hits_per_query = (
+        (query_id, ((ref_genome_id, distance) for ref_genome_id, _, distance in hits))
+        for query_id, hits in itertools.groupby(mash_hits, key=lambda hit: hit[1])
+    )
+    return select_cohort_hits(config, mash_hits_per_query, screened)
+
+
+def native_mash_cohort(config):
+    """Compute Mash distances of a cohort in-process, e.g. against resident sketches of a server, see select_cohort_hits()."""
+    max_distance = float(rc.UNFILTERED_MASH_DIST if config['unfiltered'] else rc.MAX_MASH_DIST)
+    return select_cohort_hits(config, zip((str(genome_path) for genome_path in config['genome_path']), native_dist(config, max_distance)))
+
+
+def select_cohort_hits(config, mash_hits_per_query, screened=None):
+    """Select reference genomes among the best hits of every query genome.
+
+    Hits are streamed once keeping the best n_mash_results hits per query genome only,
+    so memory is proportional to the number of query genomes times n_mash_results.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param mash_hits_per_query: An iterable of (query id, iterable of (id, distance) tuples) blocks. Blocks of the same query genome are merged.
+    :param screened: An optional dict of hits per query genome of Mash searches reduced to the best hits.
+
+    :rtype: A list of common (id, distance) hits per query genome sorted by distance, a list of common ids
+        sorted by distance to the first query genome and a list of dicts of common hit distances per query genome.
+    """
+
+    best_hits = {str(genome_path): ([], {}, 0) for genome_path in config['genome_path']}
+    for query_id, mash_hits in mash_hits_per_query:
+        # merge with best hits of a previous block of the same query genome, if any
+        previous_ids, previous_distances, previous_screened = best_hits.get(query_id, ([], {}, 0))
+        mash_hits = itertools.chain(((k, previous_distances[k]) for k in previous_ids), mash_hits)
+        screened_ref_genome_ids, mash_distances, no_screened = select_best_hits(mash_hits, config['n_mash_results'])
+        best_hits[query_id] = (screened_ref_genome_ids, mash_distances, previous_screened + no_screened - len(previous_ids))
 
     # filter ids for intersection mash results of every query genome
-    filtered_ids = []
-    for id in id_list:
-        for mash_result in top_mash_results:
-            for (next_ref_genome, _, _, _, _) in mash_result:
-                if next_ref_genome == id:
-                    break  # id is in mash_result
-            else:
-                break  # id is not in mash result
-        else:
-            filtered_ids.append(id)
+    best_hits = [best_hits[str(genome_path)] for genome_path in config['genome_path']]
+    common_ids = set(best_hits[0][0]).intersection(*[screened_ref_genome_ids for screened_ref_genome_ids, _, _ in best_hits[1:]])
+    filtered_ids = [ref_genome_id for ref_genome_id in best_hits[0][0] if ref_genome_id in common_ids]
 
     filtered_mash_results = []
-    for mash_result in top_mash_results:  # sublist containing mash results of query genomes with duplicate ref-genome IDs
-        mash = []
-        for next_ref_genome in mash_result:
-            if next_ref_genome[0] in filtered_ids:
-                mash.append(next_ref_genome)
-        filtered_mash_results.append(mash)
-
-    # build specific output lists for further processing
-    screened_ref_genomes_ids_list = []
     mash_distances_list = []
-    for single_fasta in filtered_mash_results:
-        mash_distances = {}
-        for entry in single_fasta:
-            mash_distances[entry[0]] = float(entry[2])  # 0 = ID, 2 = mash distance
-        mash_distances_list.append(mash_distances)
+    for genome_path, (screened_ref_genome_ids, mash_distances, no_screened) in zip(config['genome_path'], best_hits):
+        filtered_mash_results.append([(ref_genome_id, mash_distances[ref_genome_id]) for ref_genome_id in screened_ref_genome_ids if ref_genome_id in common_ids])
+        mash_distances_list.append({ref_genome_id: mash_distances[ref_genome_id] for ref_genome_id in filtered_ids})
+        if screened is not None:
+            no_screened = screened.get(str(genome_path), no_screened)
+        events.emit(config, 'mash', query=str(genome_path), hits=no_screened, candidates=len(filtered_ids))
     return filtered_mash_results, filtered_ids, mash_distances_list
 
 
-def run_mash(args, config, mash_output_path):
+def run_mash(args, config):
     """calculates genome distances with mash, extracts the hits and filters for the best hits"""
     # calculate genome distances via Mash
     if args.verbose:
         print('\nEstimate genome distances...')
-    exec_mash(config, mash_output_path)
+    duplicates = dedup.load(config)
+    screened = {}  # hits per query genome of Mash searches reduced to the best hits
+    if config['native_mash']:
+        max_distance = float(rc.UNFILTERED_MASH_DIST if config['unfiltered'] else rc.MAX_MASH_DIST)
+        mash_hits = native_dist(config, max_distance)[0]
+    elif duplicates is not None:  # all hits are needed to collapse near-duplicate genomes
+        mash_hits = ((ref_genome_id, distance) for ref_genome_id, _, distance in parse_mash_results(stream_mash(config)))
+    else:
+        mash_hits = ((ref_genome_id, distance) for ref_genome_id, _, distance in parse_mash_results(stream_mash(config, args.crg, screened)))
 
-    # extract hits and store dist
-    screened_ref_genome_ids, mash_distances = parse_mash_results(config, mash_output_path)
-    if args.verbose:
-        print("\tscreened %d potential reference genome(s)" % len(screened_ref_genome_ids))
+    # collapse hits of near-duplicate genomes to their representatives
+    if duplicates is not None:
+        mash_hits, groups = dedup.collapse(duplicates, mash_hits)
 
-    # reduce Mash output to best hits (args.crg)
-    if len(screened_ref_genome_ids) > args.crg:
-        if args.verbose:
+    # reduce Mash output to best hits (args.crg) while streaming hits
+    screened_ref_genome_ids, mash_distances, no_screened = select_best_hits(mash_hits, args.crg)
+    no_screened = screened.get(str(config['genome_path'][0]), no_screened)
+    if duplicates is not None:
+        add_representative_distances(config, [screened_ref_genome_ids], [mash_distances], [groups])
+        add_member_distances(screened_ref_genome_ids, mash_distances, groups)
+    events.emit(config, 'mash', query=str(config['genome_path'][0]), hits=no_screened, candidates=len(screened_ref_genome_ids))
+    if args.verbose:
+        print("\tscreened %d potential reference genome(s)" % no_screened)
+        if no_screened > args.crg:
             print("\treduce to best %d hits..." % args.crg)
-        tmp_screened_ref_genome_ids = sorted(screened_ref_genome_ids, key=lambda k: mash_distances[k])
-        screened_ref_genome_ids = tmp_screened_ref_genome_ids[:args.crg]
     return screened_ref_genome_ids, mash_distances
+
+
+def add_representative_distances(config, screened_ref_genome_ids_list, mash_distances_list, groups_list):
+    """Replace the distances of screened representatives which have not been hit themselves by their own Mash distances.
+
+    Hit groups of near-duplicate genomes are ranked by the distance of their closest genome, see dedup.representative_hits().
+    Representatives hit by their members only are farther away than the max Mash distance and are therefore compared
+    to the query genomes separately, so that reported distances and Mash based estimates refer to the representatives.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param screened_ref_genome_ids_list: A list of screened representative ids per query genome.
+    :param mash_distances_list: A list of dicts of Mash distances per query genome to update.
+    :param groups_list: A list of dicts of hit groups per query genome as returned by dedup.group_hits().
+    """
+
+    representative_ids = []
+    for screened_ref_genome_ids, groups in zip(screened_ref_genome_ids_list, groups_list):
+        for ref_genome_id in screened_ref_genome_ids:
+            if groups[ref_genome_id]['distance'] is None and ref_genome_id not in representative_ids:
+                representative_ids.append(ref_genome_id)
+    if len(representative_ids) == 0:
+        return
+
+    sketch_params = sketch.read_sketch_params(shards.get_shards(config['db_path'])[0])
+    try:
+        clusters.sketch_genomes(config, config['db_path'], config['tmp'], 'representatives.msh', representative_ids, sketch_params)
+    except Exception as e:
+        sys.exit("ERROR: %s" % e)
+    lines = stream_shard(config, config['tmp'].joinpath('representatives.msh'), config['genome_path'], config['threads'], 1.0)
+    distances = {(ref_genome_id, query_id): distance for ref_genome_id, query_id, distance in parse_mash_results(lines)}
+    for genome_path, screened_ref_genome_ids, mash_distances, groups in zip(config['genome_path'], screened_ref_genome_ids_list, mash_distances_list, groups_list):
+        for ref_genome_id in screened_ref_genome_ids:
+            if groups[ref_genome_id]['distance'] is None:
+                mash_distances[ref_genome_id] = distances[(ref_genome_id, str(genome_path))]
+
+
+def add_member_distances(screened_ref_genome_ids, mash_distances, groups):
+    """Add Mash distances of hit near-duplicate members of screened representatives, so results can be expanded to them."""
+    for ref_genome_id in screened_ref_genome_ids:
+        for member_id, distance in groups[ref_genome_id]['members']:
+            mash_distances[member_id] = distance
+
+
+def run_mash_batch(args, config):
+    """calculates genome distances of many independent query genomes within a single Mash run and filters for the best hits per query"""
+    if args.verbose:
+        print('\nEstimate genome distances...')
+    duplicates = dedup.load(config)
+    screened = {}  # hits per query genome of Mash searches reduced to the best hits
+    if config['native_mash']:
+        max_distance = float(rc.UNFILTERED_MASH_DIST if config['unfiltered'] else rc.MAX_MASH_DIST)
+        mash_hits_per_query = zip(config['genome_path'], native_dist(config, max_distance))
+    else:
+        # Mash reports hits grouped by query genome, all hits are needed to collapse near-duplicate genomes
+        mash_hits = parse_mash_results(stream_mash(config) if duplicates is not None else stream_mash(config, args.crg, screened))
+        mash_hits_per_query = (
+            (query_id, ((ref_genome_id, distance) for ref_genome_id, _, distance in hits))
+            for query_id, hits in itertools.groupby(mash_hits, key=lambda hit: hit[1])
+        )
+
+    best_hits = {str(genome_path): ([], {}, 0) for genome_path in config['genome_path']}
+    groups = {str(genome_path): {} for genome_path in config['genome_path']}
+    for query_id, mash_hits in mash_hits_per_query:
+        if duplicates is not None:
+            # group hits of near-duplicate genomes by their representatives, hits are collapsed after the last block
+            dedup.group_hits(duplicates, mash_hits, groups[str(query_id)])
+            continue
+        # merge with best hits of a previous block of the same query genome, if any
+        previous_ids, previous_distances, previous_screened = best_hits[str(query_id)]
+        mash_hits = itertools.chain(((k, previous_distances[k]) for k in previous_ids), mash_hits)
+        screened_ref_genome_ids, mash_distances, no_screened = select_best_hits(mash_hits, args.crg)
+        best_hits[str(query_id)] = (screened_ref_genome_ids, mash_distances, previous_screened + no_screened - len(previous_ids))
+
+    if duplicates is not None:
+        for genome_path in config['genome_path']:
+            best_hits[str(genome_path)] = select_best_hits(dedup.representative_hits(groups[str(genome_path)]), args.crg)
+        add_representative_distances(
+            config,
+            [best_hits[str(genome_path)][0] for genome_path in config['genome_path']],
+            [best_hits[str(genome_path)][1] for genome_path in config['genome_path']],
+            [groups[str(genome_path)] for genome_path in config['genome_path']]
+        )
+
+    results = []
+    for genome_path in config['genome_path']:
+        screened_ref_genome_ids, mash_distances, no_screened = best_hits[str(genome_path)]
+        no_screened = screened.get(str(genome_path), no_screened)
+        if duplicates is not None:
+            add_member_distances(screened_ref_genome_ids, mash_distances, groups[str(genome_path)])
+        events.emit(config, 'mash', query=str(genome_path), hits=no_screened, candidates=len(screened_ref_genome_ids))
+        if args.verbose:
+            print("\t%s: screened %d potential reference genome(s)" % (genome_path.name, no_screened))
+        results.append((screened_ref_genome_ids, mash_distances))
+    return results
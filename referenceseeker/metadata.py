@@ -0,0 +1,124 @@
+import sqlite3
+from contextlib import contextmanager
+
+import referenceseeker.constants as rc
+
+
+SQLITE_MAX_VARIABLES = 500  # stay below the bound parameter limit of older SQLite versions
+
+
+def exists(db_path):
+    """Check whether a database comprises an indexed metadata store."""
+    return db_path.joinpath(rc.METADATA_FILE).is_file()
+
+
+def add_genomes(db_path, ref_genomes):
+    """Add reference genome metadata to the indexed metadata store of a database.
+
+    If the store does not exist yet, it is built from all genomes listed in db.tsv first,
+    so that stores of databases created by former versions are complete.
+
+    :param db_path: Path to the database directory.
+    :param ref_genomes: A list of reference genome dicts comprising id, tax, status, name and length.
+    """
+
+    if not exists(db_path):
+        ref_genomes = list(read_tsv(db_path).values()) + list(ref_genomes)
+    with _connect(db_path) as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO genomes (id, tax, status, name, length) VALUES (?, ?, ?, ?, ?)',
+            [(k['id'], k['tax'], k['status'], k['name'], k['length']) for k in ref_genomes]
+        )
+
+
+def remove_genomes(db_path, ref_genome_ids):
+    """Remove reference genome metadata from the indexed metadata store of a database, e.g. of failed imports.
+
+    :param db_path: Path to the database directory.
+    :param ref_genome_ids: A list of reference genome ids.
+    """
+
+    if not exists(db_path):
+        return
+    ref_genome_ids = list(ref_genome_ids)
+    with _connect(db_path) as conn:
+        for idx in range(0, len(ref_genome_ids), SQLITE_MAX_VARIABLES):
+            chunk = ref_genome_ids[idx:idx + SQLITE_MAX_VARIABLES]
+            conn.execute('DELETE FROM genomes WHERE id IN (%s)' % ','.join('?' * len(chunk)), chunk)
+
+
+def fetch(db_path, ref_genome_ids=None):
+    """Fetch reference genome metadata from the indexed metadata store of a database.
+
+    :param db_path: Path to the database directory.
+    :param ref_genome_ids: A list of reference genome ids or None to fetch all reference genomes.
+
+    :rtype: A dict of reference genome dicts per id in database order.
+    """
+
+    rows = []
+    with _connect(db_path) as conn:
+        if ref_genome_ids is None:
+            rows = conn.execute('SELECT rowid, id, tax, status, name, length FROM genomes').fetchall()
+        else:
+            ref_genome_ids = list(ref_genome_ids)
+            for idx in range(0, len(ref_genome_ids), SQLITE_MAX_VARIABLES):
+                chunk = ref_genome_ids[idx:idx + SQLITE_MAX_VARIABLES]
+                rows.extend(conn.execute(
+                    'SELECT rowid, id, tax, status, name, length FROM genomes WHERE id IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk
+                ).fetchall())
+    ref_genomes = {}
+    for rowid, accession_id, tax, status, name, length in sorted(rows):
+        ref_genomes[accession_id] = {
+            'id': accession_id,
+            'tax': tax,
+            'status': status,
+            'name': name,
+            'length': length
+        }
+    return ref_genomes
+
+
+def read_tsv(db_path, ref_genome_ids=None):
+    """Read reference genome metadata by scanning the db.tsv file of a database.
+
+    :param db_path: Path to the database directory.
+    :param ref_genome_ids: A list of reference genome ids or None to read all reference genomes.
+
+    :rtype: A dict of reference genome dicts per id in database order.
+    """
+
+    if ref_genome_ids is not None:
+        ref_genome_ids = set(ref_genome_ids)
+    ref_genomes = {}
+    with open(str(db_path.joinpath('db.tsv')), 'r') as fh:
+        for line in fh:
+            if line[0] != '#':
+                cols = line.rstrip('\n').split('\t')
+                accession_id = cols[0]
+                if ref_genome_ids is not None and accession_id not in ref_genome_ids:
+                    continue
+                ref_genomes[accession_id] = {
+                    'id': accession_id,
+                    'tax': cols[1],
+                    'status': cols[2],
+                    'name': cols[3],
+                    'length': int(cols[4]) if len(cols) > 4 and cols[4] != '' else None  # missing in older databases
+                }
+    return ref_genomes
+
+
+@contextmanager
+def _connect(db_path):
+    """Open the metadata store and run all statements within a single transaction."""
+    conn = sqlite3.connect(str(db_path.joinpath(rc.METADATA_FILE)), timeout=60)
+    try:
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS genomes ('
+                'id TEXT PRIMARY KEY, tax TEXT, status TEXT, name TEXT, length INTEGER)'
+            )
+            yield conn
+    finally:
+        conn.close()
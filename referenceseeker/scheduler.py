@@ -0,0 +1,254 @@
+import concurrent.futures as cf
+
+import referenceseeker.ani as rani
+import referenceseeker.cache as cache
+import referenceseeker.events as events
+import referenceseeker.trace as trace
+import referenceseeker.util as util
+
+
+IN_FLIGHT_JOBS_PER_THREAD = 2  # bounds the number of submitted but unfinished alignment jobs
+DIRECTIONS = {cache.FORWARD: 'QR', cache.REVERSE: 'RQ'}  # direction names of traces and event logs
+
+
+def align_genomes(args, config, tpe, genome_paths, ref_genome_ids, mash_distances=None):
+    """Align query genomes to reference genomes via a single flat queue of (query, reference, direction) jobs.
+
+    DNA fragments of all query genomes are built in parallel. Alignment jobs of all query genomes
+    share a bounded in-flight window, so workers are kept busy until the very last job. Jobs of
+    large reference genomes are submitted first to avoid long tails. If fewer jobs than threads
+    are left, spare threads are passed to individual nucmer runs. Alignments of a query genome are
+    scored in a single matrix pass as soon as all of its jobs are finished.
+
+    In top mode (config['top']), jobs are submitted in ascending Mash distance order instead. As soon as
+    the best reference genomes of a query genome are known, its remaining jobs are cancelled and only
+    aligned reference genomes are returned. Hence, alignments are scored per batch of finished jobs.
+
+    :param args: parsed command line arguments
+    :param config: a global config object encapsulating global runtime vars
+    :param tpe: a worker pool
+    :param genome_paths: A list of query genome Fasta file paths.
+    :param ref_genome_ids: A list of reference genome ids per query genome.
+    :param mash_distances: A dict of Mash distances per reference genome id for each query genome (required by top mode).
+
+    :rtype: A list comprising a dict of lists of (ANI, conserved DNA) tuples per reference genome for each query genome.
+    """
+
+    top = config.get('top') if mash_distances is not None else None
+    directions = [cache.FORWARD, cache.REVERSE] if args.bidirectional else [cache.FORWARD]
+
+    # build DNA fragments of all query genomes in parallel
+    queries = []
+    for idx, (genome_path, query_ref_genome_ids) in enumerate(zip(genome_paths, ref_genome_ids)):
+        dna_fragments_path = config['tmp'].joinpath('dna-fragments-%d.fasta' % idx)
+        queries.append({
+            'genome_path': genome_path,
+            'ref_genome_ids': query_ref_genome_ids,
+            'mash_distances': mash_distances[idx] if top is not None else None,
+            'directions': directions,
+            'dna_fragments_path': dna_fragments_path,
+            'dna_fragments': trace.submit(config, tpe, 'build_dna_fragments', util.build_dna_fragments, genome_path, dna_fragments_path, query=str(genome_path)),
+            'cached_results': lookup_results(args, config, genome_path, query_ref_genome_ids),
+            'alignments': {cache.FORWARD: [], cache.REVERSE: []},
+            'pending': 0
+        })
+    results = [None] * len(queries)
+
+    jobs = []
+    for idx, query in enumerate(queries):
+        for direction in directions:
+            for ref_genome_id in query['ref_genome_ids']:
+                if ref_genome_id not in query['cached_results'][direction]:
+                    jobs.append((idx, direction, ref_genome_id))
+                    query['pending'] += 1
+        query[cache.FORWARD] = {}
+        query[cache.REVERSE] = {}
+        if query['pending'] == 0 or (top is not None and is_settled(args, config, query, top)):  # all (relevant) results are cached
+            results[idx] = _finish(config, query)
+
+    ref_genome_lengths = _get_genome_lengths(config, jobs)
+    if top is not None:
+        # closest reference genomes first, both directions of a reference genome in a row
+        jobs = sorted(jobs, key=lambda k: queries[k[0]]['mash_distances'][k[2]])
+    else:
+        # longest reference genomes first, queries and directions in order otherwise
+        jobs = sorted(jobs, key=lambda k: ref_genome_lengths[k[2]], reverse=True)
+
+    window = max(IN_FLIGHT_JOBS_PER_THREAD * config['threads'], 1)
+    no_jobs = len(jobs)
+    jobs = iter(jobs)
+    in_flight = {}
+    while True:
+        for idx, direction, ref_genome_id in jobs:
+            no_jobs -= 1
+            if results[idx] is not None:  # query genome finished early
+                continue
+            # pass spare threads to the remaining nucmer runs
+            busy_threads = sum(job[3] for job in in_flight.values())
+            threads = max((config['threads'] - busy_threads) // (no_jobs + 1), 1)
+            job = _submit(config, tpe, queries[idx], direction, ref_genome_id, ref_genome_lengths[ref_genome_id], threads)
+            in_flight[job] = (idx, direction, ref_genome_id, threads)
+            if len(in_flight) >= window:
+                break
+        if len(in_flight) == 0:
+            break
+        done, not_done = cf.wait(in_flight, return_when=cf.FIRST_COMPLETED)
+        finished = set()
+        for f in done:
+            idx, direction, ref_genome_id, threads = in_flight.pop(f)
+            if results[idx] is not None:  # discard alignments of query genomes finished early
+                continue
+            queries[idx]['alignments'][direction].append(f.result())
+            queries[idx]['pending'] -= 1
+            finished.add(idx)
+        for idx in sorted(finished):
+            query = queries[idx]
+            if query['pending'] > 0 and top is None:  # score all alignments of a query genome at once
+                continue
+            _score(config, query)
+            if query['pending'] == 0 or is_settled(args, config, query, top):
+                results[idx] = _finish(config, query)
+                for job, (job_idx, job_direction, job_ref_genome_id, job_threads) in in_flight.items():
+                    if job_idx == idx and job.cancel():
+                        events.emit(config, 'job', job='align', status='cancelled', query=str(query['genome_path']), reference=job_ref_genome_id, direction=DIRECTIONS[job_direction])
+    return results
+
+
+def is_settled(args, config, query, top):
+    """Check whether the best reference genomes of a query genome are known in top mode.
+
+    Mash distances approximate 1 - ANI and conserved DNA values cannot exceed 1. Hence, the search is settled
+    if at least `top` aligned reference genomes pass the thresholds and none of the unaligned reference genomes
+    is expected to exceed the ranking key (see ranking_key()) of the `top`-th best of them.
+
+    :rtype: True if no unaligned reference genome is expected to be among the best reference genomes.
+    """
+
+    keys = []
+    max_unaligned_key = None
+    for ref_genome_id in query['ref_genome_ids']:
+        result = []
+        for direction in query['directions']:
+            if ref_genome_id in query[direction]:
+                result.append(query[direction][ref_genome_id])
+            elif ref_genome_id in query['cached_results'][direction]:
+                result.append(query['cached_results'][direction][ref_genome_id])
+        if len(result) < len(query['directions']):
+            # best reachable key: ANI of missing directions estimated by Mash, conserved DNA of 1
+            expected_ani = 1 - query['mash_distances'][ref_genome_id]
+            key = ranking_key(result + [(expected_ani, 1.0)] * (len(query['directions']) - len(result)))
+            if max_unaligned_key is None or key > max_unaligned_key:
+                max_unaligned_key = key
+        elif passes_thresholds(args, config, result):
+            keys.append(ranking_key(result))
+    if len(keys) < top:
+        return False
+    return max_unaligned_key is None or sorted(keys, reverse=True)[top - 1] >= max_unaligned_key
+
+
+def ranking_key(result):
+    """Compute the ranking key of a reference genome, i.e. the product of ANI and conserved DNA values of all directions.
+
+    :param result: A list of (ANI, conserved DNA) tuples per direction.
+    """
+    key = 1.0
+    for ani, conserved_dna in result:
+        key = key * ani * conserved_dna
+    return key
+
+
+def passes_thresholds(args, config, result):
+    """Check ANI/conserved DNA values of a reference genome against the thresholds.
+
+    :param result: A list of (ANI, conserved DNA) tuples per direction.
+    """
+    if args.unfiltered:
+        return True
+    for ani, conserved_dna in result:
+        if ani < config['ani'] or conserved_dna < config['conserved_dna']:
+            return False
+    return True
+
+
+def log_decisions(args, config, genome_path, results, mash_distances):
+    """Log the threshold decision and ANI/conserved DNA values of each aligned reference genome of a query genome."""
+    if config.get('events') is None:
+        return
+    for ref_genome_id, result in results.items():
+        events.emit(
+            config,
+            'decision',
+            query=str(genome_path),
+            reference=ref_genome_id,
+            mash_distance=mash_distances.get(ref_genome_id),
+            ani=[ani for ani, conserved_dna in result],
+            conserved_dna=[conserved_dna for ani, conserved_dna in result],
+            passed=passes_thresholds(args, config, result)
+        )
+
+
+def _get_genome_lengths(config, jobs):
+    """Get the lengths of all reference genomes of jobs."""
+    ref_genomes = util.read_reference_genomes(config, set(job[2] for job in jobs))
+    return {ref_genome_id: util.get_genome_length(config, ref_genome) for ref_genome_id, ref_genome in ref_genomes.items()}
+
+
+def lookup_results(args, config, genome_path, ref_genome_ids):
+    """Look up results of a query genome in the result cache.
+
+    :rtype: A dict comprising the query key and cached results per direction.
+    """
+
+    query = cache.query_key(config, genome_path)
+    return {
+        'query': query,
+        cache.FORWARD: cache.lookup(config, query, ref_genome_ids, cache.FORWARD),
+        cache.REVERSE: cache.lookup(config, query, ref_genome_ids, cache.REVERSE) if args.bidirectional else {}
+    }
+
+
+def _submit(config, tpe, query, direction, ref_genome_id, length, threads):
+    job_args = {'query': str(query['genome_path']), 'reference': ref_genome_id, 'length': length, 'direction': DIRECTIONS[direction], 'threads': threads}
+    if direction == cache.FORWARD:
+        return trace.submit(config, tpe, 'align', rani.align_query_genome, config, query['dna_fragments_path'], query['dna_fragments'].result(), ref_genome_id, threads, **job_args)
+    else:
+        return trace.submit(config, tpe, 'align', rani.align_reference_genome, config, query['genome_path'], ref_genome_id, threads, **job_args)
+
+
+def _score(config, query):
+    """Compute ANI/conserved DNA values of all pending alignments of a query genome in a single matrix pass per direction.
+
+    Alignment arrays are released right after scoring.
+    """
+    for direction in query['directions']:
+        alignments = query['alignments'][direction]
+        if len(alignments) == 0:
+            continue
+        with trace.stage(config, 'score', direction=DIRECTIONS[direction], genomes=len(alignments)):
+            if direction == cache.FORWARD:
+                ref_genome_ids, alignment_lengths, non_identities = zip(*alignments)
+                dna_fragments = query['dna_fragments'].result()
+            else:
+                ref_genome_ids, dna_fragments, alignment_lengths, non_identities = zip(*alignments)
+                dna_fragments = rani.stack_fragment_arrays(dna_fragments)
+            anis, conserved_dnas = rani.score_alignments(
+                dna_fragments,
+                rani.stack_fragment_arrays(alignment_lengths),
+                rani.stack_fragment_arrays(non_identities)
+            )
+        for ref_genome_id, ani, conserved_dna in zip(ref_genome_ids, anis.tolist(), conserved_dnas.tolist()):
+            query[direction][ref_genome_id] = (ani, conserved_dna)
+        query['alignments'][direction] = []
+
+
+def _finish(config, query):
+    """Store new results of a query genome and merge them with cached results in reference genome order."""
+    cached_results = query['cached_results']
+    results = {}
+    for direction in [cache.FORWARD, cache.REVERSE]:
+        cache.store(config, cached_results['query'], query[direction], direction)
+        query[direction].update(cached_results[direction])
+    for ref_genome_id in query['ref_genome_ids']:
+        if all(ref_genome_id in query[direction] for direction in query['directions']):  # skip unaligned genomes in top mode
+            results[ref_genome_id] = [query[direction][ref_genome_id] for direction in query['directions']]
+    return results
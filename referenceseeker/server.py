@@ -0,0 +1,205 @@
+import argparse
+import concurrent.futures as cf
+import io
+import json
+import shutil
+import socket
+import socketserver
+import sys
+import threading
+from pathlib import Path
+
+import referenceseeker.clusters as clusters
+import referenceseeker.cohort as cohort
+import referenceseeker.constants as rc
+import referenceseeker.dedup as dedup
+import referenceseeker.shards as shards
+import referenceseeker.single as single
+import referenceseeker.sketch as sketch
+import referenceseeker.util as util
+
+
+# options a client may set per request, all others are fixed by the server
+REQUEST_OPTIONS = ['crg', 'ani', 'conserved_dna', 'unfiltered', 'bidirectional', 'top', 'expand', 'n_mash_results', 'algorithm']
+RESIDENT_CONFIG_KEYS = ['env', 'bundled-binaries', 'db_path', 'sketches', 'clusters', 'duplicates', 'ref_genomes', 'executor']
+RESIDENT_DATABASE_KEYS = ['sketches', 'clusters', 'duplicates', 'ref_genomes']  # reloaded as soon as the database changes
+# files replaced by database updates, i.e. import, compact, cluster and dedup
+DATABASE_STATE_FILES = [rc.SHARDS_MANIFEST, 'db.msh', 'db.tsv', rc.METADATA_FILE, rc.DUPLICATES_FILE, '%s/%s' % (rc.CLUSTERS_DIR, rc.CLUSTERS_FILE)]
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Handle a single JSON encoded request per connection and reply with a JSON encoded response."""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+        except ValueError as e:
+            response = {'exit': 1, 'output': '', 'error': 'ERROR: malformed request! (%s)' % e}
+        else:
+            try:
+                response = handle_request(self.server.args, self.server.config, request)
+            except Exception as e:  # always reply, e.g. to requests with options of wrong types
+                response = {'exit': 1, 'output': '', 'error': 'ERROR: request failed! (%s)' % e}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(args, config):
+    """Keep database metadata, sketches and a worker pool resident and answer single/cohort requests."""
+    if args.verbose:
+        print('\nLoad database...')
+    config['native_mash'] = True
+    config['lock'] = threading.Lock()
+    load_database(config)
+    if args.verbose:
+        print("\tloaded %d reference genomes" % len(config['ref_genomes']))
+
+    with cf.ThreadPoolExecutor(max_workers=args.threads) as tpe:
+        config['executor'] = tpe
+        if args.socket is not None:
+            socket_path = Path(args.socket).resolve()
+            server = UnixServer(str(socket_path), RequestHandler)
+            address = str(socket_path)
+        else:
+            socket_path = None
+            server = TCPServer((args.host, args.port), RequestHandler)
+            address = '%s:%d' % (args.host, args.port)
+        server.args = args
+        server.config = config
+        print("ReferenceSeeker server listening on %s" % address, flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if socket_path is not None and socket_path.exists():
+                socket_path.unlink()
+            shutil.rmtree(str(config['tmp']), ignore_errors=True)
+
+
+def load_database(config):
+    """Load database metadata, sketches, clusters and near-duplicates and keep them resident in the global config object."""
+    config['db_state'] = get_database_state(config['db_path'])
+    config['ref_genomes'] = util.read_reference_genomes(config)
+    if clusters.load(config) is None:
+        sketch.load_database(config, shards.get_shards(config['db_path']))
+    dedup.load(config)
+
+
+def refresh_database(config):
+    """Reload resident database objects if the database has been changed since they were loaded, e.g. by new imports.
+
+    :rtype: True if the database has been reloaded.
+    """
+    with config['lock']:
+        if get_database_state(config['db_path']) == config['db_state']:
+            return False
+        for key in RESIDENT_DATABASE_KEYS:
+            config.pop(key, None)
+        load_database(config)
+        return True
+
+
+def get_database_state(db_path):
+    """Get a signature of all database files replaced by database updates."""
+    state = []
+    for file_name in DATABASE_STATE_FILES:
+        try:
+            stat = db_path.joinpath(file_name).stat()
+            state.append((file_name, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            state.append((file_name, None))
+    return state
+
+
+def handle_request(server_args, server_config, request):
+    """Run a single or cohort request against the resident database.
+
+    :param server_args: the server's parsed command line arguments
+    :param server_config: the server's config object comprising resident database objects
+    :param request: A dict comprising the subcommand, genome paths and request options.
+
+    :rtype: A dict comprising the exit code, the tabular output and an optional error message.
+    """
+
+    request_args = argparse.Namespace(**vars(server_args))
+    request_args.verbose = False
+    request_args.trace = None  # traces and event logs are written by standalone runs only
+    request_args.events = None
+    request_args.scores = None
+    request_args.subcommand = request.get('subcommand')
+    for option, value in request.get('options', {}).items():
+        if option in REQUEST_OPTIONS:
+            setattr(request_args, option, value)
+    request_args.genome = request.get('genome')
+    request_args.cohort_genomes = request.get('cohort_genomes')
+
+    out = io.StringIO()
+    config = None
+    try:
+        refresh_database(server_config)
+        config = util.setup_configuration(request_args)
+        config['native_mash'] = True
+        with server_config['lock']:
+            for key in RESIDENT_CONFIG_KEYS:
+                if key in server_config:
+                    config[key] = server_config[key]
+
+        if request_args.subcommand == 'single':
+            single.single(request_args, config, out)
+        elif request_args.subcommand == 'cohort':
+            cohort.cohort(request_args, config, out)
+        else:
+            return {'exit': 1, 'output': '', 'error': 'ERROR: unknown subcommand: %s' % request_args.subcommand}
+    except SystemExit as e:
+        return {'exit': 1, 'output': out.getvalue(), 'error': str(e.code)}
+    finally:
+        if config is not None:
+            shutil.rmtree(str(config['tmp']), ignore_errors=True)
+    return {'exit': 0, 'output': out.getvalue()}
+
+
+def submit(args):
+    """Forward a single or cohort request to a running server and print its output."""
+    request = {
+        'subcommand': args.subcommand,
+        'options': {option: getattr(args, option) for option in REQUEST_OPTIONS if hasattr(args, option)}
+    }
+    if args.subcommand == 'single':
+        request['genome'] = str(Path(args.genome).resolve())
+    elif args.subcommand == 'cohort':
+        request['cohort_genomes'] = [str(Path(genome).resolve()) for genome in args.cohort_genomes]
+
+    address = parse_address(args.server)
+    try:
+        with socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.connect(address)
+            with sock.makefile('rwb') as fh:
+                fh.write((json.dumps(request) + '\n').encode())
+                fh.flush()
+                response = json.loads(fh.readline().decode())
+    except OSError as e:
+        sys.exit("ERROR: could not connect to ReferenceSeeker server at %s! (%s)" % (args.server, e))
+    except ValueError:
+        sys.exit("ERROR: no valid response from ReferenceSeeker server at %s!" % args.server)
+
+    print(response['output'], end='')
+    if response['exit'] != 0:
+        sys.exit(response.get('error', 'ERROR: request failed!'))
+
+
+def parse_address(address):
+    """Parse a server address either as host:port or as a Unix socket path."""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host if host else 'localhost', int(port))
+    return address
@@ -0,0 +1,214 @@
+import os
+import shutil
+import subprocess as sp
+import tempfile
+import time
+from pathlib import Path
+
+import referenceseeker.constants as rc
+import referenceseeker.sketch as sketch
+
+
+def read_manifest(db_path):
+    """Read the sketch shard manifest of a database.
+
+    Databases without a manifest comprise a single shard, i.e. the db.msh file.
+
+    :param db_path: Path to the database directory.
+
+    :rtype: A list of (shard file name relative to the database directory, number of sketches) tuples.
+    """
+
+    manifest_path = db_path.joinpath(rc.SHARDS_MANIFEST)
+    if not manifest_path.is_file():
+        db_sketch_path = db_path.joinpath('db.msh')
+        if db_sketch_path.is_file() and db_sketch_path.stat().st_size > 0:
+            return [('db.msh', len(sketch.read_sketches(db_sketch_path)['ids']))]
+        return []
+    shards = []
+    with manifest_path.open() as fh:
+        for line in fh:
+            if line.strip() != '' and line[0] != '#':
+                cols = line.rstrip('\n').split('\t')
+                shards.append((cols[0], int(cols[1])))
+    return shards
+
+
+def write_manifest(db_path, shards):
+    """Replace the sketch shard manifest of a database at once, so concurrent queries never read partial manifests."""
+    fd, tmp_manifest_path = tempfile.mkstemp(dir=str(db_path), prefix='.tmp-')
+    with os.fdopen(fd, 'w') as fh:
+        for shard_name, no_sketches in shards:
+            fh.write("%s\t%i\n" % (shard_name, no_sketches))
+    os.chmod(tmp_manifest_path, 0o660)
+    os.replace(tmp_manifest_path, str(db_path.joinpath(rc.SHARDS_MANIFEST)))
+
+
+def get_shards(db_path):
+    """Get the sketch shard file paths of a database in database order."""
+    if not db_path.joinpath(rc.SHARDS_MANIFEST).is_file():  # skip counting sketches of legacy databases
+        db_sketch_path = db_path.joinpath('db.msh')
+        return [db_sketch_path] if db_sketch_path.is_file() and db_sketch_path.stat().st_size > 0 else []
+    return [db_path.joinpath(shard_name) for shard_name, no_sketches in read_manifest(db_path)]
+
+
+def add_sketches(config, db_path, sketch_paths):
+    """Add genome sketches to the database.
+
+    New sketches are appended to the last shard if it is still small or stored as a new shard otherwise,
+    so imports never rewrite large parts of the database.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param db_path: Path to the database directory.
+    :param sketch_paths: A list of genome sketch file paths.
+    """
+
+    shards = read_manifest(db_path)
+    # the legacy sketch file of databases without a manifest is kept unchanged
+    if len(shards) > 0 and shards[-1][0] != 'db.msh' and shards[-1][1] + len(sketch_paths) <= rc.SMALL_SHARD_SIZE:
+        shard_name, no_sketches = shards.pop()
+        sketch_paths = [db_path.joinpath(shard_name)] + list(sketch_paths)
+        no_sketches += len(sketch_paths) - 1
+    else:
+        shard_name = new_shard_name(db_path)
+        no_sketches = len(sketch_paths)
+    paste_sketches(config, db_path.joinpath(shard_name), sketch_paths)
+    write_manifest(db_path, shards + [(shard_name, no_sketches)])
+
+
+def compact(config, db_path, shard_size):
+    """Merge consecutive shards into shards of at most shard_size sketches.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param db_path: Path to the database directory.
+    :param shard_size: Max number of sketches per merged shard.
+
+    :rtype: The number of shards before and after compaction.
+    """
+
+    shards = read_manifest(db_path)
+    groups = []
+    for shard_name, no_sketches in shards:
+        if len(groups) > 0 and sum(k[1] for k in groups[-1]) + no_sketches <= shard_size:
+            groups[-1].append((shard_name, no_sketches))
+        else:
+            groups.append([(shard_name, no_sketches)])
+
+    remove_retired_shards(db_path)
+    compacted_shards = []
+    for group in groups:
+        if len(group) == 1:
+            compacted_shards.append(group[0])
+        else:
+            shard_name = new_shard_name(db_path, [k[0] for k in compacted_shards])
+            paste_sketches(config, db_path.joinpath(shard_name), [db_path.joinpath(k[0]) for k in group])
+            compacted_shards.append((shard_name, sum(k[1] for k in group)))
+    write_manifest(db_path, compacted_shards)
+
+    # merged shards might still be read by queries which have read the former manifest
+    compacted_shard_names = set(k[0] for k in compacted_shards)
+    retire_shards(db_path, [shard_name for shard_name, no_sketches in shards if shard_name not in compacted_shard_names])
+    return len(shards), len(compacted_shards)
+
+
+def retire_shards(db_path, shard_names):
+    """Mark shards no longer listed in the manifest for removal by a later cleanup, see remove_retired_shards()."""
+    if len(shard_names) == 0:
+        return
+    db_path.joinpath(rc.SHARDS_DIR).mkdir(mode=0o770, exist_ok=True)
+    retired_time = time.time()
+    with db_path.joinpath(rc.SHARDS_DIR, rc.RETIRED_SHARDS_FILE).open('a') as fh:
+        fh.write(''.join("%s\t%f\n" % (shard_name, retired_time) for shard_name in shard_names))
+
+
+def remove_retired_shards(db_path, lifetime=rc.RETIRED_SHARD_LIFETIME):
+    """Remove shards which have been retired at least lifetime seconds ago.
+
+    Queries read the manifest once and the listed shards afterwards. Hence, retired shards are kept for a while,
+    so that running queries and servers which have read a former manifest never miss a shard.
+
+    :param db_path: Path to the database directory.
+    :param lifetime: Min number of seconds retired shards are kept.
+
+    :rtype: The number of removed shards.
+    """
+
+    retired_path = db_path.joinpath(rc.SHARDS_DIR, rc.RETIRED_SHARDS_FILE)
+    if not retired_path.is_file():
+        return 0
+    shard_names = set(shard_name for shard_name, no_sketches in read_manifest(db_path))
+    retired_shards = []
+    no_removed = 0
+    with retired_path.open() as fh:
+        for line in fh:
+            shard_name, retired_time = line.rstrip('\n').split('\t')
+            if shard_name in shard_names:  # listed again
+                continue
+            if time.time() - float(retired_time) < lifetime:
+                retired_shards.append((shard_name, retired_time))
+                continue
+            try:
+                db_path.joinpath(shard_name).unlink()
+            except FileNotFoundError:
+                pass
+            no_removed += 1
+
+    fd, tmp_retired_path = tempfile.mkstemp(dir=str(retired_path.parent), prefix='.tmp-')
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(''.join("%s\t%s\n" % retired_shard for retired_shard in retired_shards))
+    os.chmod(tmp_retired_path, 0o660)
+    os.replace(tmp_retired_path, str(retired_path))
+    return no_removed
+
+
+def new_shard_name(db_path, reserved_shard_names=()):
+    """Create a shard file name not used by any existing or reserved shard."""
+    shards_path = db_path.joinpath(rc.SHARDS_DIR)
+    shards_path.mkdir(mode=0o770, exist_ok=True)
+    idx = 0
+    while True:
+        idx += 1
+        shard_name = '%s/shard-%05d.msh' % (rc.SHARDS_DIR, idx)
+        if shard_name not in reserved_shard_names and not db_path.joinpath(shard_name).exists():
+            return shard_name
+
+
+def paste_sketches(config, shard_path, sketch_paths):
+    """Merge sketch files into a single shard file via Mash.
+
+    The shard is built in a temporary directory next to its final path and moved in place at once,
+    so concurrent queries never read partial shards.
+    """
+    tmp_path = Path(tempfile.mkdtemp(dir=str(shard_path.parent), prefix='.tmp-'))
+    try:
+        _paste_sketches(config, tmp_path, sketch_paths)
+        os.chmod(str(tmp_path.joinpath('shard.msh')), 0o660)
+        os.replace(str(tmp_path.joinpath('shard.msh')), str(shard_path))
+    finally:
+        shutil.rmtree(str(tmp_path), ignore_errors=True)
+
+
+def _paste_sketches(config, tmp_path, sketch_paths):
+    if len(sketch_paths) == 1:
+        shutil.copyfile(str(sketch_paths[0]), str(tmp_path.joinpath('shard.msh')))
+    else:
+        sketch_list_path = tmp_path.joinpath('sketches.txt')
+        with sketch_list_path.open('w') as fh:
+            fh.write(''.join("%s\n" % sketch_path for sketch_path in sketch_paths))
+        cmd = [
+            'mash',
+            'paste',
+            '-l',
+            'shard',
+            str(sketch_list_path)
+        ]
+        proc = sp.run(
+            cmd,
+            cwd=str(tmp_path),
+            env=config['env'],
+            stdout=sp.PIPE,
+            stderr=sp.PIPE,
+            universal_newlines=True
+        )
+        if proc.returncode != 0:
+            raise Exception("failed to merge sketches via Mash! exit=%d, cmd=%s" % (proc.returncode, cmd))
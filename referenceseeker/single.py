@@ -1,14 +1,17 @@
 import shutil
 import sys
 
+import referenceseeker.dedup as dedup
 import referenceseeker.mash as mash
-import referenceseeker.ani as rani
+import referenceseeker.scheduler as scheduler
+import referenceseeker.trace as trace
 import referenceseeker.util as util
-import concurrent.futures as cf
 
 
-def single(args, config):
+def single(args, config, out=None):
     """allows single genome analysis"""
+    if out is None:
+        out = sys.stdout
     try:
         config['genome_path'] = [util.check_path(args.genome)]
     except FileNotFoundError:
@@ -19,67 +22,84 @@ def single(args, config):
         sys.exit('ERROR: genome file %s is empty!' % args.genome)
 
     # mash out best hits
-    mash_output_path = config['tmp'].joinpath('mash.out')
-    screened_ref_genome_ids, mash_distances = mash.run_mash(args, config, mash_output_path)
+    with trace.stage(config, 'mash'):
+        screened_ref_genome_ids, mash_distances = mash.run_mash(args, config)
     config['genome_path'] = config['genome_path'][0]  # Reformat genome_path
 
     # get genomes from RefSeq by accessions
-    ref_genomes = util.read_reference_genomes(config)
-    screened_ref_genomes = {k: v for k, v in ref_genomes.items() if k in screened_ref_genome_ids}
-
-    # build dna fragments
-    dna_fragments_path = config['tmp'].joinpath('dna-fragments.fasta')
-    dna_fragments = util.build_dna_fragments(config['genome_path'], dna_fragments_path)
+    ref_genomes = util.read_reference_genomes(config, screened_ref_genome_ids)
+    screened_ref_genome_ids = list(ref_genomes.keys())
 
     # align query fragments to reference genomes and compute ANI/conserved DNA
-    results = {}
     if args.verbose:
         print('\nCompute ANIs...')
-    with cf.ThreadPoolExecutor(max_workers=args.threads) as tpe:
-        futures = []
-        for identifier, ref_genome in screened_ref_genomes.items():
-            futures.append(tpe.submit(rani.align_query_genome, config, dna_fragments_path, dna_fragments, identifier))
-        for f in futures:
-            ref_genome_id, ani, conserved_dna = f.result()
-            results[ref_genome_id] = [(ani, conserved_dna)]
-        # align reference genomes fragments to query genome and compute ANI/conserved DNA
-        if args.bidirectional:
-            if args.verbose:
-                print('\nCompute reverse ANIs...')
-            futures = []
-            for identifier, ref_genome in screened_ref_genomes.items():
-                futures.append(tpe.submit(rani.align_reference_genome, config, config['genome_path'], identifier))
-            for f in futures:
-                ref_genome_id, ani, conserved_dna = f.result()
-                result = results[ref_genome_id]
-                result.append((ani, conserved_dna))
+    with util.thread_pool(config) as tpe, trace.stage(config, 'align', references=len(screened_ref_genome_ids)):
+        results = scheduler.align_genomes(args, config, tpe, [config['genome_path']], [screened_ref_genome_ids], [mash_distances])[0]
+        if config.get('expand'):
+            member_ids = expand_duplicates(args, config, tpe, [config['genome_path']], [results], [mash_distances])
+            ref_genomes.update(util.read_reference_genomes(config, member_ids))
 
     # remove tmp dir
     shutil.rmtree(str(config['tmp']))
 
-    # filter and sort results
-    filtered_reference_ids = []
-    for ref_genome_id, result in results.items():
-        if args.unfiltered:
-            filtered_reference_ids.append(ref_genome_id)
-        else:
-            if args.bidirectional:
-                query_ref = result[0]
-                ref_query = result[1]
-                if((query_ref[0] >= config['ani']) and (query_ref[1] >= config['conserved_dna'])
-                        and (ref_query[0] >= config['ani']) and (ref_query[1] >= config['conserved_dna'])):
-                    filtered_reference_ids.append(ref_genome_id)
-            else:
-                (ani, conserved_dna) = result[0]
-                if (conserved_dna >= config['conserved_dna']) and (ani >= config['ani']):
-                    filtered_reference_ids.append(ref_genome_id)
-
-    # sort and print results according to ANI * conserved DNA values
+    scheduler.log_decisions(args, config, config['genome_path'], results, mash_distances)
+    print_results(args, config, results, mash_distances, ref_genomes, out)
+
+
+def expand_duplicates(args, config, tpe, genome_paths, results_list, mash_distances_list):
+    """Expand results of query genomes to the best near-duplicate members of their best representatives.
+
+    Hit members of representatives passing the thresholds are aligned in ascending Mash distance order,
+    at most args.crg members per query genome, and added to the results in place.
+
+    :param args: parsed command line arguments
+    :param config: a global config object encapsulating global runtime vars
+    :param tpe: a worker pool
+    :param genome_paths: A list of query genome Fasta file paths.
+    :param results_list: A list comprising a dict of results per reference genome for each query genome.
+    :param mash_distances_list: A list comprising a dict of Mash distances per reference genome for each query genome.
+
+    :rtype: A set of all expanded member ids.
+    """
+
+    duplicates = dedup.load(config)
+    if duplicates is None:
+        return set()
+    member_ids_list = []
+    for results, mash_distances in zip(results_list, mash_distances_list):
+        member_hits = []
+        for representative_id in rank_results(args, config, results):
+            for member_id in duplicates['members'].get(representative_id, []):
+                if member_id in mash_distances:
+                    member_hits.append((mash_distances[member_id], member_id))
+        member_ids_list.append([member_id for distance, member_id in sorted(member_hits)[:args.crg]])
+    if args.verbose:
+        print("\texpand results to %d near-duplicate member(s)..." % sum(len(member_ids) for member_ids in member_ids_list))
+    member_results_list = scheduler.align_genomes(args, config, tpe, genome_paths, member_ids_list)
+    for results, member_results in zip(results_list, member_results_list):
+        results.update(member_results)
+    return set(member_id for member_ids in member_ids_list for member_id in member_ids)
+
+
+def rank_results(args, config, results):
+    """Filter results by thresholds and sort them according to ANI * conserved DNA values.
+
+    :rtype: A list of reference genome ids, at most config['top'] ids in top mode.
+    """
+    filtered_reference_ids = [k for k, result in results.items() if scheduler.passes_thresholds(args, config, result)]
+    filtered_reference_ids = sorted(filtered_reference_ids, key=lambda k: scheduler.ranking_key(results[k]), reverse=True)
+    if config.get('top') is not None:
+        filtered_reference_ids = filtered_reference_ids[:config['top']]
+    return filtered_reference_ids
+
+
+def print_results(args, config, results, mash_distances, ref_genomes, out):
+    """Filter, sort and print results according to ANI * conserved DNA values."""
+    filtered_reference_ids = rank_results(args, config, results)
     if args.bidirectional:
-        filtered_reference_ids = sorted(filtered_reference_ids, key=lambda k: (results[k][0][0] * results[k][0][1] * results[k][1][0] * results[k][1][1]), reverse=True)
         if args.verbose:
             print('')
-        print('#ID\tMash Distance\tQR ANI\tQR Con. DNA\tRQ ANI\tRQ Con. DNA\tTaxonomy ID\tAssembly Status\tOrganism')
+        print('#ID\tMash Distance\tQR ANI\tQR Con. DNA\tRQ ANI\tRQ Con. DNA\tTaxonomy ID\tAssembly Status\tOrganism', file=out)
         for id in filtered_reference_ids:  # print results to STDOUT
             ref_genome = ref_genomes[id]
             result = results[id]
@@ -95,13 +115,13 @@ def single(args, config):
                     ref_genome['tax'],
                     ref_genome['status'],
                     ref_genome['name']
-                )
+                ),
+                file=out
             )
     else:
-        filtered_reference_ids = sorted(filtered_reference_ids, key=lambda k: (results[k][0][0] * results[k][0][1]), reverse=True)
         if args.verbose:
             print('')
-        print('#ID\tMash Distance\tANI\tCon. DNA\tTaxonomy ID\tAssembly Status\tOrganism')
+        print('#ID\tMash Distance\tANI\tCon. DNA\tTaxonomy ID\tAssembly Status\tOrganism', file=out)
         for id in filtered_reference_ids:  # print results to STDOUT
             ref_genome = ref_genomes[id]
             result = results[id][0]
@@ -115,5 +135,6 @@ def single(args, config):
                     ref_genome['tax'],
                     ref_genome['status'],
                     ref_genome['name']
-                )
+                ),
+                file=out
             )
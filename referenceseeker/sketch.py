@@ -0,0 +1,301 @@
+import concurrent.futures as cf
+import math
+import subprocess as sp
+import sys
+
+import numpy as np
+
+import referenceseeker.trace as trace
+
+
+MASH_HASH_SEED = 42
+DISTANCE_CHUNK_SIZE = 256  # number of database sketches compared per vectorized step
+
+
+def read_sketches(sketch_path):
+    """Read a Mash sketch file into contiguous hash arrays.
+
+    Mash stores sketches as an unpacked Cap'n Proto message. Only the parts needed for distance
+    estimations are decoded: sketch parameters, names, genome lengths and the sorted min-hashes.
+
+    :param sketch_path: Path to a Mash sketch (.msh) file.
+
+    :rtype: A dict comprising sketch parameters, ids, lengths, a 2-D hash array and per sketch hash counts.
+    """
+
+    with open(str(sketch_path), 'rb') as fh:
+        buffer = fh.read()
+    segments = _read_segments(buffer)
+
+    root = _follow(segments, 0, 0)
+    if root is None:
+        raise ValueError('empty sketch file: %s' % sketch_path)
+    root_seg, root_pos, root_ptr = root
+    data_words = (root_ptr >> 32) & 0xffff
+    kmer_size, sketch_size, hash_seed = _read_params(segments[root_seg][root_pos:root_pos + data_words])
+
+    # reference list is the first struct pointer of the root struct comprising a non-empty reference list
+    references = []
+    for ptr_idx in range(2):
+        reference_list = _follow(segments, root_seg, root_pos + data_words + ptr_idx)
+        if reference_list is not None:
+            seg, pos, ptr = reference_list
+            references = _read_struct_list(segments, seg, pos + ((ptr >> 32) & 0xffff))
+            if len(references) > 0:
+                break
+
+    ids = []
+    lengths = np.zeros(len(references), dtype=np.uint64)
+    counts = np.zeros(len(references), dtype=np.int64)
+    hash_arrays = []
+    for idx, (seg, pos, data_words, ptr_words) in enumerate(references):
+        data = segments[seg][pos:pos + data_words]
+        length = int(data[1]) if data_words > 1 else 0  # length64
+        lengths[idx] = length if length > 0 else int(data[0]) & 0xffffffff
+        ptr_pos = pos + data_words
+        ids.append(_read_text(segments, seg, ptr_pos + 2))
+        hashes = _read_primitive_list(segments, seg, ptr_pos + 5) if ptr_words > 5 else None  # hashes64
+        if hashes is None or len(hashes) == 0:
+            hashes = _read_primitive_list(segments, seg, ptr_pos + 4)  # hashes32
+        if hashes is None:
+            hashes = np.zeros(0, dtype=np.uint64)
+        counts[idx] = len(hashes)
+        hash_arrays.append(hashes)
+
+    width = max(sketch_size, int(counts.max()) if len(counts) > 0 else 0)
+    matrix = np.full((len(hash_arrays), width), np.iinfo(np.uint64).max, dtype=np.uint64)
+    for idx, hashes in enumerate(hash_arrays):
+        matrix[idx, :len(hashes)] = hashes
+
+    return {
+        'kmer': kmer_size,
+        'size': sketch_size,
+        'seed': hash_seed,
+        'ids': ids,
+        'lengths': lengths,
+        'counts': counts,
+        'hashes': matrix
+    }
+
+
+def read_sketch_params(sketch_path):
+    """Read the sketch parameters of a Mash sketch file without decoding its sketches.
+
+    :param sketch_path: Path to a Mash sketch (.msh) file.
+
+    :rtype: A (k-mer size, sketch size, hash seed) tuple.
+    """
+
+    with open(str(sketch_path), 'rb') as fh:
+        header = fh.read(4)
+        if len(header) < 4:
+            raise ValueError('empty sketch file: %s' % sketch_path)
+        segment_count = int(np.frombuffer(header, dtype='<u4', count=1)[0]) + 1
+        offset = 4 * (segment_count + 1)
+        offset += offset % 8
+        fh.seek(offset)
+        root_ptr = int(np.frombuffer(fh.read(8), dtype='<u8', count=1)[0])
+        if root_ptr == 0 or (root_ptr & 3) != 0:  # far root pointers are resolved by decoding the whole file
+            sketches = read_sketches(sketch_path)
+            return sketches['kmer'], sketches['size'], sketches['seed']
+        root_offset = (root_ptr & 0xffffffff) >> 2
+        data_words = min((root_ptr >> 32) & 0xffff, 3)
+        fh.seek(offset + 8 * (1 + root_offset))
+        return _read_params(np.frombuffer(fh.read(8 * data_words), dtype='<u8', count=data_words))
+
+
+def _read_params(root_data):
+    data_words = len(root_data)
+    kmer_size = int(root_data[0]) & 0xffffffff if data_words > 0 else 0
+    sketch_size = int(root_data[1]) & 0xffffffff if data_words > 1 else 0
+    hash_seed = ((int(root_data[2]) >> 32) ^ MASH_HASH_SEED) if data_words > 2 else MASH_HASH_SEED
+    return kmer_size, sketch_size, hash_seed
+
+
+def compute_distances(sketches, query_hashes, max_distance=1.0):
+    """Compute Mash distances between a query sketch and all sketches of a database.
+
+    Shared hashes are counted via vectorized sorted merges exactly as Mash does,
+    i.e. only among the smallest 'sketch size' hashes of the union of both sketches.
+
+    :param sketches: A dict of database sketches as returned by read_sketches().
+    :param query_hashes: A sorted 1-D array of query sketch hashes.
+    :param max_distance: Maximum distance of reported hits.
+
+    :rtype: A list of (id, distance) tuples in database order.
+    """
+
+    query_hashes = np.asarray(query_hashes, dtype=np.uint64)
+    query_count = len(query_hashes)
+    sketch_size = sketches['size']
+    distances = np.ones(len(sketches['ids']), dtype=np.float64)
+    if query_count == 0 or len(distances) == 0:
+        return []
+
+    width = sketches['hashes'].shape[1]
+    columns = np.arange(width, dtype=np.int64)
+    for start in range(0, len(distances), DISTANCE_CHUNK_SIZE):
+        hashes = sketches['hashes'][start:start + DISTANCE_CHUNK_SIZE]
+        counts = sketches['counts'][start:start + DISTANCE_CHUNK_SIZE]
+        positions = np.searchsorted(query_hashes, hashes)
+        valid = columns < counts[:, None]
+        shared = valid & (query_hashes[np.minimum(positions, query_count - 1)] == hashes)
+        shared_before = np.cumsum(shared, axis=1) - shared
+        union_rank = columns + positions - shared_before  # number of smaller hashes in the union of both sketches
+        common = np.count_nonzero(shared & (union_rank < sketch_size), axis=1)
+        denom = np.minimum(counts + query_count - np.count_nonzero(shared, axis=1), sketch_size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            jaccard = common / denom
+            chunk_distances = 0.0 - np.log(2 * jaccard / (1 + jaccard)) / sketches['kmer']
+        distances[start:start + len(hashes)] = np.where(common > 0, chunk_distances, 1.0)
+
+    return [(sketches['ids'][idx], float(distances[idx])) for idx in np.flatnonzero(distances <= max_distance)]
+
+
+def sketch_genomes(config, genome_paths, sketches):
+    """Sketch query genomes with the same parameters as a given database sketch.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param genome_paths: A list of query genome Fasta file paths.
+    :param sketches: A dict of database sketches as returned by read_sketches().
+
+    :rtype: A dict of query sketches as returned by read_sketches().
+    """
+
+    return read_sketches(sketch_queries(config, genome_paths, (sketches['kmer'], sketches['size'], sketches['seed'])))
+
+
+def sketch_queries(config, genome_paths, sketch_params):
+    """Sketch query genomes once into a sketch file which can be compared to many database sketch files.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param genome_paths: A list of query genome Fasta file paths.
+    :param sketch_params: A (k-mer size, sketch size, hash seed) tuple of the database sketches.
+
+    :rtype: Path to the query sketch file.
+    """
+
+    kmer_size, sketch_size, hash_seed = sketch_params
+    cmd = [
+        'mash',
+        'sketch',
+        '-o', 'query',
+        '-k', str(kmer_size),
+        '-s', str(sketch_size),
+        '-S', str(hash_seed),
+        '-p', str(config['threads'])
+    ]
+    for genome_path in genome_paths:
+        cmd.append(str(genome_path))
+    proc = trace.popen(
+        config,
+        cmd,
+        cwd=str(config['tmp']),
+        env=config['env'],
+        stdout=sp.DEVNULL,
+        stderr=sp.DEVNULL
+    )
+    if trace.wait(config, proc) != 0:
+        sys.exit("ERROR: failed to create query kmer sketches via Mash!\nexit=%d\ncmd=%s" % (proc.returncode, cmd))
+    return config['tmp'].joinpath('query.msh')
+
+
+def load_database(config, shard_paths):
+    """Load database sketches of all shards once and keep them in the global config object."""
+    if 'sketches' not in config:
+        config['sketches'] = [read_sketches(shard_path) for shard_path in shard_paths]
+    return config['sketches']
+
+
+def dist(config, shard_sketches, max_distance):
+    """Compute Mash distances of all query genomes against all database shards in-process.
+
+    Shards are searched concurrently and their hits are concatenated in database order.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param shard_sketches: A list of database shard sketches as returned by load_database().
+    :param max_distance: Maximum distance of reported hits.
+
+    :rtype: A list comprising a list of (id, distance) tuples per query genome.
+    """
+
+    if len(shard_sketches) == 0:
+        return [[] for genome_path in config['genome_path']]
+    query_sketches = sketch_genomes(config, config['genome_path'], shard_sketches[0])
+    with cf.ThreadPoolExecutor(max_workers=max(min(config['threads'], len(shard_sketches) * len(query_sketches['ids'])), 1)) as tpe:
+        futures = []
+        for idx in range(len(query_sketches['ids'])):
+            query_hashes = query_sketches['hashes'][idx, :query_sketches['counts'][idx]]
+            futures.append([tpe.submit(compute_distances, sketches, query_hashes, max_distance) for sketches in shard_sketches])
+        return [[hit for future in query_futures for hit in future.result()] for query_futures in futures]
+
+
+def _read_segments(buffer):
+    segment_count = int(np.frombuffer(buffer, dtype='<u4', count=1)[0]) + 1
+    segment_sizes = np.frombuffer(buffer, dtype='<u4', count=segment_count, offset=4)
+    offset = 4 * (segment_count + 1)
+    offset += offset % 8
+    segments = []
+    for size in segment_sizes:
+        segments.append(np.frombuffer(buffer, dtype='<u8', count=int(size), offset=offset))
+        offset += int(size) * 8
+    return segments
+
+
+def _follow(segments, seg, pos):
+    """Resolve the pointer at a word position following far pointers.
+
+    :rtype: (segment, target word position, pointer) or None for null pointers.
+    """
+
+    ptr = int(segments[seg][pos])
+    if ptr == 0:
+        return None
+    if (ptr & 3) == 2:  # far pointer
+        landing_seg = ptr >> 32
+        landing_pos = (ptr >> 3) & 0x1fffffff
+        if ((ptr >> 2) & 1) == 0:
+            return _follow(segments, landing_seg, landing_pos)
+        far_ptr = int(segments[landing_seg][landing_pos])
+        tag = int(segments[landing_seg][landing_pos + 1])
+        return far_ptr >> 32, (far_ptr >> 3) & 0x1fffffff, tag
+    offset = (ptr & 0xffffffff) >> 2
+    if offset & (1 << 29):  # signed 30 bit offset
+        offset -= 1 << 30
+    return seg, pos + 1 + offset, ptr
+
+
+def _read_struct_list(segments, seg, pos):
+    target = _follow(segments, seg, pos)
+    if target is None:
+        return []
+    seg, pos, ptr = target
+    tag = int(segments[seg][pos])
+    element_count = (tag & 0xffffffff) >> 2
+    data_words = (tag >> 32) & 0xffff
+    ptr_words = tag >> 48
+    element_size = data_words + ptr_words
+    return [(seg, pos + 1 + idx * element_size, data_words, ptr_words) for idx in range(element_count)]
+
+
+def _read_primitive_list(segments, seg, pos):
+    target = _follow(segments, seg, pos)
+    if target is None:
+        return None
+    seg, pos, ptr = target
+    element_size = (ptr >> 32) & 7
+    count = ptr >> 35
+    if element_size == 5:  # 64 bit
+        return segments[seg][pos:pos + count]
+    elif element_size == 4:  # 32 bit
+        return segments[seg][pos:pos + (count + 1) // 2].view('<u4')[:count].astype(np.uint64)
+    raise ValueError('unexpected hash list element size: %d' % element_size)
+
+
+def _read_text(segments, seg, pos):
+    target = _follow(segments, seg, pos)
+    if target is None:
+        return ''
+    seg, pos, ptr = target
+    count = ptr >> 35
+    return segments[seg][pos:pos + math.ceil(count / 8)].tobytes()[:count].rstrip(b'\x00').decode()
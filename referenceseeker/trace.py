@@ -0,0 +1,180 @@
+import json
+import os
+import resource
+import subprocess as sp
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import referenceseeker.events as events
+
+
+def create(trace_path):
+    """Create a tracer recording pipeline stages, worker pool jobs and external processes.
+
+    :param trace_path: Path of the Chrome trace-event JSON file to write or None to disable tracing.
+
+    :rtype: A tracer dict or None if tracing is disabled.
+    """
+
+    if trace_path is None:
+        return None
+    return {
+        'path': Path(trace_path).resolve(),
+        'start': time.perf_counter(),
+        'events': [],
+        'threads': {},
+        'lock': threading.Lock()
+    }
+
+
+@contextmanager
+def stage(config, name, **args):
+    """Record wall time, CPU time and RSS of a pipeline stage.
+
+    The RSS is sampled at the start and end of the stage. As the peak RSS is recorded for the whole process only,
+    it is stored as the process' peak so far rather than as the stage's peak.
+    """
+    tracer = config.get('trace')
+    if tracer is None:
+        yield
+        return
+    start, cpu_start, rss_start = time.perf_counter(), time.process_time(), _current_rss()
+    try:
+        yield
+    finally:
+        args['cpu_ms'] = (time.process_time() - cpu_start) * 1000
+        args['rss_start_kb'] = rss_start
+        args['rss_end_kb'] = _current_rss()
+        args['process_max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        _add_event(tracer, name, 'stage', start, time.perf_counter(), args)
+
+
+def submit(config, tpe, name, fn, *fn_args, **args):
+    """Submit a job to a worker pool recording its queue wait and run time.
+
+    Jobs are recorded in the trace and in the event log, if enabled.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param tpe: a worker pool
+    :param name: the job's event name
+    :param fn: the job's function called with fn_args
+    :param args: additional event arguments, e.g. reference genome ids
+
+    :rtype: the job's future
+    """
+
+    tracer = config.get('trace')
+    if tracer is None and config.get('events') is None:
+        return tpe.submit(fn, *fn_args)
+    submitted = time.perf_counter()
+
+    def job():
+        start = time.perf_counter()
+        cpu_start = _thread_time()
+        status = 'failed'
+        try:
+            result = fn(*fn_args)
+            status = 'ok'
+            return result
+        except SystemExit as e:  # failed external processes
+            args['error'] = str(e.code)
+            raise
+        except Exception as e:
+            args['error'] = str(e)
+            raise
+        finally:
+            end = time.perf_counter()
+            args['queue_wait_ms'] = round((start - submitted) * 1000, 3)
+            args['cpu_ms'] = round((_thread_time() - cpu_start) * 1000, 3)
+            if tracer is not None:
+                _add_event(tracer, name, 'job', start, end, dict(args, status=status))
+            events.emit(config, 'job', job=name, status=status, run_ms=round((end - start) * 1000, 3), **args)
+    return tpe.submit(job)
+
+
+def popen(config, cmd, **kwargs):
+    """Start an external process keeping its start time for tracing, see wait()."""
+    start = time.perf_counter()
+    proc = sp.Popen(cmd, **kwargs)
+    proc.trace_start = start
+    return proc
+
+
+def wait(config, proc):
+    """Wait for an external process started via popen() and record its wall time, CPU time and peak RSS.
+
+    :rtype: the process' exit code
+    """
+
+    tracer = config.get('trace')
+    if tracer is None or proc.returncode is not None:
+        return proc.wait()
+    try:
+        pid, status, rusage = os.wait4(proc.pid, 0)  # resource usage of this very process only
+    except ChildProcessError:  # already reaped
+        return proc.wait()
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    cmd = [str(arg) for arg in proc.args]
+    name = Path(cmd[0]).name
+    if len(cmd) > 1 and cmd[1][0] != '-':  # sub-command, e.g. mash dist
+        name = '%s %s' % (name, cmd[1])
+    args = {
+        'cmd': ' '.join(cmd),
+        'exit': proc.returncode,
+        'cpu_ms': (rusage.ru_utime + rusage.ru_stime) * 1000,
+        'max_rss_kb': rusage.ru_maxrss
+    }
+    _add_event(tracer, name, 'process', proc.trace_start, time.perf_counter(), args, pid=proc.pid)
+    return proc.returncode
+
+
+def write(config):
+    """Write all recorded events as Chrome trace-event JSON file."""
+    tracer = config.get('trace')
+    if tracer is None:
+        return
+    pid = os.getpid()
+    with tracer['lock']:
+        trace_events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': 'referenceseeker'}}]
+        for tid, thread_name in sorted(tracer['threads'].items()):
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+        for event in tracer['events']:
+            if event['pid'] != pid:
+                trace_events.append({'name': 'process_name', 'ph': 'M', 'pid': event['pid'], 'tid': event['tid'], 'args': {'name': event['name']}})
+        trace_events.extend(tracer['events'])
+    with tracer['path'].open('w') as fh:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, fh)
+
+
+def _add_event(tracer, name, category, start, end, args, pid=None):
+    thread = threading.current_thread()
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': (start - tracer['start']) * 1000000,
+        'dur': (end - start) * 1000000,
+        'pid': os.getpid() if pid is None else pid,
+        'tid': thread.ident if pid is None else pid,
+        'args': args
+    }
+    with tracer['lock']:
+        tracer['events'].append(event)
+        if pid is None:
+            tracer['threads'][thread.ident] = thread.name
+
+
+def _current_rss():
+    """Current RSS of this process in KB if supported (Linux) or None otherwise."""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _thread_time():
+    """CPU time of the current thread if supported (Python >= 3.7) or of the whole process otherwise."""
+    return time.thread_time() if hasattr(time, 'thread_time') else time.process_time()
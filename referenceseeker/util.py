@@ -1,92 +1,179 @@
 
+import concurrent.futures as cf
+import hashlib
+import json
 import os
+import shutil
 import subprocess as sp
 import sys
 import tempfile
+from contextlib import contextmanager
 from pathlib import Path
 
-from Bio import SeqIO
+import numpy as np
 
 import referenceseeker.constants as rc
+import referenceseeker.events as events
+import referenceseeker.metadata as metadata
+import referenceseeker.trace as trace
 
 
-def read_reference_genomes(config):
-    ref_genomes = {}
-    with open(str(config['db_path'].joinpath('db.tsv')), 'r') as fh:
-        for line in fh:
-            if line[0] != '#':
-                cols = line.strip().split('\t')
-                accession_id = cols[0]
-                ref_genomes[accession_id] = {
-                    'id': accession_id,
-                    'tax': cols[1],
-                    'status': cols[2],
-                    'name': cols[3]
-                }
-    return ref_genomes
+READ_BLOCK_SIZE = 1024 * 1024  # max number of bytes of genome files read at once
+SEQUENCE_WHITESPACE = b' \t\r\n\x0b\x0c'
+BINARIES = [  # necessary 3rd party executables and their test commands
+    ('Mash', ['mash', 'dist', '-h']),
+    ('nucmer', ['nucmer', '--help'])
+]
+
+
+def read_reference_genomes(config, ref_genome_ids=None):
+    """Read reference genome metadata from the indexed metadata store or db.tsv.
+
+    :param config: a global config object encapsulating global runtime vars
+    :param ref_genome_ids: A list of reference genome ids to fetch or None to read all reference genomes.
+
+    :rtype: A dict of reference genome dicts per id in database order.
+    """
+
+    if 'ref_genomes' in config:  # resident database metadata, e.g. in server mode
+        if ref_genome_ids is None:
+            return config['ref_genomes']
+        ref_genome_ids = set(ref_genome_ids)
+        return {k: v for k, v in config['ref_genomes'].items() if k in ref_genome_ids}
+    with trace.stage(config, 'read_reference_genomes'):
+        if metadata.exists(config['db_path']):
+            return metadata.fetch(config['db_path'], ref_genome_ids)
+        return metadata.read_tsv(config['db_path'], ref_genome_ids)  # databases without a metadata store
+
+
+def get_genome_length(config, ref_genome):
+    """Get the length of a reference genome from the database metadata or estimate it by its Fasta file size."""
+    if ref_genome['length'] is not None:
+        return ref_genome['length']
+    return config['db_path'].joinpath("%s.fna" % ref_genome['id']).stat().st_size
 
 
 def build_dna_fragments(genome_path, dna_fragments_path):
     """Build DNA fragments.
 
+    The genome is streamed in blocks and fragments are written while reading, so runtime is linear
+    and memory is constant in sequence length.
+
     :param genome_path: Path to source DNA Fasta file.
     :param dna_fragments_path: Path to DNA fragments output Fasta file.
 
-    :rtype {idx, dna_fragment}: A dict containing index and DNA fragment objects.
+    :rtype np.ndarray: An array of DNA fragment lengths indexed by fragment id - 1.
     """
 
-    dna_fragments = {}
-    dna_fragment_idx = 0
-    with dna_fragments_path.open(mode='w') as fh:
-        try:
-            for record in SeqIO.parse(str(genome_path), 'fasta'):
-                sequence = str(record.seq)
-                while len(sequence) > (rc.FRAGMENT_SIZE + rc.MIN_FRAGMENT_SIZE):  # forestall fragments shorter than MIN_FRAGMENT_SIZE
-                    dna_fragment = sequence[:rc.FRAGMENT_SIZE]
-                    dna_fragment_idx += 1
-                    fh.write('>')
-                    fh.write(str(dna_fragment_idx))
-                    fh.write('\n')
-                    fh.write(str(dna_fragment))
-                    fh.write('\n')
-                    dna_fragments[dna_fragment_idx] = {
-                        'id': dna_fragment_idx,
-                        'length': len(dna_fragment)
-                    }
-                    sequence = sequence[rc.FRAGMENT_SIZE:]
-                dna_fragment = sequence
-                dna_fragment_idx += 1
-                fh.write('>')
-                fh.write(str(dna_fragment_idx))
-                fh.write('\n')
-                fh.write(str(dna_fragment))
-                fh.write('\n')
-                dna_fragments[dna_fragment_idx] = {
-                    'id': dna_fragment_idx,
-                    'length': len(dna_fragment)
-                }
-                # sequence = sequence[rc.FRAGMENT_SIZE:]
-        except ImportError:
-            sys.exit("ERROR: Genome file is not in fasta format")
+    dna_fragment_lengths = []
+    with open(str(genome_path), 'rb') as fh_in, dna_fragments_path.open(mode='wb') as fh_out:
+        sequence = None  # unfragmented tail of the current record
+        header = False
+        line_start = True
+        while True:
+            block = fh_in.readline(READ_BLOCK_SIZE)  # lines or parts of very long lines
+            if block == b'':
+                break
+            if line_start and block[:1] == b'>':
+                if sequence is not None:
+                    _write_dna_fragment(fh_out, dna_fragment_lengths, sequence)
+                sequence = bytearray()
+                header = True
+            if header:
+                header = block[-1:] != b'\n'
+            elif sequence is not None:
+                sequence += block.translate(None, SEQUENCE_WHITESPACE)
+                with memoryview(sequence) as view:
+                    offset = 0
+                    while len(sequence) - offset > (rc.FRAGMENT_SIZE + rc.MIN_FRAGMENT_SIZE):  # forestall fragments shorter than MIN_FRAGMENT_SIZE
+                        _write_dna_fragment(fh_out, dna_fragment_lengths, view[offset:offset + rc.FRAGMENT_SIZE])
+                        offset += rc.FRAGMENT_SIZE
+                del sequence[:offset]
+            line_start = block[-1:] == b'\n'
+        if sequence is not None:
+            _write_dna_fragment(fh_out, dna_fragment_lengths, sequence)
+    return np.array(dna_fragment_lengths, dtype=np.int32)
+
+
+def _write_dna_fragment(fh, dna_fragment_lengths, dna_fragment):
+    dna_fragment_lengths.append(len(dna_fragment))
+    fh.write(b'>%d\n' % len(dna_fragment_lengths))
+    fh.write(dna_fragment)
+    fh.write(b'\n')
+
+
+def store_dna_fragments(genome_path, db_path, genome_id):
+    """Build DNA fragments of a database genome once and store them along with a fragment length table.
+
+    :param genome_path: Path to genome Fasta file.
+    :param db_path: Path to the database directory.
+    :param genome_id: genome id.
+
+    :rtype np.ndarray: An array of DNA fragment lengths indexed by fragment id - 1.
+    """
+
+    fragments_path = db_path.joinpath(rc.FRAGMENTS_DIR)
+    fragments_path.mkdir(mode=0o770, exist_ok=True)
+    tmp_path = Path(tempfile.mkdtemp(dir=str(fragments_path), prefix='.tmp-'))
+    try:
+        dna_fragments = build_dna_fragments(genome_path, tmp_path.joinpath('fragments.fasta'))
+        np.save(str(tmp_path.joinpath('fragments.npy')), dna_fragments)
+        # the length table marks complete fragments and is therefore moved last
+        os.replace(str(tmp_path.joinpath('fragments.fasta')), str(fragments_path.joinpath('%s.fasta' % genome_id)))
+        os.replace(str(tmp_path.joinpath('fragments.npy')), str(fragments_path.joinpath('%s.npy' % genome_id)))
+    finally:
+        shutil.rmtree(str(tmp_path), ignore_errors=True)
     return dna_fragments
 
 
+def read_dna_fragments(db_path, genome_id):
+    """Read DNA fragments of a database genome stored at import time.
+
+    :param db_path: Path to the database directory.
+    :param genome_id: genome id.
+
+    :rtype: Path to DNA fragments Fasta file and an array of DNA fragment lengths or None if not available.
+    """
+
+    fragments_path = db_path.joinpath(rc.FRAGMENTS_DIR)
+    dna_fragments_path = fragments_path.joinpath('%s.fasta' % genome_id)
+    try:
+        dna_fragments = np.load(str(fragments_path.joinpath('%s.npy' % genome_id)))
+    except (OSError, ValueError):
+        return None
+    if not dna_fragments_path.exists():
+        return None
+    return dna_fragments_path, dna_fragments
+
+
 def setup_configuration(args):
     """Test environment and build a runtime configuration."""
     try:
-        config = {
-            'tmp': Path(tempfile.mkdtemp()),
-            'bundled-binaries': False,
-            'threads': args.threads,
-            'unfiltered': args.unfiltered,
-            'bidirectional': args.bidirectional,
-            'crg': args.crg,
-            'ani': args.ani,
-            'conserved_dna': args.conserved_dna,
-            'n_mash_results': int(args.n_mash_results)
-        }
-    except ValueError:
+        n_mash_results = int(getattr(args, 'n_mash_results', 100))
+    except (TypeError, ValueError):
         sys.exit('Error: n_mash_results must be a number ("integer")')
+    if args.top is not None and (not isinstance(args.top, int) or args.top < 1):
+        sys.exit('ERROR: top must be a positive number!')
+
+    config = {
+        'tmp': Path(tempfile.mkdtemp()),
+        'bundled-binaries': False,
+        'threads': args.threads,
+        'unfiltered': args.unfiltered,
+        'bidirectional': args.bidirectional,
+        'crg': args.crg,
+        'top': args.top,
+        'expand': args.expand,
+        'ani': args.ani,
+        'conserved_dna': args.conserved_dna,
+        'native_mash': args.native_mash,
+        'index_cache': args.index_cache * 1024 * 1024,
+        'cache_dir': Path(args.cache_dir).resolve() if args.cache_dir is not None else None,
+        'cache_size': args.cache_size * 1024 * 1024,
+        'n_mash_results': n_mash_results,
+        'trace': trace.create(args.trace),
+        'events': events.open_log(args.events)
+    }
     set_path(config)
 
     base_dir = Path(__file__).parent.parent
@@ -96,6 +183,16 @@ def setup_configuration(args):
     return config
 
 
+@contextmanager
+def thread_pool(config):
+    """Provide the resident worker pool of a server process or a new pool of config['threads'] workers."""
+    if 'executor' in config:
+        yield config['executor']
+    else:
+        with cf.ThreadPoolExecutor(max_workers=config['threads']) as tpe:
+            yield tpe
+
+
 def set_path(config):
     config['env'] = os.environ.copy()
     base_dir = Path(__file__).parent.parent
@@ -106,47 +203,68 @@ def set_path(config):
 
 
 def test_binaries(config):
-    """Test the proper installation of necessary 3rd party executables."""
+    """Test the proper installation of necessary 3rd party executables.
 
-    # test Mash
-    try:
-        sp.check_call(
-            ['mash', 'dist', '-h'],
-            env=config['env'],
-            stdout=sp.DEVNULL,
-            stderr=sp.DEVNULL
-        )
-    except FileNotFoundError:
-        sys.exit('ERROR: \'Mash\' was not found!')
-    except:
-        sys.exit('ERROR: \'Mash\' was not exeutable!')
-
-    # test nucmer
+    Passed tests are cached by the resolved executable paths, their modification times and PATH,
+    so executables are only run again if any of them has changed.
+    """
+
+    binaries = []
+    for name, cmd in BINARIES:
+        binary_path = shutil.which(cmd[0], path=config['env'].get('PATH', os.defpath))
+        if binary_path is None:
+            sys.exit('ERROR: \'%s\' was not found!' % name)
+        binary_path = os.path.realpath(binary_path)
+        binaries.append((binary_path, os.stat(binary_path).st_mtime_ns))
+    key = hashlib.sha256(json.dumps([config['env'].get('PATH'), binaries]).encode()).hexdigest()
+    cache_path = get_user_cache_path(config).joinpath(rc.BINARIES_CACHE_FILE)
+    tested_binaries = read_tested_binaries(cache_path)
+    if key in tested_binaries:
+        return
+
+    for name, cmd in BINARIES:
+        try:
+            sp.check_call(
+                cmd,
+                env=config['env'],
+                stdout=sp.DEVNULL,
+                stderr=sp.DEVNULL
+            )
+        except FileNotFoundError:
+            sys.exit('ERROR: \'%s\' was not found!' % name)
+        except:
+            sys.exit('ERROR: \'%s\' was not exeutable!' % name)
+    tested_binaries[key] = binaries
+    write_tested_binaries(cache_path, list(tested_binaries.items())[-rc.BINARIES_CACHE_SIZE:])
+
+
+def get_user_cache_path(config):
+    """Get the per-user cache directory, i.e. $XDG_CACHE_HOME/referenceseeker or ~/.cache/referenceseeker."""
+    cache_home = config['env'].get('XDG_CACHE_HOME', '')
+    if cache_home == '':
+        cache_home = Path(config['env'].get('HOME', '~')).expanduser().joinpath('.cache')
+    return Path(cache_home).joinpath('referenceseeker')
+
+
+def read_tested_binaries(cache_path):
+    """Read passed binary tests from the binary cache ignoring missing or broken cache files."""
     try:
-        sp.check_call(
-            ['nucmer', '--help'],
-            env=config['env'],
-            stdout=sp.DEVNULL,
-            stderr=sp.DEVNULL
-        )
-    except FileNotFoundError:
-        sys.exit('ERROR: \'nucmer\' was not found!')
-    except:
-        sys.exit('ERROR: \'nucmer\' was not exeutable!')
-
-    # test delta-filter
+        with cache_path.open() as fh:
+            return dict(json.load(fh))
+    except (OSError, ValueError, TypeError):
+        return {}
+
+
+def write_tested_binaries(cache_path, tested_binaries):
+    """Replace the binary cache at once, skipping it if the cache directory is not writable."""
     try:
-        sp.check_call(
-            ['delta-filter', '-h'],
-            env=config['env'],
-            stdout=sp.DEVNULL,
-            stderr=sp.DEVNULL
-        )
-    except FileNotFoundError:
-        sys.exit('ERROR: \'delta-filter\' was not found!')
-    except:
-        sys.exit('ERROR: \'delta-filter\' was not exeutable!')
-    return
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_cache_path = tempfile.mkstemp(dir=str(cache_path.parent), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(tested_binaries, fh)
+        os.replace(tmp_cache_path, str(cache_path))
+    except OSError:
+        pass
 
 
 def check_path(path):
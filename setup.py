@@ -26,7 +26,8 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=[
-        'biopython >= 1.71'
+        'biopython >= 1.71',
+        'numpy >= 1.15'
     ],
     entry_points={
         'console_scripts': [
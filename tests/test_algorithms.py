@@ -0,0 +1,51 @@
+import argparse
+import json
+from pathlib import Path
+
+import pytest
+
+from referenceseeker import algorithms as ra
+
+
+COHORT_RESULTS = [
+    {'R1': [(0.90, 0.50), (0.98, 0.70)], 'R2': [(1.0, 1.0), (1.0, 1.0)]},
+    {'R1': [(0.96, 0.80), (0.96, 0.80)], 'R2': [(0.5, 0.2), (0.5, 0.2)]}
+]
+
+
+def test_build_scores():
+    args = argparse.Namespace(bidirectional=True)
+    scores = ra.build_scores(args, ['R1', 'R2'], COHORT_RESULTS)
+    assert scores.shape == (2, 2, 3)
+    # each query genome keeps its own scores
+    assert scores[0].ravel().tolist() == pytest.approx([0.94, 0.6, 0.564, 0.96, 0.8, 0.768])
+    assert scores[1].ravel().tolist() == pytest.approx([1.0, 1.0, 1.0, 0.5, 0.2, 0.1])
+
+    args = argparse.Namespace(bidirectional=False)
+    scores = ra.build_scores(args, ['R1'], COHORT_RESULTS)
+    assert scores[0].ravel().tolist() == pytest.approx([0.90, 0.5, 0.45, 0.96, 0.8, 0.768])
+
+
+@pytest.mark.parametrize('algorithm,expected', [
+    ('product', [0.5, 0.2, 0.1]),
+    ('mean', [0.75, 0.6, 0.55]),
+    ('geometric', [0.5 ** 0.5, 0.2 ** 0.5, 0.1 ** 0.5]),
+    ('harmonic', [2 / 3, 2 / 6, 2 / 11])
+])
+def test_calculate(algorithm, expected):
+    args = argparse.Namespace(bidirectional=True, algorithm=algorithm)
+    ref_id_values = ra.calculate(args, {'R2': [1, 1, 1]}, ['R2'], COHORT_RESULTS, ['Q1', 'Q2'])
+    assert ref_id_values['R2'] == pytest.approx(expected)
+
+
+def test_calculate_scores(tmpdir):
+    args = argparse.Namespace(bidirectional=True, algorithm='product', scores=None)
+    ra.calculate(args, {}, ['R1', 'R2'], COHORT_RESULTS, ['Q1', 'Q2'])
+    assert tmpdir.listdir() == []
+
+    scores_path = Path(str(tmpdir)).joinpath('scores')
+    args.scores = str(scores_path)
+    ref_id_values = ra.calculate(args, {}, ['R1', 'R2'], COHORT_RESULTS, ['Q1', 'Q2'])
+    assert sorted(k.name for k in scores_path.iterdir()) == ['cohort_results.txt', 'final_scores.txt', 'rawscores.txt']
+    with scores_path.joinpath('final_scores.txt').open() as fh:
+        assert json.loads(fh.read().split('\n', 1)[1]) == ref_id_values
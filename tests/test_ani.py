@@ -1,4 +1,6 @@
+import os
 
+import numpy as np
 import pytest
 
 from referenceseeker import ani as ra
@@ -35,9 +37,16 @@ def test_fragment_matches():
     return dna_fragment_matches
 
 
+def to_arrays(dna_fragment_matches):
+    dna_fragments = np.array([k['length'] for k in dna_fragment_matches], dtype=np.int32)
+    alignment_lengths = np.array([k['alignment_length'] for k in dna_fragment_matches], dtype=np.int64)
+    non_identities = np.array([k['no_non_identities'] for k in dna_fragment_matches], dtype=np.int64)
+    return dna_fragments, alignment_lengths, non_identities
+
+
 def test_calculate_conserved_dna_all(test_fragment_matches):
     #  check conDNA over all test fragment matches
-    conserved_dna = ra.calculate_conserved_dna({k['id']: k for k in test_fragment_matches}, test_fragment_matches)
+    conserved_dna = ra.calculate_conserved_dna(*to_arrays(test_fragment_matches))
     valid_dna_fragment_matches = test_fragment_matches[0:2]
     expected_conserved_dna = sum(map(lambda k: k['alignment_length'], valid_dna_fragment_matches)) / sum(map(lambda k: k['length'], test_fragment_matches))
     assert conserved_dna == expected_conserved_dna
@@ -46,7 +55,7 @@ def test_calculate_conserved_dna_all(test_fragment_matches):
 def test_calculate_conserved_dna_valid(test_fragment_matches):
     #  check conDNA for *valid* test fragment matches
     test_fragment_matches = test_fragment_matches[0:2]
-    conserved_dna = ra.calculate_conserved_dna({k['id']: k for k in test_fragment_matches}, test_fragment_matches)
+    conserved_dna = ra.calculate_conserved_dna(*to_arrays(test_fragment_matches))
     expected_conserved_dna = sum(map(lambda k: k['alignment_length'], test_fragment_matches)) / sum(map(lambda k: k['length'], test_fragment_matches))
     assert conserved_dna == expected_conserved_dna
 
@@ -54,21 +63,30 @@ def test_calculate_conserved_dna_valid(test_fragment_matches):
 def test_calculate_conserved_dna_unvalid(test_fragment_matches):
     #  check conDNA for *unvalid* test fragment matches
     test_fragment_matches = test_fragment_matches[2:]
-    conserved_dna = ra.calculate_conserved_dna({k['id']: k for k in test_fragment_matches}, test_fragment_matches)
+    conserved_dna = ra.calculate_conserved_dna(*to_arrays(test_fragment_matches))
     expected_conserved_dna = 0.0
     assert conserved_dna == expected_conserved_dna
 
 
+def test_calculate_conserved_dna_unmatched(test_fragment_matches):
+    #  check conDNA for fragments without any match
+    dna_fragments, alignment_lengths, non_identities = to_arrays(test_fragment_matches)
+    alignment_lengths[:] = 0
+    non_identities[:] = 0
+    conserved_dna = ra.calculate_conserved_dna(dna_fragments, alignment_lengths, non_identities)
+    assert conserved_dna == 0.0
+
+
 def test_calculate_conserved_dna_empty():
     #  check conDNA for empty test fragment matches
-    conserved_dna = ra.calculate_conserved_dna({}, [])
+    conserved_dna = ra.calculate_conserved_dna(*to_arrays([]))
     expected_conserved_dna = 0.0
     assert conserved_dna == expected_conserved_dna
 
 
 def test_calculate_ani_all(test_fragment_matches):
     #  check ANI over all test fragment matches
-    ani = ra.calculate_ani(test_fragment_matches)
+    ani = ra.calculate_ani(*to_arrays(test_fragment_matches))
     valid_dna_fragment_matches = test_fragment_matches[0:2]
     expected_ani = sum(map(lambda k: (k['alignment_length'] - k['no_non_identities']) / k['alignment_length'], valid_dna_fragment_matches)) / len(valid_dna_fragment_matches)
     assert ani == expected_ani
@@ -77,7 +95,7 @@ def test_calculate_ani_all(test_fragment_matches):
 def test_calculate_ani_valid(test_fragment_matches):
     #  check ANI for *valid* test fragment matches
     test_fragment_matches = test_fragment_matches[0:2]
-    ani = ra.calculate_ani(test_fragment_matches)
+    ani = ra.calculate_ani(*to_arrays(test_fragment_matches))
     expected_ani = sum(map(lambda k: (k['alignment_length'] - k['no_non_identities']) / k['alignment_length'], test_fragment_matches)) / len(test_fragment_matches)
     assert ani == expected_ani
 
@@ -85,13 +103,134 @@ def test_calculate_ani_valid(test_fragment_matches):
 def test_calculate_ani_unvalid(test_fragment_matches):
     #  check ANI for *unvalid* test fragment matches
     test_fragment_matches = test_fragment_matches[2:]
-    ani = ra.calculate_ani(test_fragment_matches)
+    ani = ra.calculate_ani(*to_arrays(test_fragment_matches))
     expected_ani = 0.0
     assert ani == expected_ani
 
 
 def test_calculate_ani_empty():
     #  check ANI for empty test fragment matches
-    ani = ra.calculate_ani([])
+    ani = ra.calculate_ani(*to_arrays([]))
     expected_ani = 0.0
     assert ani == expected_ani
+
+
+def test_score_alignments(test_fragment_matches):
+    #  check batch scores against per genome scores for a shared fragment table
+    dna_fragments, alignment_lengths, non_identities = to_arrays(test_fragment_matches)
+    alignment_lengths = np.vstack([alignment_lengths, alignment_lengths[::-1], np.zeros(len(dna_fragments), dtype=np.int64)])
+    non_identities = np.vstack([non_identities, non_identities[::-1], np.zeros(len(dna_fragments), dtype=np.int64)])
+    anis, conserved_dnas = ra.score_alignments(dna_fragments, alignment_lengths, non_identities)
+    for idx in range(3):
+        assert anis[idx] == ra.calculate_ani(dna_fragments, alignment_lengths[idx], non_identities[idx])
+        assert conserved_dnas[idx] == ra.calculate_conserved_dna(dna_fragments, alignment_lengths[idx], non_identities[idx])
+    assert anis[2] == 0.0
+    assert conserved_dnas[2] == 0.0
+
+
+def test_score_alignments_padded(test_fragment_matches):
+    #  check batch scores for per genome fragment tables of different lengths
+    rows = [test_fragment_matches, test_fragment_matches[0:2], []]
+    arrays = [to_arrays(row) for row in rows]
+    anis, conserved_dnas = ra.score_alignments(
+        ra.stack_fragment_arrays([a[0] for a in arrays]),
+        ra.stack_fragment_arrays([a[1] for a in arrays]),
+        ra.stack_fragment_arrays([a[2] for a in arrays])
+    )
+    for idx, (dna_fragments, alignment_lengths, non_identities) in enumerate(arrays):
+        assert anis[idx] == ra.calculate_ani(dna_fragments, alignment_lengths, non_identities)
+        assert conserved_dnas[idx] == ra.calculate_conserved_dna(dna_fragments, alignment_lengths, non_identities)
+
+
+def to_delta(alignments):
+    lines = ['/ref.fna /query.fasta', 'NUCMER']
+    for reference, query, reference_start, reference_end, query_start, query_end, errors, indels in alignments:
+        lines.append('>%s %s 100000 2000' % (reference, query))
+        lines.append('%d %d %d %d %d %d 0' % (reference_start, reference_end, query_start, query_end, errors, errors))
+        lines.extend(str(indel) for indel in indels + [0])
+    return lines
+
+
+def test_parse_delta():
+    delta = to_delta([
+        ('R1', '1', 1, 1000, 1, 1002, 12, [-10, 5, -20]),
+        ('R2', '2', 5000, 4001, 1, 1000, 3, [])
+    ])
+    alignments = list(ra.parse_delta(delta))
+    assert alignments == [('1', 1, 1002, 12, 1002, 1, 1000), ('2', 1, 1000, 3, 1000, 5000, 4001)]
+
+
+def test_filter_query_alignments_overlap():
+    #  expected alignments have been retained by 'delta-filter -q'
+    alignments = list(ra.parse_delta(to_delta([
+        ('R0', '1', 1, 265, 118, 382, 19, []),
+        ('R1', '1', 1, 355, 137, 491, 14, []),
+        ('R2', '1', 1, 209, 346, 554, 39, [])
+    ])))
+    assert ra.filter_query_alignments(alignments) == [alignments[0], alignments[2]]
+
+
+def test_filter_query_alignments_identity():
+    #  expected alignment has been retained by 'delta-filter -q': equal truncated scores, fewer gaps of the shorter one
+    alignments = list(ra.parse_delta(to_delta([
+        ('R0', '1', 310, 477, 310, 477, 33, []),
+        ('R1', '1', 284, 490, 284, 490, 57, [])
+    ])))
+    assert ra.filter_query_alignments(alignments) == alignments[:1]
+
+
+def test_filter_query_alignments_ties():
+    #  expected alignments have been retained by 'delta-filter -q': equal chains are picked via rand() per query
+    alignments = list(ra.parse_delta(to_delta([
+        ('R%d' % idx, query, idx * 1000 + 1, idx * 1000 + 500, 1, 500, 10, []) for query in ['1', '2', '3'] for idx in range(3)
+    ])))
+    assert ra.filter_query_alignments(alignments) == [alignments[2], alignments[4], alignments[8]]
+
+
+def test_filter_query_alignments_chain():
+    #  expected alignments have been retained by 'delta-filter -q'
+    def alignments(errors):
+        return list(ra.parse_delta(to_delta([
+            ('R0', '1', 1, 500, 1, 500, 100, []),
+            ('R1', '1', 1, 500, 501, 1000, 0, []),
+            ('R2', '1', 1, 1000, 1, 1000, errors, [])
+        ])))
+    chained = alignments(95)
+    assert ra.filter_query_alignments(chained) == chained[:2]
+    single = alignments(94)
+    assert ra.filter_query_alignments(single) == single[2:]
+
+
+def test_filter_query_alignments_contained():
+    #  expected alignments have been retained by 'delta-filter -q' regardless of their order
+    full = ('R0', '1', 1, 1020, 1, 1020, 10, [])
+    partial = ('R1', '1', 5000, 5499, 1, 500, 0, [])
+    for delta in [to_delta([full, partial]), to_delta([partial, full])]:
+        alignments = list(ra.parse_delta(delta))
+        assert ra.filter_query_alignments(alignments) == [a for a in alignments if a[4] == 1020]
+
+
+def test_filter_query_alignments_queries():
+    #  alignments of different queries do not compete
+    alignments = list(ra.parse_delta(to_delta([
+        ('R0', '1', 1, 1000, 1, 1000, 0, []),
+        ('R0', '2', 1, 1000, 1, 1000, 50, [])
+    ])))
+    assert ra.filter_query_alignments(alignments) == alignments
+
+
+def test_execute_nucmer_without_index(tmp_path):
+    #  alignments fall back to nucmer runs without an index if the index cannot be loaded
+    delta_path = tmp_path.joinpath('nucmer.delta')
+    delta_path.write_text('\n'.join(to_delta([('R0', '1', 1, 1000, 1, 1000, 7, [])])) + '\n')
+    calls_path = tmp_path.joinpath('calls.txt')
+    nucmer_path = tmp_path.joinpath('nucmer')
+    nucmer_path.write_text('#!/bin/sh\necho "$@" >> %s\ncase "$1" in --load=*) exit 1;; esac\ncat %s\n' % (calls_path, delta_path))
+    nucmer_path.chmod(0o755)
+    config = {'env': {'PATH': '%s:%s' % (tmp_path, os.environ['PATH'])}}
+    dna_fragments = np.array([1000], dtype=np.int32)
+
+    alignment_lengths, non_identities = ra.execute_nucmer(config, tmp_path, dna_fragments, 'query.fasta', 'reference.fna', 'evicted/reference')
+    assert alignment_lengths.tolist() == [1000]
+    assert non_identities.tolist() == [7]
+    assert [line.split()[0] for line in calls_path.read_text().splitlines()] == ['--load=evicted/reference', '--threads=1']
@@ -0,0 +1,111 @@
+import argparse
+from pathlib import Path
+
+import pytest
+
+from referenceseeker import batch as rb
+
+
+def write_genomes(path, names):
+    path.mkdir(exist_ok=True)
+    for name in names:
+        path.joinpath(name).write_text('>contig\nACGT\n')
+    return path
+
+
+def test_read_genome_paths(tmpdir):
+    genomes_path = write_genomes(Path(str(tmpdir)).joinpath('genomes'), ['b.fasta', 'a.fna', 'notes.txt'])
+    assert rb.read_genome_paths(str(genomes_path)) == [genomes_path.joinpath('a.fna'), genomes_path.joinpath('b.fasta')]
+
+    # relative manifest paths are resolved against the manifest directory
+    manifest_path = Path(str(tmpdir)).joinpath('genomes.txt')
+    manifest_path.write_text('# query genomes\ngenomes/b.fasta\n\n%s\n' % genomes_path.joinpath('a.fna'))
+    assert rb.read_genome_paths(str(manifest_path)) == [genomes_path.joinpath('b.fasta'), genomes_path.joinpath('a.fna')]
+
+    manifest_path.write_text('genomes/c.fna\n')
+    with pytest.raises(SystemExit, match='not readable'):
+        rb.read_genome_paths(str(manifest_path))
+    manifest_path.write_text('')
+    with pytest.raises(SystemExit, match='is empty'):
+        rb.read_genome_paths(str(manifest_path))
+
+
+def test_batch_duplicate_names(tmpdir):
+    genomes_path = write_genomes(Path(str(tmpdir)).joinpath('genomes'), ['q.fna', 'q.fasta'])
+    args = argparse.Namespace(genomes=str(genomes_path), output=str(tmpdir))
+    with pytest.raises(SystemExit, match='unique'):
+        rb.batch(args, {})
+
+
+def test_run_mash_batch(monkeypatch):
+    #  hits of a single Mash run are split per query genome, later blocks of a query genome are merged
+    hits = [
+        ('a', 'q1.fna', 0.05), ('b', 'q1.fna', 0.01), ('c', 'q1.fna', 0.03),
+        ('a', 'q2.fna', 0.02),
+        ('d', 'q1.fna', 0.001)
+    ]
+    monkeypatch.setattr(rb.mash, 'stream_mash', lambda config, max_hits=None, screened=None: ('%s\t%s\t%f\t0\t1/1000\n' % hit for hit in hits))
+    args = argparse.Namespace(verbose=False, crg=2)
+    config = {'genome_path': [Path('q1.fna'), Path('q2.fna'), Path('q3.fna')], 'native_mash': False, 'duplicates': None}
+    mash_results = rb.mash.run_mash_batch(args, config)
+    assert mash_results == [
+        (['d', 'b'], {'d': 0.001, 'b': 0.01}),
+        (['a'], {'a': 0.02}),
+        ([], {})
+    ]
+
+
+def test_run_mash_batch_duplicates(monkeypatch):
+    #  hits of near-duplicate genomes are collapsed to their representatives after the last block of a query genome
+    hits = [('G2', 'q1.fna', 0.02), ('G5', 'q1.fna', 0.05), ('G4', 'q2.fna', 0.01), ('G1', 'q1.fna', 0.03), ('G3', 'q1.fna', 0.01)]
+    monkeypatch.setattr(rb.mash, 'stream_mash', lambda config, max_hits=None, screened=None: ('%s\t%s\t%f\t0\t1/1000\n' % hit for hit in hits))
+    duplicates = {
+        'representatives': {'G2': 'G1', 'G3': 'G1', 'G5': 'G4'},
+        'members': {'G1': ['G2', 'G3'], 'G4': ['G5']}
+    }
+    args = argparse.Namespace(verbose=False, crg=1)
+    config = {'genome_path': [Path('q1.fna'), Path('q2.fna')], 'native_mash': False, 'duplicates': duplicates}
+    mash_results = rb.mash.run_mash_batch(args, config)
+    assert mash_results == [
+        (['G1'], {'G1': 0.03, 'G2': 0.02, 'G3': 0.01}),
+        (['G4'], {'G4': 0.01})
+    ]
+
+
+def test_batch_expand(tmpdir, monkeypatch):
+    #  results are expanded to near-duplicate members which are printed along with their representatives
+    genomes_path = write_genomes(Path(str(tmpdir)).joinpath('genomes'), ['q1.fna', 'q2.fna'])
+    output_path = Path(str(tmpdir)).joinpath('results')
+    expanded = []
+    printed = {}
+
+    def align_genomes(args, config, tpe, genome_paths, ref_genome_ids, mash_distances):
+        return [{k: [(0.99, 0.9)] for k in query_ref_genome_ids} for query_ref_genome_ids in ref_genome_ids]
+
+    def expand_duplicates(args, config, tpe, genome_paths, results_list, mash_distances_list):
+        expanded.append([sorted(results) for results in results_list])
+        results_list[0]['M1'] = [(0.995, 0.9)]
+        return {'M1'}
+
+    def print_results(args, config, results, mash_distances, ref_genomes, out):
+        printed[Path(out.name).name] = (sorted(results), sorted(ref_genomes))
+
+    mash_results = [(['R1', 'R2'], {'R1': 0.01, 'R2': 0.02, 'M1': 0.005}), (['R2'], {'R2': 0.03})]
+    monkeypatch.setattr(rb.mash, 'run_mash_batch', lambda args, config: mash_results)
+    monkeypatch.setattr(rb.util, 'read_reference_genomes', lambda config, ref_genome_ids=None: {k: {'id': k} for k in sorted(ref_genome_ids)})
+    monkeypatch.setattr(rb.scheduler, 'align_genomes', align_genomes)
+    monkeypatch.setattr(rb.single, 'expand_duplicates', expand_duplicates)
+    monkeypatch.setattr(rb.single, 'print_results', print_results)
+
+    args = argparse.Namespace(genomes=str(genomes_path), output=str(output_path), verbose=False)
+    tmp_path = Path(str(tmpdir)).joinpath('tmp')
+    tmp_path.mkdir()
+    config = {'tmp': tmp_path, 'threads': 1, 'expand': True}
+    rb.batch(args, config)
+
+    assert expanded == [[['R1', 'R2'], ['R2']]]
+    assert printed == {
+        'q1.tsv': (['M1', 'R1', 'R2'], ['M1', 'R1', 'R2']),
+        'q2.tsv': (['R2'], ['M1', 'R1', 'R2'])
+    }
+    assert not tmp_path.exists()
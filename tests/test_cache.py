@@ -0,0 +1,53 @@
+from pathlib import Path
+
+import pytest
+
+from referenceseeker import cache as rcache
+
+
+@pytest.fixture
+def config(tmpdir):
+    db_path = Path(str(tmpdir)).joinpath('db')
+    db_path.mkdir()
+    for ref_genome_id in ['R1', 'R2']:
+        db_path.joinpath('%s.fna' % ref_genome_id).write_text('>%s\nACGT\n' % ref_genome_id)
+    query_path = Path(str(tmpdir)).joinpath('query.fna')
+    query_path.write_text('>query\nACGT\n')
+    return {
+        'db_path': db_path,
+        'cache_dir': Path(str(tmpdir)).joinpath('cache'),
+        'cache_size': 1024 * 1024,
+        'query_path': query_path
+    }
+
+
+def test_lookup_store(config):
+    query = rcache.query_key(config, config['query_path'])
+    assert rcache.lookup(config, query, ['R1', 'R2'], rcache.FORWARD) == {}
+    rcache.store(config, query, {'R1': (0.99, 0.9)}, rcache.FORWARD)
+    assert rcache.lookup(config, query, ['R1', 'R2'], rcache.FORWARD) == {'R1': (0.99, 0.9)}
+    assert rcache.lookup(config, query, ['R1', 'R2'], rcache.REVERSE) == {}
+
+
+def test_lookup_changed_reference(config):
+    #  results of modified reference genome files must not be reused
+    query = rcache.query_key(config, config['query_path'])
+    rcache.store(config, query, {'R1': (0.99, 0.9)}, rcache.FORWARD)
+    config['db_path'].joinpath('R1.fna').write_text('>R1\nACGTACGT\n')
+    assert rcache.lookup(config, query, ['R1'], rcache.FORWARD) == {}
+
+
+def test_disabled(config):
+    config['cache_dir'] = None
+    query = rcache.query_key(config, config['query_path'])
+    assert query is None
+    rcache.store(config, query, {'R1': (0.99, 0.9)}, rcache.FORWARD)
+    assert rcache.lookup(config, query, ['R1'], rcache.FORWARD) == {}
+
+
+def test_evict(config):
+    #  least recently used results are evicted if the cache exceeds its size
+    config['cache_size'] = 0
+    query = rcache.query_key(config, config['query_path'])
+    rcache.store(config, query, {'R1': (0.99, 0.9), 'R2': (0.98, 0.8)}, rcache.FORWARD)
+    assert rcache.lookup(config, query, ['R1', 'R2'], rcache.FORWARD) == {}
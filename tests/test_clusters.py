@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from referenceseeker import clusters as rclusters
+
+
+def shard_sketches(ids, hashes, kmer=21, size=10, seed=42):
+    width = max(len(genome_hashes) for genome_hashes in hashes)
+    stacked = np.full((len(ids), width), np.iinfo(np.uint64).max, dtype=np.uint64)
+    for idx, genome_hashes in enumerate(hashes):
+        stacked[idx, :len(genome_hashes)] = genome_hashes
+    return {'kmer': kmer, 'size': size, 'seed': seed, 'ids': ids, 'counts': np.array([len(k) for k in hashes]), 'hashes': stacked}
+
+
+def test_select_clusters():
+    #  clusters are selected if their representative is within max distance plus the cluster radius
+    clusters = {
+        'clusters': {
+            'R1': {'path': Path('cluster-00001.msh'), 'radius': 0.02, 'size': 3},
+            'R2': {'path': Path('cluster-00002.msh'), 'radius': 0.0, 'size': 1},
+            'R3': {'path': Path('cluster-00003.msh'), 'radius': 0.05, 'size': 2}
+        },
+        'max_radius': 0.05
+    }
+    selected = rclusters.select_clusters(clusters, [('R1', 0.11), ('R2', 0.11), ('R3', 0.08)], 0.1)
+    assert [cluster['path'].name for cluster in selected] == ['cluster-00003.msh', 'cluster-00001.msh']
+
+
+def test_load(tmpdir):
+    #  cluster indices are ignored as soon as the database has changed
+    db_path = Path(str(tmpdir))
+    clusters_path = db_path.joinpath('clusters')
+    clusters_path.mkdir()
+    clusters_path.joinpath('clusters.tsv').write_text('cluster-00001.msh\tR1\t0.020000\t3\ncluster-00002.msh\tR2\t0.000000\t1\n')
+    clusters_path.joinpath('shards.tsv').write_text('db.msh\t4\n')
+    db_path.joinpath('shards.tsv').write_text('db.msh\t4\n')
+    clusters = rclusters.load({'db_path': db_path})
+    assert clusters['max_radius'] == 0.02
+    assert clusters['clusters']['R1'] == {'path': clusters_path.joinpath('cluster-00001.msh'), 'radius': 0.02, 'size': 3}
+
+    db_path.joinpath('shards.tsv').write_text('db.msh\t4\nshards/shard-00001.msh\t1\n')
+    assert rclusters.load({'db_path': db_path}) is None
+
+
+def test_cluster_sketches(monkeypatch):
+    #  genomes join the nearest representative including representatives of their own block
+    monkeypatch.setattr(rclusters, 'CLUSTER_BLOCK_SIZE', 2)
+    family_a = list(range(0, 10))
+    family_b = list(range(100, 110))
+    shards = [
+        shard_sketches(['A1', 'B1', 'A2'], [family_a, family_b, family_a[:9] + [50]]),
+        shard_sketches(['B2', 'C1'], [family_b[1:] + [150], list(range(200, 210))])
+    ]
+    clusters = rclusters.cluster_sketches(shards, 0.1, threads=2)
+    assert [[member_id for member_id, distance in members] for members in clusters] == [['A1', 'A2'], ['B1', 'B2'], ['C1']]
+    assert clusters[0][1][1] == pytest.approx(-np.log(2 * 0.9 / 1.9) / 21)  # 9 of the 10 smallest hashes are shared
+
+
+def test_check_sketch_params():
+    #  shards sketched with different parameters cannot be clustered together
+    shard_paths = [Path('db.msh'), Path('shards/shard-00001.msh')]
+    shards = [shard_sketches(['A1'], [[1, 2]]), shard_sketches(['B1'], [[3, 4]])]
+    assert rclusters.check_sketch_params(shard_paths, shards) == (21, 10, 42)
+    shards[1]['size'] = 1000
+    with pytest.raises(Exception, match='shards/shard-00001.msh'):
+        rclusters.check_sketch_params(shard_paths, shards)
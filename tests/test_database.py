@@ -0,0 +1,57 @@
+import argparse
+import random
+from pathlib import Path
+
+import pytest
+
+from referenceseeker import database as rdatabase
+from referenceseeker import metadata as rmetadata
+from referenceseeker import shards as rshards
+from referenceseeker import util as rutil
+
+
+def test_read_manifest(tmpdir):
+    #  missing manifest values default to the import options
+    tmp_path = Path(str(tmpdir))
+    for name in ['a.fna', 'b.gbk', 'c.txt']:
+        tmp_path.joinpath(name).write_text('>a\nACGT\n')
+    manifest_path = tmp_path.joinpath('manifest.tsv')
+    manifest_path.write_text('# path\tid\ttaxonomy\tstatus\torganism\na.fna\tA\t1000\tcomplete\tGenome A\n%s\n' % tmp_path.joinpath('b.gbk'))
+    args = argparse.Namespace(manifest=str(manifest_path), taxonomy=12908, status='contig', organism='')
+
+    genomes = rdatabase.read_manifest(args)
+    assert genomes == [
+        {'path': tmp_path.joinpath('a.fna'), 'id': 'A', 'tax': 1000, 'status': 'complete', 'name': 'Genome A'},
+        {'path': tmp_path.joinpath('b.gbk'), 'id': None, 'tax': 12908, 'status': 'contig', 'name': ''}
+    ]
+
+    args.manifest = str(tmp_path)
+    assert [genome['path'].name for genome in rdatabase.read_manifest(args)] == ['a.fna', 'b.gbk']
+
+
+def test_import_genomes_rollback(tmpdir, monkeypatch):
+    #  genome files, DNA fragments and metadata of failed imports are removed, former genomes are kept
+    tmp_path = Path(str(tmpdir))
+    rng = random.Random(42)
+    genomes = []
+    for genome_id in ['A', 'B', 'C']:
+        genome_path = tmp_path.joinpath('%s.fasta' % genome_id)
+        genome_path.write_text('>%s\n%s\n' % (genome_id, ''.join(rng.choice('ACGT') for idx in range(5000))))
+        genomes.append({'path': genome_path, 'id': genome_id, 'tax': 12908, 'status': 'contig', 'name': ''})
+    rdatabase.init(argparse.Namespace(output=str(tmp_path), db='db'))
+    db_path = tmp_path.joinpath('db')
+    config = {}
+    rutil.set_path(config)
+    args = argparse.Namespace(db=str(db_path), threads=2, index=False)
+    rdatabase.import_genomes(config, args, genomes[:1])
+    db_files = sorted(str(path.relative_to(db_path)) for path in db_path.rglob('*'))
+    db_tsv = db_path.joinpath('db.tsv').read_text()
+
+    def add_sketches(config, db_path, sketch_paths):
+        raise Exception('failed to merge sketches via Mash!')
+    monkeypatch.setattr(rshards, 'add_sketches', add_sketches)
+    with pytest.raises(SystemExit):
+        rdatabase.import_genomes(config, args, genomes[1:])
+    assert sorted(str(path.relative_to(db_path)) for path in db_path.rglob('*')) == db_files
+    assert db_path.joinpath('db.tsv').read_text() == db_tsv
+    assert list(rmetadata.fetch(db_path)) == ['A']
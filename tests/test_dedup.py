@@ -0,0 +1,29 @@
+from pathlib import Path
+
+from referenceseeker import dedup as rdedup
+
+
+def test_load(tmpdir):
+    db_path = Path(str(tmpdir))
+    assert rdedup.load({'db_path': db_path}) is None
+
+    db_path.joinpath('duplicates.tsv').write_text('G2\tG1\t0.000500\nG3\tG1\t0.000800\nG5\tG4\t0.000100\n')
+    duplicates = rdedup.load({'db_path': db_path})
+    assert duplicates['representatives'] == {'G2': 'G1', 'G3': 'G1', 'G5': 'G4'}
+    assert duplicates['members'] == {'G1': ['G2', 'G3'], 'G4': ['G5']}
+
+
+def test_collapse():
+    #  representatives hit by members only are ranked by the distance of their closest member
+    duplicates = {
+        'representatives': {'G2': 'G1', 'G3': 'G1', 'G5': 'G4'},
+        'members': {'G1': ['G2', 'G3'], 'G4': ['G5']}
+    }
+    hits, groups = rdedup.collapse(duplicates, [('G2', 0.02), ('G1', 0.03), ('G5', 0.05), ('G3', 0.01), ('G6', 0.04)])
+    assert hits == [('G1', 0.03), ('G4', 0.05), ('G6', 0.04)]
+    assert groups['G1']['members'] == [('G2', 0.02), ('G3', 0.01)]
+
+    #  hits of further blocks extend former hit groups and are collapsed once after the last block
+    groups = rdedup.group_hits(duplicates, [('G2', 0.02), ('G5', 0.05)])
+    assert rdedup.group_hits(duplicates, [('G4', 0.06), ('G3', 0.01)], groups) is groups
+    assert rdedup.representative_hits(groups) == [('G1', 0.01), ('G4', 0.06)]
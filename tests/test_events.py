@@ -0,0 +1,45 @@
+import concurrent.futures as cf
+import json
+import os
+
+from referenceseeker import events as revents
+from referenceseeker import trace as rtrace
+
+
+def read_events(path):
+    with open(str(path)) as fh:
+        return [json.loads(line) for line in fh]
+
+
+def test_event_log(tmpdir):
+    log_path = tmpdir.join('events.jsonl')
+    config = {'events': revents.open_log(str(log_path))}
+    revents.emit(config, 'mash', query='q.fna', hits=3, candidates=2)
+    with cf.ThreadPoolExecutor(max_workers=1) as tpe:
+        assert rtrace.submit(config, tpe, 'align', sum, [1, 2], reference='R1').result() == 3
+    revents.close_log(config, 'ok')
+
+    records = read_events(log_path)
+    assert [record['event'] for record in records] == ['mash', 'job', 'end']
+    assert len(set(record['run'] for record in records)) == 1
+    assert records[0]['hits'] == 3
+    assert records[1]['job'] == 'align'
+    assert records[1]['reference'] == 'R1'
+    assert records[1]['status'] == 'ok'
+    assert records[1]['queue_wait_ms'] >= 0 and records[1]['run_ms'] >= 0
+    assert records[2]['status'] == 'ok'
+
+
+def test_event_log_fd(tmpdir):
+    #  file descriptors are left open for the caller
+    log_path = tmpdir.join('events.jsonl')
+    fd = os.open(str(log_path), os.O_WRONLY | os.O_CREAT)
+    try:
+        config = {'events': revents.open_log('fd:%d' % fd)}
+        revents.emit(config, 'start')
+        revents.close_log(config, 'failed')
+        os.fstat(fd)
+    finally:
+        os.close(fd)
+    assert [(record['event'], record.get('status')) for record in read_events(log_path)] == [('start', None), ('end', 'failed')]
+    assert revents.emit({}, 'start') is None  # disabled
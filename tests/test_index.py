@@ -0,0 +1,52 @@
+import os
+import threading
+
+from referenceseeker import constants as rc
+from referenceseeker import index as ri
+
+
+def create_index(db_path, ref_genome_id, size, last_used):
+    index_path = db_path.joinpath(rc.INDEX_DIR, ref_genome_id)
+    index_path.mkdir(parents=True)
+    index_path.joinpath('%s.sa' % rc.INDEX_PREFIX).write_bytes(b'x' * size)
+    os.utime(str(index_path), (last_used, last_used))
+
+
+def test_evict(tmp_path):
+    #  least recently used indices are removed until the cache fits into its budget
+    create_index(tmp_path, 'A', 100, 1000)
+    create_index(tmp_path, 'B', 100, 3000)
+    create_index(tmp_path, 'C', 100, 2000)
+    ri.evict({'db_path': tmp_path, 'index_cache': 150})
+    assert sorted(p.name for p in tmp_path.joinpath(rc.INDEX_DIR).iterdir() if p.name[0] != '.') == ['B']
+
+
+def test_evict_within_budget(tmp_path):
+    create_index(tmp_path, 'A', 100, 1000)
+    create_index(tmp_path, 'B', 100, 2000)
+    ri.evict({'db_path': tmp_path, 'index_cache': 200})
+    assert sorted(p.name for p in tmp_path.joinpath(rc.INDEX_DIR).iterdir() if p.name[0] != '.') == ['A', 'B']
+
+
+def test_use_index(tmp_path):
+    create_index(tmp_path, 'A', 100, 1000)
+    with ri.use_index({'db_path': tmp_path, 'index_cache': 0}, 'A') as index_prefix:
+        assert index_prefix is None
+    with ri.use_index({'db_path': tmp_path, 'index_cache': 1000}, 'A') as index_prefix:
+        assert index_prefix == tmp_path.joinpath(rc.INDEX_DIR, 'A', rc.INDEX_PREFIX)
+    assert tmp_path.joinpath(rc.INDEX_DIR, 'A').stat().st_mtime > 1000
+
+
+def test_evict_in_use(tmp_path):
+    #  indices in use by nucmer are skipped by concurrent evictions until they are released
+    create_index(tmp_path, 'A', 100, 1000)
+    create_index(tmp_path, 'B', 100, 2000)
+    config = {'db_path': tmp_path, 'index_cache': 50}
+    with ri.use_index(config, 'A') as index_prefix:
+        evictor = threading.Thread(target=ri.evict, args=(config,))
+        evictor.start()
+        evictor.join()
+        assert index_prefix.parent.is_dir()
+        assert [p.name for p in tmp_path.joinpath(rc.INDEX_DIR).iterdir() if p.name[0] != '.'] == ['A']
+    ri.evict(config)
+    assert [p.name for p in tmp_path.joinpath(rc.INDEX_DIR).iterdir() if p.name[0] != '.'] == []
@@ -0,0 +1,159 @@
+import threading
+import time
+from pathlib import Path
+
+from referenceseeker import mash as rm
+
+
+def test_parse_mash_results():
+    lines = [
+        'GCF_000439415.1\tquery.fna\t0.00995615\t0\t5713/10000\n',
+        'GCF_002211925.1\tquery.fna\t0.0752612\t0\t471/10000\n'
+    ]
+    hits = list(rm.parse_mash_results(lines))
+    assert hits == [('GCF_000439415.1', 'query.fna', 0.00995615), ('GCF_002211925.1', 'query.fna', 0.0752612)]
+
+
+def test_select_best_hits():
+    mash_hits = [('a', 0.05), ('b', 0.01), ('c', 0.03), ('d', 0.01), ('e', 0.09)]
+    ids, distances, no_screened = rm.select_best_hits(iter(mash_hits), 3)
+    assert ids == ['b', 'd', 'c']  # ties are kept in order of appearance
+    assert distances == {'b': 0.01, 'd': 0.01, 'c': 0.03}
+    assert no_screened == 5
+
+
+def test_select_best_hits_all():
+    mash_hits = [('a', 0.05), ('b', 0.01)]
+    ids, distances, no_screened = rm.select_best_hits(mash_hits, 100)
+    assert ids == ['b', 'a']
+    assert no_screened == 2
+
+
+def test_search_shards(monkeypatch):
+    #  query genomes are sketched once, shards are searched by at most threads Mash processes
+    #  and their hits are reduced to the best hits per query genome in database order
+    shard_hits = {
+        's1.msh': [('a', 'q1.fna', 0.05), ('b', 'q1.fna', 0.01), ('c', 'q1.fna', 0.02), ('a', 'q2.fna', 0.03)],
+        's2.msh': [('d', 'q1.fna', 0.01), ('e', 'q2.fna', 0.01), ('f', 'q2.fna', 0.04)],
+        's3.msh': [('g', 'q1.fna', 0.001)]
+    }
+    sketched = []
+    searched = []
+    active = [0, 0]  # current and max number of concurrent searches
+    lock = threading.Lock()
+
+    def stream_shard(config, shard_path, query_paths, threads, max_distance):
+        with lock:
+            searched.append((shard_path.name, [str(query_path) for query_path in query_paths], threads))
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.05)
+        for hit in shard_hits[shard_path.name]:
+            yield '%s\t%s\t%f\t0\t1/1000\n' % hit
+        with lock:
+            active[0] -= 1
+
+    monkeypatch.setattr(rm.sketch, 'read_sketch_params', lambda sketch_path: (21, 1000, 42))
+    monkeypatch.setattr(rm.sketch, 'sketch_queries', lambda config, genome_paths, sketch_params: sketched.append(sketch_params) or Path('query.msh'))
+    monkeypatch.setattr(rm, 'stream_shard', stream_shard)
+    config = {'genome_path': [Path('q1.fna'), Path('q2.fna')], 'threads': 2}
+    screened = {}
+    best_lines = rm.search_shards(config, [Path(shard_name) for shard_name in shard_hits], 0.1, 2, screened)
+    assert sketched == [(21, 1000, 42)]
+    assert sorted(searched) == [(shard_name, ['query.msh'], 1) for shard_name in ['s1.msh', 's2.msh', 's3.msh']]
+    assert active[1] == 2
+    assert {query_id: [line.split('\t')[0] for line in lines] for query_id, lines in best_lines.items()} == {'q1.fna': ['g', 'b'], 'q2.fna': ['e', 'a']}
+    assert screened == {'q1.fna': 5, 'q2.fna': 3}
+
+    best_lines = rm.search_shards(config, [Path(shard_name) for shard_name in shard_hits], 0.1, None)
+    assert [line.split('\t')[0] for line in best_lines['q1.fna']] == ['a', 'b', 'c', 'd', 'g']
+
+
+def test_select_cluster_sketch(tmpdir, monkeypatch):
+    #  query genomes are sketched once and member sketches of all selected clusters are searched by a single Mash run
+    clusters_index = {
+        'representatives_path': Path('representatives.msh'),
+        'clusters': {
+            'R1': {'path': Path('cluster-00001.msh'), 'radius': 0.02},
+            'R2': {'path': Path('cluster-00002.msh'), 'radius': 0.0},
+            'R3': {'path': Path('cluster-00003.msh'), 'radius': 0.01}
+        },
+        'max_radius': 0.02
+    }
+    representative_hits = [('R1', 'q1.fna', 0.11), ('R2', 'q1.fna', 0.05), ('R3', 'q1.fna', 0.12), ('R3', 'q2.fna', 0.09)]
+    searched = []
+    pasted = []
+
+    def stream_shard(config, shard_path, query_paths, threads, max_distance):
+        searched.append((str(shard_path), [str(query_path) for query_path in query_paths]))
+        return ('%s\t%s\t%f\t0\t1/1000\n' % hit for hit in representative_hits)
+
+    monkeypatch.setattr(rm.sketch, 'read_sketch_params', lambda sketch_path: (21, 1000, 42))
+    monkeypatch.setattr(rm.sketch, 'sketch_queries', lambda config, genome_paths, sketch_params: Path('query.msh'))
+    monkeypatch.setattr(rm, 'stream_shard', stream_shard)
+    monkeypatch.setattr(rm.shards, 'paste_sketches', lambda config, shard_path, sketch_paths: pasted.append([str(sketch_path) for sketch_path in sketch_paths]))
+    config = {'genome_path': [Path('q1.fna'), Path('q2.fna')], 'threads': 2, 'tmp': Path(str(tmpdir))}
+    query_path, cluster_sketch_path = rm.select_cluster_sketch(config, clusters_index, 0.1)
+    assert query_path == Path('query.msh')
+    assert cluster_sketch_path == Path(str(tmpdir)).joinpath('clusters.msh')
+    assert searched == [('representatives.msh', ['query.msh'])]
+    assert pasted == [['cluster-00002.msh', 'cluster-00001.msh', 'cluster-00003.msh']]
+
+    representative_hits = [('R2', 'q1.fna', 0.05)]
+    assert rm.select_cluster_sketch(config, clusters_index, 0.1) == (Path('query.msh'), Path('cluster-00002.msh'))
+    representative_hits = []
+    assert rm.select_cluster_sketch(config, clusters_index, 0.1) == (Path('query.msh'), None)
+    assert len(pasted) == 1
+
+
+def test_add_representative_distances(tmpdir, monkeypatch):
+    #  representatives hit by their members only are compared to the query genomes separately
+    sketched = []
+    distances = [('G4', 'q1.fna', 0.12), ('G4', 'q2.fna', 0.31), ('G7', 'q1.fna', 1.0), ('G7', 'q2.fna', 0.15)]
+
+    def stream_shard(config, shard_path, query_paths, threads, max_distance):
+        assert max_distance == 1.0
+        return ('%s\t%s\t%f\t0\t1/1000\n' % hit for hit in distances)
+
+    monkeypatch.setattr(rm.shards, 'get_shards', lambda db_path: [Path('db.msh')])
+    monkeypatch.setattr(rm.sketch, 'read_sketch_params', lambda sketch_path: (21, 1000, 42))
+    monkeypatch.setattr(rm.clusters, 'sketch_genomes', lambda config, db_path, tmp_path, sketch_file, genome_ids, sketch_params: sketched.append((genome_ids, sketch_params)))
+    monkeypatch.setattr(rm, 'stream_shard', stream_shard)
+    config = {'genome_path': [Path('q1.fna'), Path('q2.fna')], 'db_path': Path('db'), 'tmp': Path(str(tmpdir)), 'threads': 1}
+    groups_list = [
+        {'G1': {'distance': 0.03, 'members': [('G2', 0.02)]}, 'G4': {'distance': None, 'members': [('G5', 0.05)]}},
+        {'G4': {'distance': None, 'members': [('G5', 0.09)]}, 'G7': {'distance': None, 'members': [('G8', 0.08)]}}
+    ]
+    mash_distances_list = [{'G1': 0.03, 'G4': 0.05}, {'G7': 0.08, 'G4': 0.09}]
+    rm.add_representative_distances(config, [['G1', 'G4'], ['G7', 'G4']], mash_distances_list, groups_list)
+    assert sketched == [(['G4', 'G7'], (21, 1000, 42))]
+    assert mash_distances_list == [{'G1': 0.03, 'G4': 0.12}, {'G7': 0.15, 'G4': 0.31}]
+
+    rm.add_representative_distances(config, [['G1']], [{'G1': 0.03}], groups_list[:1])
+    assert len(sketched) == 1
+
+
+def test_parse_mash_cohort(monkeypatch):
+    hits = [
+        ('a', 'q1.fna', 0.05), ('b', 'q1.fna', 0.01), ('c', 'q1.fna', 0.2),
+        ('a', 'q2.fna', 0.01), ('c', 'q2.fna', 0.02), ('b', 'q2.fna', 0.03),
+        ('d', 'q1.fna', 0.001)  # later block of the same query genome
+    ]
+    streamed = []
+
+    def stream_mash(config, max_hits=None, screened=None):
+        streamed.append(max_hits)
+        for hit in hits:
+            yield '%s\t%s\t%f\t0\t1/1000\n' % hit
+    monkeypatch.setattr(rm, 'stream_mash', stream_mash)
+    config = {'genome_path': [Path('q1.fna'), Path('q2.fna')], 'n_mash_results': 3}
+    mash_results, filtered_ids, mash_distances_list = rm.parse_mash_cohort(config)
+    assert streamed == [3]
+    assert filtered_ids == ['b', 'a']  # best hits of every query genome, numerically sorted by first query genome distances
+    assert mash_results == [[('b', 0.01), ('a', 0.05)], [('a', 0.01), ('b', 0.03)]]
+    assert mash_distances_list == [{'b': 0.01, 'a': 0.05}, {'a': 0.01, 'b': 0.03}]
+
+    config['genome_path'].append(Path('q3.fna'))  # query genome without hits
+    mash_results, filtered_ids, mash_distances_list = rm.parse_mash_cohort(config)
+    assert filtered_ids == []
+    assert mash_results == [[], [], []]
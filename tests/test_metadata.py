@@ -0,0 +1,44 @@
+from pathlib import Path
+
+import pytest
+
+from referenceseeker import metadata as rmetadata
+
+
+@pytest.fixture
+def db_path(tmpdir):
+    db_path = Path(str(tmpdir)).joinpath('db')
+    db_path.mkdir()
+    db_path.joinpath('db.tsv').write_text('R3\t1003\tcomplete\tGenome 3\nR1\t1001\tcontig\tGenome 1\t5000\n')
+    return db_path
+
+
+def genome(ref_genome_id, length):
+    return {'id': ref_genome_id, 'tax': '1000', 'status': 'complete', 'name': 'Genome', 'length': length}
+
+
+def test_read_tsv(db_path):
+    ref_genomes = rmetadata.read_tsv(db_path)
+    assert list(ref_genomes.keys()) == ['R3', 'R1']
+    assert ref_genomes['R3']['length'] is None
+    assert ref_genomes['R1'] == {'id': 'R1', 'tax': '1001', 'status': 'contig', 'name': 'Genome 1', 'length': 5000}
+    assert list(rmetadata.read_tsv(db_path, ['R1', 'R9']).keys()) == ['R1']
+
+
+def test_add_genomes(db_path):
+    #  a new store comprises all genomes of db.tsv followed by new genomes
+    assert not rmetadata.exists(db_path)
+    rmetadata.add_genomes(db_path, [genome('R2', 2000)])
+    assert rmetadata.exists(db_path)
+    ref_genomes = rmetadata.fetch(db_path)
+    assert list(ref_genomes.keys()) == ['R3', 'R1', 'R2']
+    assert ref_genomes == dict(rmetadata.read_tsv(db_path), R2=genome('R2', 2000))
+
+
+def test_fetch(db_path, monkeypatch):
+    #  lookups return requested genomes only, in database order
+    monkeypatch.setattr(rmetadata, 'SQLITE_MAX_VARIABLES', 2)
+    rmetadata.add_genomes(db_path, [genome('R%d' % idx, idx) for idx in range(4, 10)])
+    ref_genomes = rmetadata.fetch(db_path, ['R9', 'R1', 'R5', 'R0', 'R3'])
+    assert list(ref_genomes.keys()) == ['R3', 'R1', 'R5', 'R9']
+    assert rmetadata.fetch(db_path, []) == {}
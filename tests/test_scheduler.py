@@ -0,0 +1,171 @@
+import argparse
+import concurrent.futures as cf
+import threading
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from referenceseeker import scheduler as rs
+
+
+def reference_genomes(ref_genome_ids):
+    return {k: {'id': k, 'length': int(k[1:]) * 1000} for k in ref_genome_ids}
+
+
+def test_align_genomes(tmpdir, monkeypatch):
+    #  all (query, reference, direction) jobs are run within a bounded window and folded per query
+    lock = threading.Lock()
+    in_flight = {'current': 0, 'max': 0}
+
+    def track(delta):
+        with lock:
+            in_flight['current'] += delta
+            in_flight['max'] = max(in_flight['max'], in_flight['current'])
+
+    class TrackingExecutor(cf.ThreadPoolExecutor):
+        def submit(self, fn, *args):
+            track(1)
+            future = super().submit(fn, *args)
+            future.add_done_callback(lambda f: track(-1))
+            return future
+
+    def build_dna_fragments(genome_path, dna_fragments_path):
+        return np.array([1000, 1000], dtype=np.int32)
+
+    def align_query_genome(config, dna_fragments_path, dna_fragments, ref_genome_id, threads=1):
+        errors = int(ref_genome_id[1:]) + int(dna_fragments_path.name.split('-')[-1].split('.')[0])
+        return ref_genome_id, np.array([1000, 1000]), np.array([errors, errors])
+
+    def align_reference_genome(config, genome_path, ref_genome_id, threads=1):
+        return ref_genome_id, np.array([1000], dtype=np.int32), np.array([1000]), np.array([0])
+
+    monkeypatch.setattr(rs.util, 'build_dna_fragments', build_dna_fragments)
+    monkeypatch.setattr(rs.rani, 'align_query_genome', align_query_genome)
+    monkeypatch.setattr(rs.rani, 'align_reference_genome', align_reference_genome)
+    monkeypatch.setattr(rs.util, 'read_reference_genomes', lambda config, ref_genome_ids=None: reference_genomes(ref_genome_ids))
+
+    args = argparse.Namespace(bidirectional=True)
+    config = {'tmp': Path(str(tmpdir)), 'threads': 2}
+    ref_genome_ids = ['R%d' % idx for idx in range(10)]
+    with TrackingExecutor(max_workers=2) as tpe:
+        results = rs.align_genomes(args, config, tpe, ['q0.fna', 'q1.fna', 'q2.fna'], [ref_genome_ids] * 3)
+
+    assert in_flight['max'] <= rs.IN_FLIGHT_JOBS_PER_THREAD * config['threads'] + 3  # window + fragment builds
+    assert len(results) == 3
+    for query_idx, query_results in enumerate(results):
+        assert list(query_results.keys()) == ref_genome_ids
+        for ref_genome_id, (forward, reverse) in query_results.items():
+            assert forward[0] == 1 - (int(ref_genome_id[1:]) + query_idx) / 1000
+            assert reverse == (1.0, 1.0)
+
+
+def test_align_genomes_schedule(tmpdir, monkeypatch):
+    #  long reference genomes are aligned first and spare threads are passed to nucmer
+    submitted = []
+
+    def build_dna_fragments(genome_path, dna_fragments_path):
+        return np.array([1000], dtype=np.int32)
+
+    def align_query_genome(config, dna_fragments_path, dna_fragments, ref_genome_id, threads=1):
+        submitted.append((ref_genome_id, threads))
+        return ref_genome_id, np.array([1000]), np.array([0])
+
+    monkeypatch.setattr(rs.util, 'build_dna_fragments', build_dna_fragments)
+    monkeypatch.setattr(rs.rani, 'align_query_genome', align_query_genome)
+    monkeypatch.setattr(rs.util, 'read_reference_genomes', lambda config, ref_genome_ids=None: reference_genomes(['R1', 'R3', 'R2']))
+
+    args = argparse.Namespace(bidirectional=False)
+    config = {'tmp': Path(str(tmpdir)), 'threads': 6}
+    with cf.ThreadPoolExecutor(max_workers=1) as tpe:
+        results = rs.align_genomes(args, config, tpe, ['q0.fna'], [['R1', 'R3', 'R2']])
+
+    assert list(results[0].keys()) == ['R1', 'R3', 'R2']
+    assert [k for k, threads in submitted] == ['R3', 'R2', 'R1']
+    assert sum(threads for k, threads in submitted) == config['threads']
+
+
+def test_align_genomes_score(tmpdir, monkeypatch):
+    #  alignments of a query genome are scored in a single matrix pass per direction
+    scored = []
+    score_alignments = rs.rani.score_alignments
+
+    def track_score_alignments(dna_fragments, alignment_lengths, non_identities):
+        scored.append(alignment_lengths.shape)
+        return score_alignments(dna_fragments, alignment_lengths, non_identities)
+
+    def build_dna_fragments(genome_path, dna_fragments_path):
+        return np.array([1000, 1000], dtype=np.int32)
+
+    def align_query_genome(config, dna_fragments_path, dna_fragments, ref_genome_id, threads=1):
+        return ref_genome_id, np.array([1000, 1000]), np.array([int(ref_genome_id[1:]), 0])
+
+    def align_reference_genome(config, genome_path, ref_genome_id, threads=1):
+        fragments = int(ref_genome_id[1:])  # reference genomes of different lengths
+        return ref_genome_id, np.full(fragments, 1000), np.full(fragments, 1000), np.zeros(fragments)
+
+    monkeypatch.setattr(rs.util, 'build_dna_fragments', build_dna_fragments)
+    monkeypatch.setattr(rs.rani, 'align_query_genome', align_query_genome)
+    monkeypatch.setattr(rs.rani, 'align_reference_genome', align_reference_genome)
+    monkeypatch.setattr(rs.rani, 'score_alignments', track_score_alignments)
+    monkeypatch.setattr(rs.util, 'read_reference_genomes', lambda config, ref_genome_ids=None: reference_genomes(ref_genome_ids))
+
+    args = argparse.Namespace(bidirectional=True)
+    config = {'tmp': Path(str(tmpdir)), 'threads': 2}
+    with cf.ThreadPoolExecutor(max_workers=2) as tpe:
+        results = rs.align_genomes(args, config, tpe, ['q0.fna'], [['R1', 'R2', 'R3']])
+
+    assert sorted(scored) == [(3, 2), (3, 3)]
+    for ref_genome_id, (forward, reverse) in results[0].items():
+        assert forward == pytest.approx((1 - int(ref_genome_id[1:]) / 2000, 1.0))
+        assert reverse == (1.0, 1.0)
+
+
+def test_align_genomes_top(tmpdir, monkeypatch):
+    #  alignments stop as soon as no unaligned reference genome is expected to outrank the best one by ANI * conserved DNA
+    aligned = []
+    mash_distances = {'R%d' % idx: (idx + 9 if idx > 1 else idx) / 1000 for idx in range(1, 11)}
+
+    def build_dna_fragments(genome_path, dna_fragments_path):
+        return np.array([1000, 1000], dtype=np.int32)
+
+    def align_query_genome(config, dna_fragments_path, dna_fragments, ref_genome_id, threads=1):
+        aligned.append(ref_genome_id)
+        if ref_genome_id == 'R1':  # closest by Mash but only half of the query genome is conserved
+            return ref_genome_id, np.array([1000, 0]), np.array([5, 0])
+        errors = int(round(mash_distances[ref_genome_id] * 1000))
+        return ref_genome_id, np.array([1000, 1000]), np.array([errors, errors])
+
+    monkeypatch.setattr(rs.util, 'build_dna_fragments', build_dna_fragments)
+    monkeypatch.setattr(rs.util, 'read_reference_genomes', lambda config, ref_genome_ids=None: reference_genomes(ref_genome_ids))
+    monkeypatch.setattr(rs.rani, 'align_query_genome', align_query_genome)
+
+    args = argparse.Namespace(bidirectional=False, unfiltered=False)
+    config = {'tmp': Path(str(tmpdir)), 'threads': 1, 'top': 1, 'ani': 0.95, 'conserved_dna': 0.4}
+    ref_genome_ids = sorted(mash_distances, key=lambda k: int(k[1:]))
+    with cf.ThreadPoolExecutor(max_workers=1) as tpe:
+        results = rs.align_genomes(args, config, tpe, ['q0.fna'], [ref_genome_ids], [mash_distances])
+
+    # R1 has the highest ANI but R2 (0.989 * 1.0) outranks it (0.995 * 0.5), R3 might be in flight when R2 settles the search
+    assert aligned[:2] == ['R1', 'R2']
+    assert set(aligned) <= {'R1', 'R2', 'R3'}
+    assert results[0]['R1'] == [(0.995, 0.5)]
+    assert results[0]['R2'] == [(0.989, 1.0)]
+    ranked = sorted(results[0], key=lambda k: rs.ranking_key(results[0][k]), reverse=True)
+    assert ranked[0] == 'R2'
+
+
+def test_is_settled():
+    args = argparse.Namespace(unfiltered=False)
+    config = {'ani': 0.95, 'conserved_dna': 0.69}
+    query = {
+        'ref_genome_ids': ['R1', 'R2'],
+        'directions': [0],
+        'cached_results': {0: {}, 1: {}},
+        'mash_distances': {'R1': 0.001, 'R2': 0.011},
+        0: {'R1': (0.995, 0.70)},
+        1: {}
+    }
+    assert not rs.is_settled(args, config, query, 1)  # R2 might reach 0.989 * 1.0 > 0.995 * 0.70
+    query[0]['R1'] = (0.995, 0.995)
+    assert rs.is_settled(args, config, query, 1)
@@ -0,0 +1,152 @@
+import argparse
+import json
+import socket
+import threading
+from pathlib import Path
+
+import pytest
+
+from referenceseeker import constants as rc
+from referenceseeker import server as rs
+
+
+def server_args(db_path, socket_path=None):
+    return argparse.Namespace(
+        subcommand='serve', db=str(db_path), socket=socket_path, port=None, host='127.0.0.1', server=None,
+        threads=1, verbose=False, crg=100, ani=0.95, conserved_dna=0.69, unfiltered=False, bidirectional=False,
+        top=None, expand=False, native_mash=True, index_cache=0, cache_dir=None, cache_size=0, trace=None, events=None
+    )
+
+
+def server_config(db_path):
+    return {'db_path': db_path, 'lock': threading.Lock(), 'db_state': rs.get_database_state(db_path), 'ref_genomes': {}}
+
+
+@pytest.fixture
+def fake_single(monkeypatch):
+    requests = []
+
+    def single(args, config, out):
+        requests.append((args, config))
+        if args.genome.endswith('fail.fna'):
+            print('partial', file=out)
+            raise SystemExit('ERROR: failed request!')
+        print('%s\t%d\t%d' % (args.genome, args.crg, config['threads']), file=out)
+    monkeypatch.setattr(rs.single, 'single', single)
+    return requests
+
+
+def test_parse_address():
+    assert rs.parse_address('example.org:8080') == ('example.org', 8080)
+    assert rs.parse_address(':8080') == ('localhost', 8080)
+    assert rs.parse_address('/tmp/referenceseeker.sock') == '/tmp/referenceseeker.sock'
+    assert rs.parse_address('/tmp/a:b.sock') == '/tmp/a:b.sock'
+
+
+def test_handle_request(tmp_path, fake_single):
+    #  clients may only set per-request options, resident objects are shared
+    config = server_config(tmp_path)
+    request = {'subcommand': 'single', 'genome': 'q.fna', 'options': {'crg': 7, 'threads': 64, 'db': '/other/db'}}
+    response = rs.handle_request(server_args(tmp_path), config, request)
+    assert response == {'exit': 0, 'output': 'q.fna\t7\t1\n'}
+    args, request_config = fake_single[0]
+    assert args.db == str(tmp_path)
+    assert request_config['ref_genomes'] is config['ref_genomes']
+
+    response = rs.handle_request(server_args(tmp_path), config, {'subcommand': 'single', 'genome': 'fail.fna'})
+    assert response == {'exit': 1, 'output': 'partial\n', 'error': 'ERROR: failed request!'}
+    response = rs.handle_request(server_args(tmp_path), config, {'subcommand': 'batch'})
+    assert response['exit'] == 1
+
+
+def test_handle_request_invalid_options(tmp_path, fake_single, monkeypatch):
+    #  requests with invalid options are answered with an error and leave no tmp directory behind
+    tmp_dirs = []
+    mkdtemp = rs.util.tempfile.mkdtemp
+    monkeypatch.setattr(rs.util.tempfile, 'mkdtemp', lambda: tmp_dirs.append(mkdtemp(dir=str(tmp_path))) or tmp_dirs[-1])
+    config = server_config(tmp_path)
+    for options, error in [({'top': 0}, 'top must be a positive number'), ({'top': 'abc'}, 'top must be a positive number'), ({'n_mash_results': 'abc'}, 'n_mash_results must be a number')]:
+        response = rs.handle_request(server_args(tmp_path), config, {'subcommand': 'single', 'genome': 'q.fna', 'options': options})
+        assert response['exit'] == 1
+        assert error in response['error']
+    assert fake_single == []
+
+    response = rs.handle_request(server_args(tmp_path), config, {'subcommand': 'single', 'genome': 'fail.fna'})
+    assert response['exit'] == 1
+    assert len(tmp_dirs) == 1
+    assert not any(Path(tmp_dir).exists() for tmp_dir in tmp_dirs)
+
+
+def test_refresh_database(tmp_path, monkeypatch):
+    #  resident database objects are reloaded after database updates
+    tmp_path.joinpath(rc.SHARDS_MANIFEST).write_text('db.msh\t1\n')
+    config = server_config(tmp_path)
+    config['sketches'] = 'former sketches'
+    reloads = []
+
+    def load_database(config):
+        reloads.append(dict(config))
+        config['db_state'] = rs.get_database_state(config['db_path'])
+    monkeypatch.setattr(rs, 'load_database', load_database)
+
+    assert not rs.refresh_database(config)
+    tmp_path.joinpath(rc.SHARDS_MANIFEST).write_text('db.msh\t1\nshards/shard-00001.msh\t1\n')
+    assert rs.refresh_database(config)
+    assert 'sketches' not in reloads[0]
+    assert not rs.refresh_database(config)
+    assert len(reloads) == 1
+
+
+def test_submit(tmp_path, fake_single, capsys):
+    #  requests are forwarded through a Unix socket and answered by the server
+    socket_path = tmp_path.joinpath('server.sock')
+    server = rs.UnixServer(str(socket_path), rs.RequestHandler)
+    server.args = server_args(tmp_path, str(socket_path))
+    server.config = server_config(tmp_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        genome_path = tmp_path.joinpath('q.fna')
+        client_args = argparse.Namespace(subcommand='single', genome=str(genome_path), server=str(socket_path), crg=3, ani=0.9, threads=8)
+        rs.submit(client_args)
+        assert capsys.readouterr().out == '%s\t3\t1\n' % genome_path
+        assert fake_single[0][0].ani == 0.9
+
+        with pytest.raises(SystemExit, match='failed request'):
+            rs.submit(argparse.Namespace(subcommand='single', genome='fail.fna', server=str(socket_path)))
+
+        with pytest.raises(SystemExit, match='top must be a positive number'):
+            rs.submit(argparse.Namespace(subcommand='single', genome=str(genome_path), server=str(socket_path), top=0))
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(socket_path))
+            with sock.makefile('rwb') as fh:
+                fh.write(b'not json\n')
+                fh.flush()
+                response = json.loads(fh.readline().decode())
+        assert response['exit'] == 1
+        assert 'malformed request' in response['error']
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_submit_invalid_response(tmp_path):
+    #  clients exit with an error message if the server does not reply with a valid response
+    socket_path = tmp_path.joinpath('server.sock')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(str(socket_path))
+        sock.listen(1)
+
+        def close_connection():
+            connection, address = sock.accept()
+            with connection, connection.makefile('rb') as fh:
+                fh.readline()
+        thread = threading.Thread(target=close_connection)
+        thread.start()
+        try:
+            with pytest.raises(SystemExit, match='no valid response'):
+                rs.submit(argparse.Namespace(subcommand='single', genome='q.fna', server=str(socket_path)))
+        finally:
+            thread.join()
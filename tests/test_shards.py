@@ -0,0 +1,60 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from referenceseeker import shards as rshards
+
+
+@pytest.fixture
+def db_path(tmpdir):
+    db_path = Path(str(tmpdir)).joinpath('db')
+    db_path.mkdir()
+    shutil.copyfile('tests/db/db.msh', str(db_path.joinpath('db.msh')))
+    return db_path
+
+
+def test_read_manifest_legacy(db_path):
+    #  databases without a manifest comprise db.msh as single shard
+    assert rshards.read_manifest(db_path) == [('db.msh', 4)]
+    assert rshards.get_shards(db_path) == [db_path.joinpath('db.msh')]
+    db_path.joinpath('db.msh').write_bytes(b'')
+    assert rshards.read_manifest(db_path) == []
+    assert rshards.get_shards(db_path) == []
+
+
+def test_write_manifest(db_path):
+    shards = [('db.msh', 4), ('shards/shard-00001.msh', 2)]
+    rshards.write_manifest(db_path, shards)
+    assert rshards.read_manifest(db_path) == shards
+    assert rshards.get_shards(db_path) == [db_path.joinpath('db.msh'), db_path.joinpath('shards/shard-00001.msh')]
+
+
+def test_compact(db_path, monkeypatch):
+    #  consecutive shards are merged up to the shard size, merged shards are retired and removed by a later cleanup
+    pasted = []
+
+    def paste_sketches(config, shard_path, sketch_paths):
+        pasted.append([p.name for p in sketch_paths])
+        shard_path.write_bytes(b'')
+
+    monkeypatch.setattr(rshards, 'paste_sketches', paste_sketches)
+    shards = [('db.msh', 4)]
+    for idx in range(1, 5):
+        shard_name = rshards.new_shard_name(db_path)
+        db_path.joinpath(shard_name).write_bytes(b'')
+        shards.append((shard_name, idx))
+    rshards.write_manifest(db_path, shards)
+
+    assert rshards.compact({}, db_path, 6) == (5, 3)
+    assert pasted == [['db.msh', 'shard-00001.msh'], ['shard-00002.msh', 'shard-00003.msh']]
+    assert rshards.read_manifest(db_path) == [('shards/shard-00005.msh', 5), ('shards/shard-00006.msh', 5), ('shards/shard-00004.msh', 4)]
+    assert db_path.joinpath('db.msh').exists()  # might still be read by running queries
+    assert rshards.remove_retired_shards(db_path) == 0
+    assert sorted(p.name for p in db_path.joinpath('shards').glob('*.msh')) == ['shard-%05d.msh' % idx for idx in range(1, 7)]
+
+    assert rshards.remove_retired_shards(db_path, 0) == 4
+    assert not db_path.joinpath('db.msh').exists()
+    assert sorted(p.name for p in db_path.joinpath('shards').glob('*.msh')) == ['shard-00004.msh', 'shard-00005.msh', 'shard-00006.msh']
+    assert db_path.joinpath('shards', 'retired.tsv').read_text() == ''
+    assert rshards.remove_retired_shards(db_path, 0) == 0
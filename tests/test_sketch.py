@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import pytest
+
+from referenceseeker import sketch as rs
+
+
+@pytest.fixture(scope="module")
+def db_sketches():
+    return rs.read_sketches(Path('tests/db/db.msh').resolve())
+
+
+def test_read_sketches(db_sketches):
+    assert db_sketches['kmer'] == 32
+    assert db_sketches['size'] == 10000
+    assert db_sketches['seed'] == 42
+    assert db_sketches['ids'] == ['GCF_000439415.1', 'GCF_002760915.1', 'GCF_900205275.1', 'GCF_002211925.1']
+    assert list(db_sketches['lengths']) == [4808805, 4678113, 4676595, 4468959]
+    assert list(db_sketches['counts']) == [10000] * 4
+    assert db_sketches['hashes'][0, 0] == 1588450635144
+
+    # hashes must be sorted in order to allow sorted merges
+    for hashes in db_sketches['hashes']:
+        assert (hashes[1:] > hashes[:-1]).all()
+
+
+def test_read_sketch_params(tmpdir):
+    assert rs.read_sketch_params(Path('tests/db/db.msh')) == (32, 10000, 42)
+    sketch_path = Path(str(tmpdir)).joinpath('empty.msh')
+    sketch_path.write_bytes(b'')
+    with pytest.raises(ValueError):
+        rs.read_sketch_params(sketch_path)
+
+
+def test_compute_distances(db_sketches):
+    #  check distances against values computed by 'mash dist db.msh db.msh'
+    query_hashes = db_sketches['hashes'][0]
+    distances = dict(rs.compute_distances(db_sketches, query_hashes))
+    assert distances['GCF_000439415.1'] == 0.0
+    assert distances['GCF_002760915.1'] == pytest.approx(0.00995615, abs=1e-8)
+    assert distances['GCF_900205275.1'] == pytest.approx(0.0151986, abs=1e-7)
+    assert distances['GCF_002211925.1'] == pytest.approx(0.0752612, abs=1e-7)
+
+
+def test_compute_distances_max_distance(db_sketches):
+    query_hashes = db_sketches['hashes'][0]
+    hits = rs.compute_distances(db_sketches, query_hashes, 0.05)
+    assert [ref_id for ref_id, distance in hits] == ['GCF_000439415.1', 'GCF_002760915.1', 'GCF_900205275.1']
+
+
+def test_compute_distances_empty(db_sketches):
+    assert rs.compute_distances(db_sketches, []) == []
@@ -0,0 +1,39 @@
+import concurrent.futures as cf
+import json
+import subprocess as sp
+
+from referenceseeker import trace as rtrace
+
+
+def test_disabled():
+    config = {'trace': rtrace.create(None)}
+    with rtrace.stage(config, 'stage'):
+        pass
+    with cf.ThreadPoolExecutor(max_workers=1) as tpe:
+        assert rtrace.submit(config, tpe, 'job', sum, [1, 2]).result() == 3
+    proc = rtrace.popen(config, ['sh', '-c', 'exit 3'], stdout=sp.DEVNULL)
+    assert rtrace.wait(config, proc) == 3
+
+
+def test_trace(tmpdir):
+    trace_path = tmpdir.join('trace.json')
+    config = {'trace': rtrace.create(str(trace_path))}
+    with rtrace.stage(config, 'align', references=1):
+        with cf.ThreadPoolExecutor(max_workers=1) as tpe:
+            assert rtrace.submit(config, tpe, 'job', sum, [1, 2], reference='R1').result() == 3
+        proc = rtrace.popen(config, ['sh', '-c', 'exit 3'], stdout=sp.DEVNULL)
+        assert rtrace.wait(config, proc) == 3
+    rtrace.write(config)
+
+    events = {event['name']: event for event in json.loads(trace_path.read())['traceEvents'] if event['ph'] == 'X'}
+    assert set(events.keys()) == {'align', 'job', 'sh'}
+    assert events['align']['cat'] == 'stage'
+    assert events['align']['args']['references'] == 1
+    assert 'max_rss_kb' not in events['align']['args']  # peak RSS of the whole process, not of the stage
+    assert events['align']['args']['process_max_rss_kb'] > 0
+    assert 'rss_start_kb' in events['align']['args'] and 'rss_end_kb' in events['align']['args']
+    assert events['job']['args']['reference'] == 'R1'
+    assert events['job']['args']['queue_wait_ms'] >= 0
+    assert events['sh']['pid'] == proc.pid
+    assert events['sh']['args']['exit'] == 3
+    assert events['align']['ts'] <= events['job']['ts'] <= events['sh']['ts']
@@ -1,4 +1,4 @@
-
+import os
 from pathlib import Path
 
 from referenceseeker import constants as rc
@@ -11,8 +11,86 @@ def test_build_dna_fragments(tmpdir):
     dna_fragments = ru.build_dna_fragments(genome_path, dna_fragments_path)
 
     # first nucleotide fragment must have standard length
-    assert dna_fragments[1]['length'] == rc.FRAGMENT_SIZE
+    assert dna_fragments[0] == rc.FRAGMENT_SIZE
 
     # last nucleotide fragment should have a non-standard length
-    last_fragment_id = sorted(list(dna_fragments.keys()))[-1]
-    assert dna_fragments[last_fragment_id]['length'] != rc.FRAGMENT_SIZE
+    assert dna_fragments[-1] != rc.FRAGMENT_SIZE
+
+
+def test_build_dna_fragments_lengths(tmpdir):
+    genome_path = Path(str(tmpdir)).joinpath('genome.fasta')
+    contig_lengths = [3 * rc.FRAGMENT_SIZE + rc.MIN_FRAGMENT_SIZE, 3 * rc.FRAGMENT_SIZE + rc.MIN_FRAGMENT_SIZE + 1, 50]
+    with genome_path.open(mode='w') as fh:
+        for idx, contig_length in enumerate(contig_lengths):
+            fh.write('>contig-%d\n%s\n' % (idx, 'ACGT' * (contig_length // 4) + 'ACGT'[:contig_length % 4]))
+    dna_fragments_path = Path(str(tmpdir)).joinpath('fragments.fna')
+    dna_fragments = ru.build_dna_fragments(genome_path, dna_fragments_path)
+
+    # fragments shorter than MIN_FRAGMENT_SIZE are merged into the preceding fragment
+    expected_lengths = [rc.FRAGMENT_SIZE, rc.FRAGMENT_SIZE, rc.FRAGMENT_SIZE + rc.MIN_FRAGMENT_SIZE]
+    expected_lengths += [rc.FRAGMENT_SIZE, rc.FRAGMENT_SIZE, rc.FRAGMENT_SIZE, rc.MIN_FRAGMENT_SIZE + 1]
+    expected_lengths += [50]
+    assert list(dna_fragments) == expected_lengths
+    assert sum(dna_fragments) == sum(contig_lengths)
+
+    # fragment ids are 1-based indices into the fragment length array
+    with dna_fragments_path.open() as fh:
+        lines = fh.read().splitlines()
+    assert lines[0::2] == ['>%d' % (idx + 1) for idx in range(len(expected_lengths))]
+    assert [len(line) for line in lines[1::2]] == expected_lengths
+
+
+def test_build_dna_fragments_wrapped(tmpdir, monkeypatch):
+    monkeypatch.setattr(ru, 'READ_BLOCK_SIZE', 7)  # split lines and headers across reads
+    sequence = 'ACGT' * (rc.FRAGMENT_SIZE // 2)
+    genome_path = Path(str(tmpdir)).joinpath('genome.fasta')
+    with genome_path.open(mode='w', newline='') as fh:
+        fh.write('>contig-1 a long description line\r\n')
+        fh.write(''.join('%s\r\n' % sequence[i:i + 60] for i in range(0, len(sequence), 60)))
+        fh.write('\n>contig-2\n>contig-3\nAC GT\nAC')
+    dna_fragments_path = Path(str(tmpdir)).joinpath('fragments.fna')
+    dna_fragments = ru.build_dna_fragments(genome_path, dna_fragments_path)
+
+    # line breaks and whitespace are skipped, empty contigs are kept
+    assert list(dna_fragments) == [rc.FRAGMENT_SIZE, rc.FRAGMENT_SIZE, 0, 6]
+    with dna_fragments_path.open() as fh:
+        lines = fh.read().splitlines()
+    assert lines[1] + lines[3] == sequence
+    assert lines[4:] == ['>3', '', '>4', 'ACGTAC']
+
+
+def test_store_dna_fragments(tmpdir):
+    db_path = Path(str(tmpdir))
+    genome_path = db_path.joinpath('G1.fna')
+    with genome_path.open(mode='w') as fh:
+        fh.write('>contig-1\n%s\n' % ('ACGT' * 1000))
+    assert ru.read_dna_fragments(db_path, 'G1') is None
+
+    dna_fragments = ru.store_dna_fragments(genome_path, db_path, 'G1')
+    dna_fragments_path, stored_dna_fragments = ru.read_dna_fragments(db_path, 'G1')
+    assert list(stored_dna_fragments) == list(dna_fragments)
+    assert dna_fragments_path == db_path.joinpath(rc.FRAGMENTS_DIR, 'G1.fasta')
+    with dna_fragments_path.open() as fh:
+        assert len(fh.read().splitlines()) == 2 * len(dna_fragments)
+
+
+def test_binaries_cache(tmpdir):
+    bin_path = Path(str(tmpdir)).joinpath('bin')
+    bin_path.mkdir()
+    calls_path = Path(str(tmpdir)).joinpath('calls.txt')
+    for binary in ['mash', 'nucmer']:
+        binary_path = bin_path.joinpath(binary)
+        binary_path.write_text('#!/bin/sh\necho %s >> %s\n' % (binary, calls_path))
+        binary_path.chmod(0o755)
+    config = {'env': {'PATH': str(bin_path), 'XDG_CACHE_HOME': str(tmpdir.join('cache'))}}
+
+    ru.test_binaries(config)
+    assert calls_path.read_text().split() == ['mash', 'nucmer']
+    ru.test_binaries(config)  # passed tests are cached
+    assert calls_path.read_text().split() == ['mash', 'nucmer']
+
+    binary_path = bin_path.joinpath('nucmer')
+    stat = binary_path.stat()
+    os.utime(str(binary_path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    ru.test_binaries(config)  # changed binaries are tested again
+    assert calls_path.read_text().split() == ['mash', 'nucmer', 'mash', 'nucmer']